@@ -0,0 +1,218 @@
+# Persistent cache of analysis results.
+#
+# Text analyses (GetTextFile) of a lens which has not changed give the
+# same results, so repeated runs can take them from disk.  Results are
+# keyed by the hash of the lens (see modelhash.py), the analysis type,
+# the content of the settings file and the name of any parsing applied
+# to the text.  They are pickled, compressed with zlib and kept in a
+# sqlite database, whose size is bounded by evicting the least recently
+# used results.
+#
+# The hash of the server lens is only recomputed when the revision of
+# the connection (see Connection.revision) has changed, so a hit makes
+# no request of the server.  Changes made in the Zemax program window,
+# or through other connections, are not seen by the revision: pass the
+# hash of the lens (`model`) explicitly in that case.
+#
+# Analyses of the rays of the last NSCTrace, such as the detector
+# viewer, depend on the trace as well as the lens.  Neither the hash
+# nor the revision changes when the lens is traced again, so these
+# analyses (AnalysisCache.trace_analyses) are never cached.
+
+import io
+import zlib
+import pickle
+import sqlite3
+import hashlib
+import threading
+import weakref
+from contextlib import contextmanager
+from modelhash import model_hash
+
+
+class AnalysisCache(object):
+    """Cache of analysis results, held in a sqlite database.
+
+    path :
+        file of the database, which is created if it does not exist
+    max_bytes :
+        bound of the total (compressed) size of the results
+    level :
+        zlib compression level
+    extra :
+        hash the extra data of the surfaces of the server lens (see
+        modelhash.model_hash).  Without it, analyses cached before an
+        extra data change (SetExtra) are still returned, but each
+        column costs a request for every surface.
+    """
+    def __init__(self, path, max_bytes=256 * 2**20, level=6, extra=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.level = level
+        self.extra = extra
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._models = weakref.WeakKeyDictionary()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, data BLOB, "
+                         "size INTEGER, used INTEGER)")
+        self._db.commit()
+
+    # analyses of the rays of the last NSCTrace
+    trace_analyses = frozenset(["Dvr"])
+
+    @staticmethod
+    def key(model, analysis, settings=b"", parser=""):
+        """Return the key of a result.
+
+        model :
+            hash of the lens
+        analysis :
+            analysis type (eg. "Spt"), with any flags
+        settings :
+            content of the settings file
+        parser :
+            name of the parsing applied to the text of the analysis
+        """
+        h = hashlib.sha256()
+        for part in (model, analysis, parser):
+            part = part.encode("utf-8")
+            h.update(("%d:" % len(part)).encode("ascii") + part)
+        h.update(settings)
+        return h.hexdigest()
+
+    # results are ordered by use with a counter, which unlike the time
+    # cannot tie
+    _next_use = "SELECT COALESCE(MAX(used), 0) + 1 FROM results"
+
+    def get(self, key):
+        """Return the result stored under `key`, or raise KeyError."""
+        with self._lock:
+            row = self._db.execute("SELECT data FROM results WHERE key = ?",
+                                   (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                raise KeyError(key)
+            self._db.execute("UPDATE results SET used = (%s) WHERE key = ?"
+                             % self._next_use, (key,))
+            self._db.commit()
+            self.hits += 1
+        return pickle.loads(zlib.decompress(bytes(row[0])))
+
+    def put(self, key, value):
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                             self.level)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO results VALUES "
+                             "(?, ?, ?, (%s))" % self._next_use,
+                             (key, sqlite3.Binary(data), len(data)))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total, = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM results "
+                                "ORDER BY used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    @property
+    def size(self):
+        """Total size of the stored results, in bytes."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM results")
+            self._db.commit()
+
+    def model(self, conn):
+        """Return the hash of the server lens.
+
+        The hash is kept until the revision of the connection changes.
+        """
+        revision, digest = self._models.get(conn, (None, None))
+        if revision != conn.revision:
+            revision = conn.revision
+            digest = model_hash(conn, self.extra)
+            self._models[conn] = (revision, digest)
+        return digest
+
+    def analysis(self, conn, type, settingspath=None, flag=0,
+                 parse=None, model=None, timeout=120000):
+        """Return the result of a text analysis (see
+        Connection.GetTextFileString), from the cache if it holds it.
+
+        Analyses in `trace_analyses` are always requested, as they
+        depend on the last ray trace.
+
+        parse :
+            function of the text of the analysis, whose result is cached
+            instead of the text.  The results of different functions are
+            cached separately, by the module and name of the function,
+            so it should not be a lambda.
+        model :
+            hash of the lens.  By default the hash of the server lens
+            (see AnalysisCache.model).
+        """
+        if type in self.trace_analyses:
+            value = conn.GetTextFileString(type, settingspath, flag, timeout)
+            return value if parse is None else parse(value)
+        if model is None:
+            model = self.model(conn)
+        settings = b""
+        if settingspath is not None:
+            with open(settingspath, "rb") as f:
+                settings = f.read()
+        parser = ""
+        if parse is not None:
+            parser = "%s.%s" % (parse.__module__, parse.__name__)
+        key = self.key(model, "%s,%d" % (type, flag), settings, parser)
+        try:
+            return self.get(key)
+        except KeyError:
+            pass
+        value = conn.GetTextFileString(type, settingspath, flag, timeout)
+        if parse is not None:
+            value = parse(value)
+        self.put(key, value)
+        return value
+
+    def text(self, conn, type, settingspath=None, flag=0, model=None,
+             timeout=120000):
+        """Cached Connection.GetTextFileString."""
+        return self.analysis(conn, type, settingspath, flag, model=model,
+                             timeout=timeout)
+
+    @contextmanager
+    def text_object(self, conn, type, settingspath=None, flag=0, model=None,
+                    timeout=120000):
+        """Cached Connection.GetTextFileObject."""
+        yield io.StringIO(self.text(conn, type, settingspath, flag, model,
+                                    timeout))
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,175 @@
+# Client-side composition of the global coordinate frames of surfaces.
+#
+# The global frame of each surface depends only on the thicknesses of
+# the preceding surfaces, the decentres and tilts of coordinate breaks,
+# coordinate returns and the choice of global reference surface.  The
+# frames can be composed locally, for all surfaces at once, instead of
+# requesting GetGlobalMatrix for each surface.  Leading dimensions on
+# the thickness and coordinate break arrays are carried through the
+# calculation, so that sweeps over (eg.) fold mirror angles are
+# evaluated as a single array operation.
+#
+# Tilts and decentres of non coordinate break surfaces (defined in the
+# surface "Tilt/Decenter" tab) are not modelled.
+
+import numpy as np
+from libzmx import CoordinateBreak
+
+# Columns of the coordinate break parameter array.
+OFFSET_X, OFFSET_Y, ROTATE_X, ROTATE_Y, ROTATE_Z, ORDER = range(6)
+
+# Zemax returns this thickness for an object at infinity.
+infinity = 1e10
+
+
+def _rotations(angles, axis):
+    """Rotation matrices about a coordinate axis (angles in degrees)."""
+    a = np.radians(angles)
+    c, s = np.cos(a), np.sin(a)
+    i, j = [k for k in range(3) if k != axis]
+    r = np.zeros(np.shape(a) + (3, 3))
+    r[..., axis, axis] = 1.0
+    r[..., i, i] = c
+    r[..., j, j] = c
+    r[..., i, j] = -s
+    r[..., j, i] = s
+    return r
+
+
+def translations(offsets):
+    """Homogeneous translations from offset vectors of shape (..., 3)."""
+    offsets = np.asarray(offsets, float)
+    t = np.zeros(offsets.shape[:-1] + (4, 4))
+    t[..., :, :] = np.eye(4)
+    t[..., :3, 3] = offsets
+    return t
+
+
+def coordinate_break_matrices(breaks):
+    """Homogeneous transformations of coordinate breaks.
+
+    breaks :
+        array of shape (..., 6), containing the coordinate break
+        parameters (offset_x, offset_y, rotate_x, rotate_y, rotate_z,
+        rotate_before_offset)
+
+    Returns an array of shape (..., 4, 4), mapping coordinates after
+    the break to coordinates before it.
+    """
+    breaks = np.asarray(breaks, float)
+    rx = _rotations(breaks[..., ROTATE_X], 0)
+    ry = _rotations(breaks[..., ROTATE_Y], 1)
+    rz = _rotations(breaks[..., ROTATE_Z], 2)
+    offset = np.zeros(breaks.shape[:-1] + (3,))
+    offset[..., 0] = breaks[..., OFFSET_X]
+    offset[..., 1] = breaks[..., OFFSET_Y]
+
+    # Decentre, then tilt about x, then the new y, then the new z ...
+    decentre_first = np.matmul(translations(offset),
+                               _homogeneous(np.matmul(np.matmul(rx, ry), rz)))
+    # ... or the reverse.
+    rotate_first = np.matmul(_homogeneous(np.matmul(np.matmul(rz, ry), rx)),
+                             translations(offset))
+    order = (breaks[..., ORDER] != 0)[..., np.newaxis, np.newaxis]
+    return np.where(order, rotate_first, decentre_first)
+
+
+def _homogeneous(rotations):
+    m = np.zeros(rotations.shape[:-2] + (4, 4))
+    m[..., :3, :3] = rotations
+    m[..., 3, 3] = 1.0
+    return m
+
+
+def compose_frames(thickness, breaks, is_break, returns=(), globalref=1):
+    """Compose the global coordinate frames of a sequence of surfaces.
+
+    thickness :
+        array of shape (..., N) of surface thicknesses
+    breaks :
+        array of shape (..., N, 6) of coordinate break parameters (see
+        coordinate_break_matrices).  Rows of other surfaces are ignored.
+    is_break :
+        sequence of N flags marking the coordinate break surfaces
+    returns :
+        sequence of (code, target surface number) coordinate returns
+        for each surface.  Codes are as used by
+        CoordinateBreak.return_to: 0 none, 1 orientation only,
+        2 orientation and x, y offsets, 3 orientation and x, y, z
+        offsets.
+    globalref :
+        the global coordinate reference surface number
+
+    Returns an array of shape (..., N, 4, 4) of homogeneous
+    transformations from surface to global coordinates (as returned by
+    SurfaceSequence.global_frames).
+    """
+    thickness = np.asarray(thickness, float)
+    breaks = np.asarray(breaks, float)
+    n = thickness.shape[-1]
+    returns = list(returns) or [(0, 0)] * n
+    batch = np.broadcast(thickness[..., 0], breaks[..., 0, 0]).shape
+
+    cb = coordinate_break_matrices(breaks)
+    frames = np.zeros(batch + (n, 4, 4))
+    # Compose relative to surface 1, to avoid the loss of precision
+    # from an object at infinity.
+    frames[..., 1, :, :] = np.eye(4)
+    offset = np.zeros(batch + (3,))
+    offset[..., 2] = -np.minimum(thickness[..., 0], infinity)
+    frames[..., 0, :, :] = translations(offset)
+
+    for i in range(1, n):
+        if i > 1:
+            offset[..., 2] = thickness[..., i-1]
+            frames[..., i, :, :] = np.matmul(frames[..., i-1, :, :],
+                                             translations(offset))
+        if is_break[i]:
+            frames[..., i, :, :] = np.matmul(frames[..., i, :, :],
+                                             cb[..., i, :, :])
+        code, target = returns[i]
+        if code:
+            frames[..., i, :, :] = _coordinate_return(
+                frames[..., i, :, :], frames[..., target, :, :], code)
+
+    ref = np.linalg.inv(frames[..., globalref, :, :])
+    return np.matmul(ref[..., np.newaxis, :, :], frames)
+
+
+def _coordinate_return(frame, target, code):
+    result = target.copy()
+    if code == 1:
+        # orientation only
+        result[..., :3, 3] = frame[..., :3, 3]
+    elif code == 2:
+        # orientation and x, y offsets: retain the z offset from the
+        # target surface, in its coordinate frame
+        delta = frame[..., :3, 3] - target[..., :3, 3]
+        z = np.einsum("...i,...i->...", target[..., :3, 2], delta)
+        result[..., :3, 3] += target[..., :3, 2] * z[..., np.newaxis]
+    return result
+
+
+def frame_inputs(prescription):
+    """Extract the arguments of compose_frames from a Prescription.
+
+    Returns a dict, whose arrays can be modified (eg. broadcast over a
+    range of tilt angles) before passing it to compose_frames.
+    """
+    surfaces = prescription.surfaces
+    is_break = [s.type == CoordinateBreak.surface_type for s in surfaces]
+    breaks = np.zeros((len(surfaces), 6))
+    for row, s, cb in zip(breaks, surfaces, is_break):
+        if cb:
+            row[:] = s.parameters[1:7]
+    return dict(
+        thickness=np.array([s.thickness for s in surfaces]),
+        breaks=breaks,
+        is_break=is_break,
+        returns=[s.coord_return for s in surfaces],
+        globalref=prescription.system.globalrefsurf)
+
+
+def prescription_frames(prescription):
+    """Compose the global frames of all surfaces in a Prescription."""
+    return compose_frames(**frame_inputs(prescription))
@@ -0,0 +1,255 @@
+# Glass catalogs and refractive indices computed on the client.
+#
+# Zemax glass catalogs (.AGF files, in the Glasscat directory of the
+# data path) hold the dispersion formula and coefficients of each glass,
+# with the coefficients of the Schott model of the change of index with
+# temperature.  refractive_index evaluates the indices of many glasses,
+# at many wavelengths and temperatures, with array operations, so that
+# client code (ray tracing, glass substitution) need not request them
+# from the server with GetIndex.
+#
+# As in Zemax, the data of a glass are relative to air at the reference
+# temperature of the glass and a pressure of 1 atmosphere, and indices
+# at the system temperature and pressure are relative to air at those
+# conditions.  Wavelengths are in micrometres and temperatures in
+# degrees Celsius.
+
+from __future__ import print_function
+import os
+import numpy as np
+from collections import namedtuple
+from zmxfile import decode_text_file
+
+
+Glass = namedtuple("Glass", [
+    "name", "catalog", "formula", "nd", "vd", "status", "coefficients",
+    "thermal", "wavelength_range", "dpgf", "tce", "density",
+    "relative_cost", "comment"])
+# formula : number of the dispersion formula (see formula_names)
+# status :
+#     0 standard, 1 preferred, 2 obsolete, 3 special, 4 melt
+# coefficients : the 10 coefficients of the dispersion formula
+# thermal :
+#     (D0, D1, D2, E0, E1, lambda_tk, reference temperature) of the
+#     Schott thermal model
+# wavelength_range : (minimum, maximum) wavelength of the data
+# tce : thermal expansion coefficient (1e-6/K) from -30 to 70 C
+
+formula_names = {
+    1: "Schott", 2: "Sellmeier 1", 3: "Herzberger", 4: "Sellmeier 2",
+    5: "Conrady", 6: "Sellmeier 3", 7: "Handbook of Optics 1",
+    8: "Handbook of Optics 2", 9: "Sellmeier 4", 10: "Extended 1",
+    11: "Sellmeier 5", 12: "Extended 2", 13: "Extended 3"}
+
+num_coefficients = 10
+
+
+def _number(token, default=np.nan):
+    try:
+        return float(token)
+    except ValueError:
+        # unknown values are written as "-"
+        return default
+
+
+def _values(fields, n, default=0.0):
+    values = [_number(x, default) for x in fields[:n]]
+    return tuple(values + [default] * (n - len(values)))
+
+
+def parse_agf(lines, catalog=""):
+    """Return the list of Glass of the lines of a .AGF file."""
+    glasses = []
+    glass = None
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        keyword, args = fields[0], fields[1:]
+        if keyword == "NM":
+            if glass is not None:
+                glasses.append(Glass(**glass))
+            args = args + ["-"] * (7 - len(args))
+            glass = dict(
+                name=args[0].upper(), catalog=catalog,
+                formula=int(_number(args[1], 0)), nd=_number(args[3]),
+                vd=_number(args[4]), status=int(_number(args[6], 0)),
+                coefficients=(0.0,) * num_coefficients,
+                thermal=(0.0,) * 6 + (20.0,),
+                wavelength_range=(np.nan, np.nan), dpgf=np.nan,
+                tce=np.nan, density=np.nan, relative_cost=np.nan,
+                comment="")
+        elif glass is None:
+            continue
+        elif keyword == "GC":
+            glass["comment"] = line.strip()[2:].strip()
+        elif keyword == "ED":
+            tce, _, density, dpgf = _values(args, 4, np.nan)
+            glass.update(tce=tce, density=density, dpgf=dpgf)
+        elif keyword == "CD":
+            glass["coefficients"] = _values(args, num_coefficients)
+        elif keyword == "TD":
+            glass["thermal"] = _values(args, 6) + _values(args[6:], 1, 20.0)
+        elif keyword == "OD":
+            glass["relative_cost"] = _values(args, 1, np.nan)[0]
+        elif keyword == "LD":
+            glass["wavelength_range"] = _values(args, 2, np.nan)
+    if glass is not None:
+        glasses.append(Glass(**glass))
+    return glasses
+
+
+def read_agf(path):
+    """Read a .AGF file (UTF-16 or plain text)."""
+    catalog = os.path.splitext(os.path.basename(path))[0].upper()
+    with open(path, "rb") as f:
+        return parse_agf(decode_text_file(f, "latin-1"), catalog)
+
+
+def catalog_directory(conn):
+    """Return the directory of the glass catalogs of the server."""
+    data_path, lenses_path = conn.GetPath()
+    return os.path.join(data_path, "Glasscat")
+
+
+def load_catalogs(directory, names=None):
+    """Read the glass catalogs in a directory.
+
+    names :
+        names of the catalogs to read (eg. ["SCHOTT", "OHARA"]), or None
+        to read all the catalogs in the directory
+
+    Returns a dict of Glass keyed by glass name.  A glass in more than
+    one catalog is taken from the first catalog named.
+    """
+    files = dict((os.path.splitext(f)[0].upper(), f)
+                 for f in os.listdir(directory)
+                 if f.upper().endswith(".AGF"))
+    if names is None:
+        names = sorted(files)
+    glasses = {}
+    for name in names:
+        for glass in read_agf(os.path.join(directory, files[name.upper()])):
+            glasses.setdefault(glass.name, glass)
+    return glasses
+
+
+def air_index(wavelengths, temperature=20.0, pressure=1.0):
+    """Refractive index of air, as computed by Zemax.
+
+    pressure : relative to 1 atmosphere
+    """
+    w2 = np.asarray(wavelengths, float) ** 2
+    reference = 1 + 1e-8 * (6432.8 + 2949810 * w2 / (146 * w2 - 1) +
+                            25540 * w2 / (41 * w2 - 1))
+    temperature = np.asarray(temperature, float)
+    return 1 + (reference - 1) * pressure / (1 + 3.4785e-3 *
+                                             (temperature - 15))
+
+
+def _sellmeier(c, w2, terms):
+    n2 = 1.0
+    for k in range(terms):
+        n2 = n2 + c[2*k] * w2 / (w2 - c[2*k+1])
+    return n2
+
+
+def _laurent(c, w2, powers):
+    """Sum of c[k] * w2 ** powers[k]."""
+    n2 = 0.0
+    for k, power in enumerate(powers):
+        n2 = n2 + c[k] * w2 ** power
+    return n2
+
+
+def _herzberger(c, w2):
+    L = 1 / (w2 - 0.028)
+    return (c[0] + c[1] * L + c[2] * L**2 + c[3] * w2 + c[4] * w2**2 +
+            c[5] * w2**3) ** 2
+
+
+def _conrady(c, w2):
+    w = np.sqrt(w2)
+    return (c[0] + c[1] / w + c[2] / w**3.5) ** 2
+
+
+# the square of the index, as a function of the coefficients and of the
+# square of the wavelength
+_formulas = {
+    1: lambda c, w2: _laurent(c, w2, (0, 1, -1, -2, -3, -4)),
+    2: lambda c, w2: _sellmeier(c, w2, 3),
+    3: _herzberger,
+    4: lambda c, w2: (1 + c[0] + c[1] * w2 / (w2 - c[2]**2) +
+                      c[3] / (w2 - c[4]**2)),
+    5: _conrady,
+    6: lambda c, w2: _sellmeier(c, w2, 4),
+    7: lambda c, w2: c[0] + c[1] / (w2 - c[2]) - c[3] * w2,
+    8: lambda c, w2: c[0] + c[1] * w2 / (w2 - c[2]) - c[3] * w2,
+    9: lambda c, w2: c[0] + c[1] * w2 / (w2 - c[2]) + c[3] * w2 / (w2 - c[4]),
+    10: lambda c, w2: _laurent(c, w2, (0, 1, -1, -2, -3, -4, -5, -6)),
+    11: lambda c, w2: _sellmeier(c, w2, 5),
+    12: lambda c, w2: _laurent(c, w2, (0, 1, -1, -2, -3, -4, 2, 3)),
+    13: lambda c, w2: _laurent(c, w2, (0, 1, 2, -1, -2, -3, -4, -5, -6))}
+
+
+def dispersion_index(glasses, wavelengths):
+    """Indices of the glasses from their dispersion formulas.
+
+    wavelengths :
+        array whose first axis is of the length of `glasses`
+    """
+    wavelengths = np.asarray(wavelengths, float)
+    coefficients = np.array([g.coefficients for g in glasses], float)
+    formulas = np.array([g.formula for g in glasses], int)
+    extra = (np.newaxis,) * (wavelengths.ndim - 1)
+    n2 = np.empty(wavelengths.shape)
+    n2.fill(np.nan)
+    for formula in np.unique(formulas):
+        if formula not in _formulas:
+            raise ValueError("Unknown dispersion formula %d" % formula)
+        rows = formulas == formula
+        c = coefficients[rows].T[(slice(None), slice(None)) + extra]
+        n2[rows] = _formulas[formula](c, wavelengths[rows] ** 2)
+    return np.sqrt(n2)
+
+
+def refractive_index(glasses, wavelengths, temperatures=None, pressure=1.0):
+    """Indices of the glasses, relative to air.
+
+    glasses : sequence of Glass
+    wavelengths : sequence of wavelengths
+    temperatures :
+        sequence of system temperatures.  If None, the indices are
+        given at the reference conditions of each glass (as when Zemax
+        does not adjust the index data to the environment).
+    pressure : system pressure, relative to 1 atmosphere
+
+    Returns an array of shape (glasses, wavelengths), or (glasses,
+    wavelengths, temperatures).
+    """
+    glasses = list(glasses)
+    wavelengths = np.asarray(wavelengths, float)
+    if temperatures is None:
+        return dispersion_index(
+            glasses, np.repeat(wavelengths[np.newaxis], len(glasses), 0))
+
+    temperatures = np.asarray(temperatures, float)
+    thermal = np.array([g.thermal for g in glasses], float).reshape(-1, 7)
+    d0, d1, d2, e0, e1, wtk, tref = [x[:, np.newaxis, np.newaxis]
+                                     for x in thermal.T]
+    air = air_index(wavelengths[:, np.newaxis], temperatures, pressure)
+    air_ref = air_index(wavelengths[:, np.newaxis], tref, 1.0)
+    # wavelengths in air at the reference conditions of the glasses
+    w = wavelengths[:, np.newaxis] * air / air_ref
+    n = dispersion_index(glasses, w)
+    dt = temperatures - tref
+    dn = (n**2 - 1) / (2 * n) * (d0 * dt + d1 * dt**2 + d2 * dt**3 +
+                                 (e0 * dt + e1 * dt**2) / (w**2 - wtk**2))
+    return (n * air_ref + dn) / air
+
+
+def abbe_number(glass):
+    """Abbe number from the dispersion formula (d, F and C lines)."""
+    nd, nf, nc = refractive_index([glass], [0.5875618, 0.4861327,
+                                            0.6562725])[0]
+    return (nd - 1) / (nf - nc)
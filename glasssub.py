@@ -0,0 +1,215 @@
+# Glass substitution.
+#
+# Candidate glasses for the selected surfaces are taken from catalogs
+# (see glasscat.py), within windows of index and Abbe number about the
+# present glass.  The candidates are ranked with a first-order proxy
+# computed on the client: the axial colour of the lens, from paraxial
+# marginal ray traces at the shortest and longest wavelengths.  The
+# best candidates are then evaluated on the server: each is substituted
+# into the nominal lens, which is re-optimised, and the merit function
+# is read.  The evaluations are made through a pool (see pool.py).
+
+from __future__ import print_function
+import os
+import tempfile
+import numpy as np
+from collections import namedtuple
+from glasscat import refractive_index
+from prescription import read_prescription
+from pool import LocalPool
+from zemaxclient import Untraceable
+
+
+Candidate = namedtuple("Candidate", ["surface", "glass", "proxy"])
+# surface : number of the surface whose glass is replaced
+# glass : name of the substituted glass
+# proxy : absolute axial colour of the lens with the glass substituted
+
+Substitution = namedtuple("Substitution", [
+    "surface", "glass", "proxy", "merit"])
+# merit :
+#     merit function of the lens after re-optimisation (inf if the lens
+#     cannot be traced)
+
+
+def _media(prescription, glasses, wavelengths):
+    """Indices of the media following each surface, of shape (surfaces,
+    wavelengths).  Mirrors reverse the sign of the index."""
+    names = sorted(set(s.glass.upper() for s in prescription.surfaces
+                       if s.glass and s.glass.upper() != "MIRROR"))
+    missing = [name for name in names if name not in glasses]
+    if missing:
+        raise KeyError("Glasses not in the catalogs: %s" %
+                       ", ".join(missing))
+    indices = dict(zip(names, refractive_index(
+        [glasses[name] for name in names], wavelengths)))
+    media = np.empty((len(prescription.surfaces), len(wavelengths)))
+    n = np.ones(len(wavelengths))
+    for i, surface in enumerate(prescription.surfaces):
+        glass = surface.glass.upper()
+        sign = np.sign(n)
+        if glass == "MIRROR":
+            n = -n
+        elif glass:
+            n = sign * indices[glass]
+        else:
+            n = sign
+        media[i] = n
+    return media
+
+
+def axial_colour(prescription, media):
+    """Paraxial axial colour of a lens.
+
+    media :
+        indices following each surface, of shape (..., surfaces,
+        wavelengths), where the leading dimensions index variants of
+        the lens (see _media)
+
+    Returns the distances from the last surface before the image to
+    the paraxial foci of each wavelength, of shape (..., wavelengths).
+    Only the curvatures and thicknesses of the surfaces are used, so
+    tilted and decentred surfaces are not modelled.
+    """
+    media = np.asarray(media, float)
+    surfaces = prescription.surfaces
+    shape = media.shape[:-2] + media.shape[-1:]
+    # marginal ray from an axial object point (at infinity if the object
+    # thickness is of the order of the server's infinity)
+    t0 = surfaces[0].thickness
+    if abs(t0) >= 1e9:
+        y = np.ones(shape)
+        nu = np.zeros(shape)
+    else:
+        y = np.ones(shape)
+        nu = media[..., 0, :] * np.ones(shape) / t0
+    for i in range(1, len(surfaces) - 1):
+        n_before = media[..., i - 1, :]
+        n_after = media[..., i, :]
+        nu = nu - y * surfaces[i].curvature * (n_after - n_before)
+        if i < len(surfaces) - 2:
+            y = y + nu / n_after * surfaces[i].thickness
+    n_last = media[..., len(surfaces) - 2, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -y * n_last / nu
+
+
+def _colour_range(prescription, wavelengths):
+    if wavelengths is None:
+        waves = [w.wavelength for w in prescription.wavelengths]
+        wavelengths = [min(waves), max(waves)]
+    return np.asarray(wavelengths, float)
+
+
+def rank_candidates(prescription, glasses, surfaces, nd_window=0.1,
+                    vd_window=10.0, statuses=(0, 1), wavelengths=None):
+    """Rank the substitutions of catalog glasses on the surfaces.
+
+    glasses :
+        dict of Glass keyed by name (see glasscat.load_catalogs),
+        which must hold the glasses of the lens
+    surfaces :
+        numbers of the surfaces whose glasses may be replaced
+    nd_window, vd_window :
+        candidates differ from the present glass by at most these
+        amounts in index and Abbe number
+    statuses :
+        catalog statuses of the candidates (standard and preferred by
+        default)
+    wavelengths :
+        wavelengths between which the axial colour is computed.  By
+        default the shortest and longest of the lens.
+
+    Returns a list of Candidate, in order of increasing proxy.
+    """
+    wavelengths = _colour_range(prescription, wavelengths)
+    media = _media(prescription, glasses, wavelengths)
+    candidates = []
+    for surface in surfaces:
+        present = glasses[prescription.surfaces[surface].glass.upper()]
+        names = sorted(
+            name for (name, g) in glasses.items()
+            if name != present.name and g.status in statuses and
+            abs(g.nd - present.nd) <= nd_window and
+            abs(g.vd - present.vd) <= vd_window)
+        if not names:
+            continue
+        # trace a variant of the lens for each candidate
+        variants = np.repeat(media[np.newaxis], len(names), 0)
+        indices = refractive_index([glasses[name] for name in names],
+                                   wavelengths)
+        variants[:, surface] = np.sign(media[surface]) * indices
+        foci = axial_colour(prescription, variants)
+        proxies = np.abs(foci[:, -1] - foci[:, 0])
+        candidates.extend(Candidate(surface, name, proxy)
+                          for (name, proxy) in zip(names, proxies))
+    candidates.sort(key=lambda c: (np.nan_to_num(c.proxy), c.surface,
+                                   c.glass))
+    return candidates
+
+
+class _Evaluation(object):
+    """Substitutes a glass in the nominal lens, saved at `path`, and
+    re-optimises."""
+    def __init__(self, path, cycles):
+        self.path = path
+        self.cycles = cycles
+
+    def __call__(self, conn, candidate):
+        conn.LoadFile(self.path, untraceable_allowed=True)
+        conn.SetSurfaceData(candidate.surface, 4, candidate.glass)
+        try:
+            merit = conn.Optimize(self.cycles)
+        except Untraceable:
+            merit = np.inf
+        return Substitution(candidate.surface, candidate.glass,
+                            candidate.proxy, merit)
+
+
+def substitute_glasses(conn, glasses, surfaces, top_k=10, pool=None,
+                       cycles=0, progress=None, **kwargs):
+    """Search for glass substitutions which improve the lens.
+
+    The candidates are ranked (see rank_candidates, which takes the
+    remaining keyword arguments), and the best `top_k` are evaluated
+    by re-optimising the lens with the substituted glass.
+
+    pool :
+        Pool on which the candidates are evaluated, by default a
+        LocalPool of `conn`.  Each evaluation loads, changes and
+        optimises the lens of its server, so the workers of a
+        ConnectionPool must not share a server (see pool.py).  As the
+        nominal lens is loaded from a file, the workers need no setup.
+    cycles :
+        optimisation cycles (see Connection.Optimize; 0 is automatic)
+    progress :
+        function called as progress(substitution, best) as each
+        evaluation is completed, where best is the best Substitution so
+        far
+
+    Returns the list of Substitution, in order of increasing merit.
+    The nominal lens is restored on `conn`.
+    """
+    prescription = read_prescription(conn, solves=False, objects=False)
+    candidates = rank_candidates(prescription, glasses, surfaces,
+                                 **kwargs)[:top_k]
+    if pool is None:
+        pool = LocalPool(conn)
+
+    # Zemax will not open a file created with
+    # tempfile.NamedTemporaryFile()
+    (fd, path) = tempfile.mkstemp(".ZMX")
+    os.close(fd)
+    results = []
+    try:
+        conn.SaveFile(path, untraceable_allowed=True)
+        evaluate = _Evaluation(path, cycles)
+        for index, result in pool.as_completed(evaluate, candidates):
+            results.append(result)
+            if progress is not None:
+                progress(result, min(results, key=lambda r: r.merit))
+        conn.LoadFile(path, untraceable_allowed=True)
+    finally:
+        os.remove(path)
+    results.sort(key=lambda r: r.merit)
+    return results
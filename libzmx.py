@@ -8,9 +8,8 @@ from __future__ import print_function
 import random
 import re
 import numpy as np
-from itertools import count
 from collections import namedtuple
-from functools import partial
+import solves
 
 
 surface_types = dict()
@@ -40,10 +39,11 @@ class SurfaceSequence:
 
     def __init__(self, conn, empty=False, copy_from_editor=False):
         self.conn = conn
+        self._frames = None
+        self._labels = None
         if empty:
             # self.conn.NewLens()
-            for i in range(1, self.__len__()-1):
-                del self[i]
+            self.clear()
         if copy_from_editor:
             self.conn.GetRefresh()
         self._enforce_id_uniqueness()
@@ -60,7 +60,13 @@ class SurfaceSequence:
             id = 0
         return id
 
+    def _surface_range(self, index):
+        """Surface numbers of a slice, as for a Python list"""
+        return range(*index.indices(len(self)))
+
     def __getitem__(self, surfno):
+        if isinstance(surfno, slice):
+            return self._get_many(self._surface_range(surfno))
         surfno = self._translate_id(surfno)
         id = self.conn.GetLabel(surfno)
         if not id:
@@ -72,12 +78,42 @@ class SurfaceSequence:
         surf = surface_factory(self.conn, id)
         return surf
 
+    def _get_many(self, numbers):
+        numbers = list(numbers)
+        labels = list(self.labels())
+        types = self.conn.req_batch(["GetSurfaceData,%d,0" % n
+                                     for n in numbers])
+        unlabelled = [n for n in numbers if not labels[n]]
+        for n in unlabelled:
+            labels[n] = random.randint(1, self.max_surf_id)
+        self._set_labels(unlabelled, labels)
+        return [surface_types.get(_type, UnknownSurface)(self.conn,
+                                                         labels[n])
+                for (n, _type) in zip(numbers, types)]
+
     def __delitem__(self, surfno):
+        if isinstance(surfno, slice):
+            self._replace(self._surface_range(surfno), [])
+            return
         surfno = self._translate_id(surfno)
         if surfno < 1:
             raise IndexError("Cannot delete this surface")
         self.conn.DeleteSurface(surfno)
 
+    def __setitem__(self, index, specs):
+        """Replace a slice of the surfaces with new surfaces (see
+        insert_many)."""
+        if not isinstance(index, slice):
+            raise TypeError("Surfaces can only be assigned to slices")
+        if index.step not in (None, 1):
+            raise ValueError("Surfaces can only be assigned to contiguous "
+                             "slices")
+        numbers = self._surface_range(index)
+        start = numbers[0] if len(numbers) else index.indices(len(self))[0]
+        if start < 1:
+            raise IndexError("Cannot insert before first surface")
+        self._replace(numbers, specs, start)
+
     def __iter__(self):
         for i in range(len(self)):
             yield self[i]
@@ -101,16 +137,151 @@ class SurfaceSequence:
     def append_new(self, factory, *args, **kwargs):
         return self.insert_new(-1, factory, *args, **kwargs)
 
+    def insert_many(self, surfno, specs):
+        """Create and insert a block of new surfaces before the
+        specified numbered surface (see insert_new).
+
+        specs :
+            sequence of surface factories (eg. surface.Standard), or of
+            (factory, kwargs), where kwargs is a dict of the arguments of
+            factory.create
+
+        The surfaces are inserted, labelled and initialised, with any
+        pickup solves, in a single batch of requests.  Pickups may refer
+        to surfaces of the sequence or to new surfaces.  Returns the
+        list of new surfaces.
+        """
+        surfno = self._translate_id(surfno)
+        if surfno < 1:
+            raise IndexError("Cannot insert before first surface")
+        return self._replace([], specs, surfno)
+
+    def clear(self):
+        """Delete all the surfaces between the object and the image."""
+        del self[1:-1]
+
+    def _replace(self, numbers, specs, surfno=None):
+        """Delete the numbered surfaces and insert new surfaces from
+        specs before surface `surfno` (numbered after the deletion),
+        with a single batch of requests."""
+        numbers = sorted(numbers, reverse=True)
+        numsurfs = len(self)
+        if numbers and (numbers[-1] < 1 or numbers[0] >= numsurfs - 1):
+            raise IndexError("Cannot delete the object or image surface")
+        labels = self._current_labels()
+        if labels is None and any(isinstance(value, PickupExpression)
+                                  for spec in specs
+                                  if isinstance(spec, tuple)
+                                  for value in spec[1].values()):
+            # pickups are resolved with the labels
+            labels = list(self.labels())
+        requests = ["DeleteSurface,%d" % n for n in numbers]
+        surfaces = []
+        pickups = []
+        if specs:
+            surfno -= len([n for n in numbers if n < surfno])
+            # as InsertSurface, insert before the image surface at most
+            surfno = min(surfno, numsurfs - len(numbers) - 1)
+        for i, spec in enumerate(specs):
+            factory, kwargs = spec if isinstance(spec, tuple) else (spec, {})
+            # a surface type must be defined (see BaseSurface.create)
+            assert(factory.surface_type is not None)
+            n = surfno + i
+            surf = factory(self.conn, random.randint(1, self.max_surf_id))
+            requests.append("InsertSurface,%d" % n)
+            requests.append("SetLabel,%d,%d" % (n, surf.id))
+            requests.append(surf.type.set_request(n, surf.surface_type))
+            for key, value in kwargs.items():
+                try:
+                    p = getattr(surf, key)
+                except Exception:
+                    raise KeyError(key)
+                if isinstance(value, PickupExpression):
+                    pickups.append((p, n, value))
+                    continue
+                if p._type is bool:
+                    value = int(value)
+                # new surfaces have fixed solves
+                requests.append(p.set_request(n, value))
+            surfaces.append(surf)
+
+        if labels is not None:
+            for n in numbers:
+                del labels[n]
+            if surfaces:
+                labels[surfno:surfno] = [surf.id for surf in surfaces]
+        # pickups are set once the surfaces have their final numbers
+        for p, n, value in pickups:
+            source = labels.index(value.surface.id)
+            requests.append(p.pickup_request(n, value, source))
+
+        responses = self.conn.req_batch(requests)
+        for rs, response in zip(requests, responses):
+            if rs.startswith("SetLabel"):
+                label = int(rs.split(",")[2])
+                if int(response) != label:
+                    raise ValueError("Label value (%d) not stored" % label)
+        if labels is not None:
+            self._labels = (self.conn.revision, labels)
+        return surfaces
+
+    def _current_labels(self):
+        """A copy of the cached labels, if they are current."""
+        if self._labels is not None and self._labels[0] == self.conn.revision:
+            return list(self._labels[1])
+        return None
+
+    def _set_labels(self, numbers, labels):
+        """Set the labels of the numbered surfaces, in a batch, and
+        cache the labels of all the surfaces."""
+        self.conn.req_batch(["SetLabel,%d,%d" % (n, labels[n])
+                             for n in numbers])
+        self._labels = (self.conn.revision, list(labels))
+
+    def labels(self):
+        """Return the labels of all surfaces.
+
+        The labels are read with a single batch of requests, and cached
+        until the next request which may modify the lens, except for
+        the bulk operations of the sequence, which update the cache.  Do
+        not modify the returned list.
+        """
+        if self._current_labels() is None:
+            requests = ["GetLabel,%d" % n for n in range(len(self))]
+            labels = [int(r) for r in self.conn.req_batch(requests)]
+            self._labels = (self.conn.revision, labels)
+        return self._labels[1]
+
+    def global_frames(self):
+        """Return the global coordinate frames of all surfaces.
+
+        Returns an array of shape (N, 4, 4), where N is the number of
+        surfaces.  Each element is the homogeneous transformation from
+        the local coordinates of the surface to global coordinates
+        (see transform_rays).
+
+        The frames are cached until the next request which may modify
+        the lens, so do not modify the returned array.
+        """
+        revision = self.conn.revision
+        if self._frames is None or self._frames[0] != revision:
+            frames = self.conn.GetGlobalMatrices(range(len(self)))
+            self._frames = (self.conn.revision, frames)
+        return self._frames[1]
+
     def _enforce_id_uniqueness(self):
         # File "ZEMAX\Samples\Short course\sc_cooke1.zmx" has
         # duplicate ids.
+        labels = list(self.labels())
         ids = set()
-        for i in range(len(self)):
-            id = self.conn.GetLabel(i)
+        duplicates = []
+        for i, id in enumerate(labels):
             if id in ids:
-                id = random.randint(1, self.max_surf_id)
-                self.conn.SetLabel(i, id)
-            ids.add(id)
+                labels[i] = random.randint(1, self.max_surf_id)
+                duplicates.append(i)
+            ids.add(labels[i])
+        if duplicates:
+            self._set_labels(duplicates, labels)
 
 
 class NamedElements(object):
@@ -250,7 +421,8 @@ class PickupFormat(object):
         self.has_offset = has_offset
         self.has_col_ref = has_col_ref
 
-    def set_pickup(self, surfp, pickup_expr):
+    def modifiers(self, surfp, pickup_expr):
+        """Arguments of SetSolve following the source surface."""
         modifiers = []
         if self.has_scale:
             modifiers.append(pickup_expr.scale)
@@ -275,7 +447,10 @@ class PickupFormat(object):
         elif not surfp.column == col:
             raise TypeError("Pickup solves on this parameter cannot "
                             "dereference other columns")
+        return modifiers
 
+    def set_pickup(self, surfp, pickup_expr):
+        modifiers = self.modifiers(surfp, pickup_expr)
         surfp.surface.conn.SetSolve(surfp.surface.get_surf_num(),
                                     surfp.solve_code, self.solve_code,
                                     pickup_expr.surface.get_surf_num(),
@@ -339,13 +514,35 @@ class Parameter(object):
 
     def get_value(self):
         _ = self.surface.get_surf_num()
-        value = self._client_get_value()
+        return self.parse_value(self._client_get_value())
+
+    def parse_value(self, value):
+        """Convert a response string to the parameter type."""
         if self._type in (bool, int):
             # value can be (eg.) "0.0000E+000"
             value = float(value)
 
         return self._type(value)
 
+    # The request builders take the surface number, so that the
+    # number can be resolved once for a batch of requests.  Setting a
+    # value with a request does not fix the parameter's solve.
+
+    def get_request(self, n):
+        return "GetSurfaceData,%d,%d" % (n, self.column)
+
+    def set_request(self, n, value):
+        return self.surface.conn.build_req("SetSurfaceData", n, self.column,
+                                           value)
+
+    def pickup_request(self, n, pickup_expr, source):
+        """Request setting a pickup solve, where `source` is the number
+        of the surface of the picked up parameter."""
+        conf = self.pickup_conf
+        return self.surface.conn.build_req(
+            "SetSolve", n, self.solve_code, conf.solve_code, source,
+            *conf.modifiers(self, pickup_expr))
+
     def __repr__(self):
         return repr(self.get_value())
 
@@ -401,6 +598,13 @@ class AuxParameter(Parameter):
         s = self.surface
         s.conn.SetSurfaceParameter(s.get_surf_num(), self.column, value)
 
+    def get_request(self, n):
+        return "GetSurfaceParameter,%d,%d" % (n, self.column)
+
+    def set_request(self, n, value):
+        return self.surface.conn.build_req("SetSurfaceParameter", n,
+                                           self.column, value)
+
     def align_to_chief_ray(self, field_id=1, wavelength_id=0):
         n = self.surface.get_surf_num()
         self.surface.conn.SetSolve(n, self.solve_code, 3, field_id,
@@ -420,6 +624,12 @@ class ExtraParameter(Parameter):
         s = self.surface
         s.conn.SetExtra(s.get_surf_num(), self.column, value)
 
+    def get_request(self, n):
+        return "GetExtra,%d,%d" % (n, self.column)
+
+    def set_request(self, n, value):
+        return self.surface.conn.build_req("SetExtra", n, self.column, value)
+
 
 class CurvatureParameter(Parameter):
     def __init__(self, surface):
@@ -500,6 +710,13 @@ class CommentParameter(Parameter):
             raise ValueError(("Comment field cannot be saved", n, value))
         Parameter._client_set_value(self, value)
 
+    def set_request(self, n, comment):
+        # any tag in the comment of the surface is replaced
+        if len(comment) > self.max_len:
+            raise ValueError(("Comment field cannot be saved", len(comment),
+                              comment))
+        return Parameter.set_request(self, n, comment)
+
     def set_value(self, comment):
         old_comment, tag = self.get_comment_and_tag()
         self.set_comment_and_tag(comment, tag)
@@ -567,6 +784,45 @@ RayNode = namedtuple("RayNode", ["status", "vigcode", "intersect",
                                  "exit_cosines", "normal", "intensity"])
 
 
+def transform_rays(frames, intersect=None, cosines=None, normal=None,
+                   inverse=False):
+    """Transform ray vectors between local and global coordinates.
+
+    frames :
+        Homogeneous transformations from local to global coordinates,
+        with shape (..., 4, 4) (eg. from SurfaceSequence.global_frames)
+    intersect :
+        Ray intersections, with shape (..., 3)
+    cosines :
+        Ray direction cosines, with shape (..., 3)
+    normal :
+        Surface normals, with shape (..., 3)
+    inverse :
+        Transform from global to local coordinates?
+
+    The leading dimensions of the frames and vectors are broadcast
+    against each other, so a single frame can transform a whole ray
+    bundle.  Returns the tuple (intersect, cosines, normal), with None
+    in place of any vectors which were not given.
+    """
+    frames = np.asarray(frames, float)
+    rotation = frames[..., :3, :3]
+    offset = frames[..., :3, 3]
+    if inverse:
+        rotation = np.swapaxes(rotation, -1, -2)
+        offset = -np.einsum("...ij,...j->...i", rotation, offset)
+
+    def rotate(v):
+        if v is None:
+            return None
+        return np.einsum("...ij,...j->...i", rotation, np.asarray(v, float))
+
+    intersect = rotate(intersect)
+    if intersect is not None:
+        intersect = intersect + offset
+    return intersect, rotate(cosines), rotate(normal)
+
+
 class UnknownSurface(BaseSurface):
     comment = Property(CommentParameter)
     thickness = Property(ThicknessParameter)   # NSC doesn't have this
@@ -596,13 +852,12 @@ class UnknownSurface(BaseSurface):
             raise Exception("GetTrace failed:", ray.status, ray)
         if _global:
             # convert vectors to global reference frame
-            rotation, offset = self.conn.GetGlobalMatrix(n)
-            ray = ray._replace(
-                intersect=np.array(
-                    ray.intersect*rotation.T + offset).flatten(),
-                exit_cosines=np.array(ray.exit_cosines*rotation.T).flatten(),
-                normal=np.array(ray.normal*rotation.T).flatten()
-                )
+            frame = self.conn.GetGlobalMatrices([n])[0]
+            intersect, exit_cosines, normal = transform_rays(
+                frame, ray.intersect, ray.exit_cosines, ray.normal)
+            ray = ray._replace(intersect=intersect,
+                               exit_cosines=exit_cosines,
+                               normal=normal)
         return ray
 
     def trace_from_surface(self, surf, origin, cosines):
@@ -612,16 +867,17 @@ class UnknownSurface(BaseSurface):
         """Fix all variables and parameters that were adjustable under
         optimisation."""
         n = self.get_surf_num()
-        # Scan the surface parameters checking for adjustable variables
-        fixed = []
-        for i in range(17):
-            # codes are 0-16
-            vals = self.conn.GetSolve(n, i)
-            # check if adjustable
-            if int(vals[0]) == 1:
-                # fix parameter
-                self.conn.SetSolve(n, i, 0)
-                fixed.append(i)
+        # Scan the surface parameters checking for adjustable variables,
+        # with one batch of requests to read and one to fix them
+        responses = self.conn.req_batch(["GetSolve,%d,%d" % (n, code)
+                                         for code in solves.codes])
+        fixed = [code for (code, response) in zip(solves.codes, responses)
+                 if solves.can_vary(code) and
+                 solves.parse_solve(code, response)["type"] ==
+                 solves.variable_type]
+        self.conn.req_batch([self.conn.build_req("SetSolve", n, code,
+                                                 solves.fix_types[code])
+                             for code in fixed])
         return fixed
 
     def get_global_ref_status(self):
@@ -684,21 +940,91 @@ class CoordinateBreak(UnknownSurface):
             self.conn.SetSurfaceData(self.get_surf_num(), 80, code)
 
 
+def coordinate_return_specs(seq, first_return_surf, last_return_surf,
+                            include_null_transforms=True):
+    """Plan the coordinate breaks undoing the transformations of a range
+    of surfaces (see return_to_coordinate_frame).
+
+    The surfaces are read with a few batches of requests.  Returns the
+    specs of the coordinate breaks, in order, for
+    SurfaceSequence.insert_many.
+    """
+    assert (first_return_surf < last_return_surf)
+    numbers = range(first_return_surf, last_return_surf + 1)
+    surfaces = seq[first_return_surf:last_return_surf + 1]
+    requests = []
+    for n in numbers:
+        requests.append("GetSurfaceData,%d,1" % n)
+        requests.append("GetSurfaceData,%d,3" % n)
+        requests.extend("GetSurfaceParameter,%d,%d" % (n, i)
+                        for i in range(1, 7))
+    responses = seq.conn.req_batch(requests)
+
+    specs = []
+    for i in reversed(range(len(numbers))):
+        n = numbers[i]
+        to_undo = surfaces[i]
+        values = responses[8*i:8*i+8]
+        comment = (CommentParameter.tag_patt.match(values[0]).group(1) or
+                   str(n))
+        thickness = float(values[1])
+        transformations = [float(x) for x in values[2:7]]
+        if isinstance(to_undo, CoordinateBreak):
+            # undo thickness first
+            if not thickness == 0 or include_null_transforms:
+                specs.append((CoordinateBreak, {
+                    "thickness": -to_undo.thickness.linked(),
+                    "comment": "UNDO thickness " + comment}))
+            if any(transformations) or include_null_transforms:
+                specs.append((CoordinateBreak, {
+                    "offset_x": -to_undo.offset_x.linked(),
+                    "offset_y": -to_undo.offset_y.linked(),
+                    "rotate_x": -to_undo.rotate_x.linked(),
+                    "rotate_y": -to_undo.rotate_y.linked(),
+                    "rotate_z": -to_undo.rotate_z.linked(),
+                    "rotate_before_offset": not float(values[7]),
+                    "comment": "UNDO " + comment}))
+        elif not thickness == 0 or include_null_transforms:
+            # simple surface, only requires undo of thickness
+            specs.append((CoordinateBreak, {
+                "rotate_before_offset": False,
+                "thickness": -to_undo.thickness.linked(),
+                "comment": "UNDO " + comment}))
+    return specs
+
+
 def return_to_coordinate_frame(seq, first_return_surf,
                                last_return_surf, insert_point=None,
                                include_null_transforms=True,
                                factory=None):
+    """Insert coordinate breaks returning to the coordinate frame of
+    the surface first_return_surf, from that following last_return_surf.
+
+    The inserted surfaces pick up the transformations of the surfaces
+    they undo.  They are inserted after insert_point (by default
+    last_return_surf), or created by calling `factory`, if given.
+    Returns the number of the last inserted surface, or insert_point
+    when there is nothing to undo.
+
+    Without a factory, the range is read and the surfaces are inserted
+    with a few batches of requests (see coordinate_return_specs).
+    """
+    if insert_point is None:
+        insert_point = last_return_surf
+    if not factory:
+        specs = coordinate_return_specs(seq, first_return_surf,
+                                        last_return_surf,
+                                        include_null_transforms)
+        if not specs:
+            return insert_point
+        inserted = seq.insert_many(insert_point + 1, specs)
+        return seq.labels().index(inserted[-1].id)
+
     assert (first_return_surf < last_return_surf)
     nsteps = last_return_surf - first_return_surf + 1
     surfaces_to_undo = range(last_return_surf, last_return_surf-nsteps, -1)
 
-    if not factory:
-        if insert_point is None:
-            insert_point = last_return_surf
-
-        insertion_point_sequence = count(insert_point+1)
-        factory = partial(seq.insert_new,
-                          next(insertion_point_sequence), CoordinateBreak)
+    inserted = None
 
     for sn1 in surfaces_to_undo:
         to_undo = seq[sn1]
@@ -737,6 +1063,8 @@ def return_to_coordinate_frame(seq, first_return_surf,
             inserted.comment.value = "UNDO " + (
                 to_undo.comment.value or str(to_undo.get_surf_num()))
 
+    if inserted is None:
+        return insert_point
     return inserted.get_surf_num()
 
 
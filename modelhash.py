@@ -0,0 +1,198 @@
+# Content hashes of lens prescriptions.
+#
+# A ModelHash identifies the exact state of a lens (see
+# prescription.Prescription), for keys of caches of analyses and to
+# detect changes, without saving and comparing lens files.  Values are
+# encoded canonically (floats with 17 significant digits, dicts in key
+# order), so equal prescriptions have equal hashes whichever way they
+# were built.
+#
+# Each surface, with its solves and non-sequential objects, is hashed
+# separately, and the surface hashes are combined in a binary (Merkle)
+# tree.  When only some surfaces change, updating the hash costs a
+# surface hash and a path of the tree for each, rather than hashing the
+# whole prescription.
+
+import hashlib
+from numbers import Integral
+from prescription import (Prescription, read_prescription,
+                          read_system_prescription, read_surfaces,
+                          read_solves, read_nsc_objects, nsc_surfaces)
+
+
+def _encode(value, out):
+    """Append a canonical encoding of value to the list out."""
+    if isinstance(value, bool):
+        out.append("b%d" % value)
+    elif isinstance(value, float):
+        # -0.0 and 0.0 are the same lens
+        out.append("f%.17G" % (value + 0.0))
+    elif isinstance(value, Integral):
+        out.append("i%d" % value)
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        out.append("s%d:" % len(value))
+        out.append(value)
+    elif isinstance(value, dict):
+        out.append("d%d(" % len(value))
+        for key in sorted(value):
+            _encode(key, out)
+            _encode(value[key], out)
+        out.append(")")
+    elif value is None:
+        out.append("n")
+    else:
+        # tuples, lists and records (namedtuples) are sequences of
+        # their values
+        out.append("t%d(" % len(value))
+        for item in value:
+            _encode(item, out)
+        out.append(")")
+
+
+def _digest(*values):
+    out = []
+    _encode(values, out)
+    return hashlib.sha256(b"".join(
+        x if isinstance(x, bytes) else x.encode("ascii")
+        for x in out)).digest()
+
+
+def _combine(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+class ModelHash(object):
+    """Hash of a Prescription, which is updated incrementally.
+
+    The hash covers the surfaces and their solves and non-sequential
+    objects, the system data, fields, wavelengths and multi-
+    configuration operands.
+    """
+    def __init__(self, prescription):
+        self._leaf_data = []
+        self._tree = [[]]
+        self.update(prescription)
+
+    def _surface_data(self, prescription, n):
+        solves = prescription.solves
+        return (prescription.surfaces[n],
+                None if solves is None else solves[n],
+                tuple(prescription.objects.get(n, ())))
+
+    def update(self, prescription, surfs=None):
+        """Update the hash to a changed prescription.
+
+        surfs :
+            numbers of the surfaces which may have changed.  By default,
+            the data of every surface are compared with the data last
+            hashed, which avoids hashing the surfaces which are
+            unchanged.
+        """
+        self.prescription = prescription
+        self._header = _digest(
+            prescription.system, prescription.field_type,
+            prescription.fields, prescription.primary_wave,
+            prescription.wavelengths, prescription.current_config,
+            prescription.configs)
+
+        num_surfs = len(prescription.surfaces)
+        if num_surfs != len(self._leaf_data):
+            # the tree is rebuilt when surfaces are inserted or deleted
+            self._leaf_data = [self._surface_data(prescription, n)
+                               for n in range(num_surfs)]
+            self._build([_digest(n, *data) for (n, data) in
+                         enumerate(self._leaf_data)])
+            return self.digest
+        if surfs is None:
+            surfs = range(num_surfs)
+        for n in surfs:
+            data = self._surface_data(prescription, n)
+            if data != self._leaf_data[n]:
+                self._leaf_data[n] = data
+                self._set_leaf(n, _digest(n, *data))
+        return self.digest
+
+    def _build(self, leaves):
+        tree = [leaves]
+        while len(tree[-1]) > 1:
+            level = tree[-1]
+            tree.append([_combine(*level[i:i+2]) if i + 1 < len(level)
+                         else level[i] for i in range(0, len(level), 2)])
+        self._tree = tree
+
+    def _set_leaf(self, i, digest):
+        tree = self._tree
+        tree[0][i] = digest
+        for depth in range(1, len(tree)):
+            i //= 2
+            below = tree[depth - 1]
+            if 2 * i + 1 < len(below):
+                tree[depth][i] = _combine(below[2 * i], below[2 * i + 1])
+            else:
+                tree[depth][i] = below[2 * i]
+
+    @property
+    def surfaces_digest(self):
+        """Root of the tree of surface hashes."""
+        top = self._tree[-1]
+        return top[0] if top else _digest()
+
+    def surface_digest(self, n):
+        return self._tree[0][n]
+
+    @property
+    def digest(self):
+        return _combine(self._header, self.surfaces_digest)
+
+    @property
+    def hexdigest(self):
+        return "".join("%02x" % c for c in bytearray(self.digest))
+
+    def refresh(self, conn, surfs=None, extra=False):
+        """Update the hash from the lens in the server memory.
+
+        surfs :
+            numbers of the surfaces which may have changed.  Only these
+            surfaces are read (with their solves and, for non-sequential
+            components, objects), together with the system data, which
+            costs a few requests.  By default the whole prescription is
+            read.
+        extra :
+            read the extra data of the surfaces (see read_prescription),
+            which costs a request for each column of each surface.  It
+            should be the same as for the prescription last hashed.
+        """
+        if surfs is None:
+            return self.update(read_prescription(conn, extra=extra))
+        surfs = sorted(set(surfs))
+        numsurfs, p = read_system_prescription(conn)
+        if numsurfs + 1 != len(self._leaf_data):
+            return self.update(read_prescription(conn, extra=extra))
+        # the surfaces which are not read are kept
+        old = self.prescription
+        p.surfaces = list(old.surfaces)
+        num_extra = Prescription.num_extra if extra else 0
+        surfaces = read_surfaces(conn, surfs, num_extra=num_extra)
+        for n, surface in zip(surfs, surfaces):
+            p.surfaces[n] = surface
+        if old.solves is not None:
+            p.solves = list(old.solves)
+            for n, solves in zip(surfs, read_solves(conn, surfs)):
+                p.solves[n] = solves
+        p.objects = dict((n, objects) for (n, objects) in old.objects.items()
+                         if n not in surfs)
+        nsc = nsc_surfaces(p.surfaces)
+        p.objects.update(read_nsc_objects(conn, [n for n in surfs
+                                                 if n in nsc]))
+        return self.update(p, surfs)
+
+
+def model_hash(conn, extra=False):
+    """Return the hexadecimal hash of the lens in the server memory.
+
+    The extra data of the surfaces are only hashed if `extra` is true
+    (see read_prescription).
+    """
+    return ModelHash(read_prescription(conn, extra=extra)).hexdigest
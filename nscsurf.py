@@ -1,6 +1,13 @@
+import os
 import re
+import tempfile
 import numpy as np
+from collections import namedtuple
+from itertools import count
 from libzmx import UnknownSurface, Property, AuxParameter
+from zemaxclient import ZemaxServerError, parse_nsc_position
+from pool import LocalPool
+from prescription import ObjectSpec
 
 # It's hard to handle Nonsequential object references as gracefully as
 # sequential surface references because there is no Set/Get/FindLabel
@@ -192,29 +199,529 @@ class NonSequentialComponent(UnknownSurface):
             self.set_obj_comment(slot, comment)
         return slot
 
+    def read_objects(self, slots=None, params=()):
+        """Read the object table with a single batch of requests.
+
+        Returns a list of ObjectSpec.  Only the numbered parameters in
+        `params` are read.
+        """
+        n = self.get_surf_num()
+        if slots is None:
+            slots = range(1, len(self) + 1)
+        slots = list(slots)
+        return read_objects(self.conn, n, slots, [params] * len(slots))
+
+    def snapshot(self, num_params=12):
+        """Read the whole object table.
+
+        Returns (objects, frames), where objects is a structured array
+        (see object_table_dtype) holding parameters 1 to `num_params` of
+        each object and frames is an array of shape (N, 4, 4) holding
+        the object matrices (see Connection.GetNSCMatrices).
+        """
+        n = self.get_surf_num()
+        slots = range(1, len(self) + 1)
+        params = range(1, num_params + 1)
+        specs = read_objects(self.conn, n, slots, [params] * len(slots))
+        frames = self.conn.GetNSCMatrices(n, slots)
+
+        objects = np.zeros(len(specs), object_table_dtype(num_params))
+        for obj, spec in zip(objects, specs):
+            obj["type"] = spec.type
+            obj["comment"] = spec.comment
+            obj["ref"] = spec.ref
+            for name, value in zip(_position_fields, spec.position):
+                obj[name] = value
+            obj["material"] = spec.material
+            obj["parameters"] = [spec.parameters[p] for p in params]
+            obj["ignore"] = spec.ignore
+        return objects, frames
+
+    def insert_objects(self, slot, specs):
+        """Insert objects before `slot`, with a single batch of requests.
+
+        `specs` is a sequence of ObjectSpec (or of dicts or records with
+        the same fields).  Returns the slots of the new objects.
+        """
+        n = self.get_surf_num()
+        specs = [object_spec(spec) for spec in specs]
+        requests = [self.conn.build_req("InsertObject", n, slot)] * len(specs)
+        for i, spec in enumerate(specs):
+            requests.extend(object_requests(self.conn, n, slot + i, spec))
+        self.conn.req_batch(requests)
+        return list(range(slot, slot + len(specs)))
+
+    def set_objects(self, specs):
+        """Make the object table match `specs`.
+
+        The existing table is read and only the data which differ are
+        set, so that updating a large model is cheap.  To lengthen the
+        table, objects are inserted before the last object (which keeps
+        its place at the end); to shorten it, the trailing objects are
+        deleted.  Returns the number of requests which changed the
+        table.
+        """
+        n = self.get_surf_num()
+        specs = [object_spec(spec) for spec in specs]
+        if not specs:
+            raise ValueError("A component holds at least one object")
+        new_len = len(specs)
+        old_len = len(self)
+
+        # slots of the old objects which keep their place, and the
+        # specifications they are compared with
+        if old_len == 0:
+            kept = []
+        elif new_len > old_len:
+            kept = list(zip(range(1, old_len), specs[:old_len-1]))
+            kept.append((old_len, specs[-1]))
+        else:
+            kept = list(zip(range(1, new_len + 1), specs))
+        old = read_objects(self.conn, n, [slot for (slot, spec) in kept],
+                           [sorted(spec.parameters) for (slot, spec) in kept])
+
+        build_req = self.conn.build_req
+        requests = []
+        if new_len > old_len:
+            slot = max(old_len, 1)
+            requests.extend([build_req("InsertObject", n, slot)] *
+                            (new_len - old_len))
+            previous = [None] * new_len
+            if old:
+                previous[:len(old)-1] = old[:-1]
+                previous[-1] = old[-1]
+        else:
+            requests.extend([build_req("DeleteObject", n, new_len + 1)] *
+                            (old_len - new_len))
+            previous = old
+        for i, spec in enumerate(specs):
+            requests.extend(object_requests(self.conn, n, i + 1, spec,
+                                            previous[i]))
+        self.conn.req_batch(requests)
+        return len(requests)
+
+
+_position_fields = ("x", "y", "z", "tilt_x", "tilt_y", "tilt_z")
+
+
+def object_table_dtype(num_params):
+    """Record type of NonSequentialComponent.snapshot."""
+    return np.dtype([("type", "U16"), ("comment", "U260"), ("ref", "i4")] +
+                    [(name, "f8") for name in _position_fields] +
+                    [("material", "U32"),
+                     ("parameters", "f8", (num_params,)),
+                     ("ignore", "i4")])
+
+
+def object_spec(spec):
+    """Normalise an object specification to an ObjectSpec.
+
+    The specification may be an ObjectSpec, a dict or a record of a
+    structured array with (some of) the fields of ObjectSpec.  The
+    position of a record may also be given by the fields x to tilt_z,
+    as in the records of NonSequentialComponent.snapshot (see
+    object_table_dtype).
+    """
+    if isinstance(spec, ObjectSpec):
+        fields = spec._asdict()
+    elif isinstance(spec, dict):
+        fields = dict(spec)
+    elif getattr(spec, "dtype", None) is not None and spec.dtype.names:
+        names = spec.dtype.names
+        fields = dict((name, spec[name]) for name in names
+                      if name in ObjectSpec._fields)
+        if "position" not in fields and set(_position_fields) & set(names):
+            fields["position"] = tuple(
+                spec[name] if name in names else 0.0
+                for name in _position_fields)
+    else:
+        fields = ObjectSpec(*spec)._asdict()
+    spec = ObjectSpec(**fields)
+
+    parameters = spec.parameters
+    if parameters is None:
+        parameters = {}
+    elif not isinstance(parameters, dict):
+        parameters = dict(enumerate(parameters, 1))
+    position = tuple(float(x) for x in spec.position)
+    if len(position) != 6:
+        raise ValueError("Object position must have 6 values: %s" %
+                         str(spec.position))
+    return ObjectSpec(
+        str(spec.type), spec.comment or "", (spec.material or "").upper(),
+        position, dict((int(k), float(v)) for (k, v) in parameters.items()),
+        int(spec.ref), int(spec.ignore))
+
+
+def object_requests(conn, surf, obj, spec, previous=None):
+    """Return the requests which set the data of an object.
+
+    If the ObjectSpec `previous` describes the current data of the
+    object, only the data which differ are set.
+    """
+    build_req = conn.build_req
+    requests = []
+    if previous is None or previous.type != spec.type:
+        # changing type resets the object data
+        requests.append(build_req("SetNSCObjectData", surf, obj, 0,
+                                  spec.type))
+        previous = None
+    if previous is None or previous.comment != spec.comment:
+        requests.append(build_req("SetNSCObjectData", surf, obj, 1,
+                                  spec.comment))
+    if previous is None or previous.ref != spec.ref:
+        requests.append(build_req("SetNSCObjectData", surf, obj, 5,
+                                  spec.ref))
+    for i, value in enumerate(spec.position):
+        if previous is None or previous.position[i] != value:
+            requests.append(build_req("SetNSCPosition", surf, obj, i+1,
+                                      value))
+    if previous is None or previous.material != spec.material:
+        requests.append(build_req("SetNSCPosition", surf, obj, 7,
+                                  spec.material))
+    for param in sorted(spec.parameters):
+        value = spec.parameters[param]
+        if previous is None or previous.parameters.get(param) != value:
+            requests.append(build_req("SetNSCParameter", surf, obj, param,
+                                      value))
+    if previous is None or previous.ignore != spec.ignore:
+        requests.append(build_req("SetNSCProperty", surf, obj, 16, 0,
+                                  spec.ignore))
+    return requests
+
+
+def read_objects(conn, surf, objs, params):
+    """Read the data of the numbered objects with a single batch.
+
+    `params` gives, for each object, the parameter numbers to read.
+    Returns a list of ObjectSpec.
+    """
+    objs = list(objs)
+    params = [list(p) for p in params]
+    requests = []
+    for obj, obj_params in zip(objs, params):
+        requests.extend([
+            "GetNSCObjectData,%d,%d,0" % (surf, obj),
+            "GetNSCObjectData,%d,%d,1" % (surf, obj),
+            "GetNSCObjectData,%d,%d,5" % (surf, obj),
+            "GetNSCPosition,%d,%d" % (surf, obj),
+            "GetNSCProperty,%d,%d,16,0" % (surf, obj)])
+        requests.extend("GetNSCParameter,%d,%d,%d" % (surf, obj, param)
+                        for param in obj_params)
+    responses = iter(conn.req_batch(requests))
+
+    specs = []
+    for obj_params in params:
+        _type, comment, ref, position, ignore = [next(responses)
+                                                 for i in range(5)]
+        position = parse_nsc_position(position)
+        values = dict((param, float(next(responses)))
+                      for param in obj_params)
+        specs.append(ObjectSpec(_type, comment, position[6].upper(),
+                                position[:6], values, int(float(ref)),
+                                int(float(ignore))))
+    return specs
+
 
 # matches definition of array size
 _dvr_pixels_re = re.compile(r".*Pixels\s(\d+)\sW\sX\s(\d+)\s")
 # matches row of column numbers (before listing of detector data)
-_dvr_cols_re = re.compile(r"^\s*1\s")
+_dvr_cols_re = re.compile(r"^[ \t]*1\s", re.MULTILINE)
+
+_number = r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+_dvr_size_re = re.compile(r"Size\s+%s\s*W\s+X\s+%s\s*H\s+(\w+)" %
+                          (_number, _number))
+_dvr_hits_re = re.compile(r"Total Hits\s*=\s*(\d+)")
+_dvr_peak_re = re.compile(r"^\s*Peak[^:\n]*:\s*%s" % _number, re.MULTILINE)
+_dvr_total_re = re.compile(r"^\s*Total[^:=\n]*:\s*%s" % _number,
+                           re.MULTILINE)
+_dvr_type_re = re.compile(r"^\s*Data Type\s*:\s*(.*?)\s*$", re.MULTILINE)
+
+DetectorInfo = namedtuple("DetectorInfo", [
+    "pixels", "size", "units", "hits", "peak", "total", "data_type"])
+# pixels : (x, y) number of pixels
+# size : (x, y) full width of the detector
+# units : units of size
+# hits : total number of ray hits
+# peak, total : peak and total values of the listed data
+# data_type : description of the listed data (eg. "Incoherent Irradiance")
+
+
+def _match_group(regex, text, _type=float):
+    m = regex.search(text)
+    if m is None:
+        return None
+    if _type is None:
+        return m.group(1)
+    return _type(m.group(1))
+
+
+def parse_detector_text(text, out=None, dtype=np.float32):
+    """Parse the text output of the detector viewer ("Dvr").
+
+    out :
+        Optional array of shape (y pixels, x pixels) to receive the
+        data (eg. a numpy.memmap).  If a path is given instead, the
+        data is written to a new memory-mapped file at the path.
+
+    Returns (data, info), where info is a DetectorInfo instance.
+    """
+    m = _dvr_pixels_re.search(text)
+    if m is None:
+        raise ValueError("Detector size not found in text")
+    nx, ny = (int(x) for x in m.groups())
+    header = text[:m.end()]
+
+    size = _dvr_size_re.search(header)
+    if size is not None:
+        width, height, units = size.groups()
+        size = (float(width), float(height))
+    else:
+        units = None
 
+    cols = _dvr_cols_re.search(text, m.end())
+    if cols is None:
+        raise ValueError("Detector data not found in text")
+    start = text.index("\n", cols.start()) + 1
+    body = text[m.end():cols.start()]
+    info = DetectorInfo((nx, ny), size, units,
+                        _match_group(_dvr_hits_re, text, int),
+                        _match_group(_dvr_peak_re, body),
+                        _match_group(_dvr_total_re, body),
+                        _match_group(_dvr_type_re, body, None))
 
-def get_detector_data(conn, settingspath=None):
-    with conn.GetTextFileObject("Dvr", settingspath) as f:
-        # extract size of array in pixels
-        while True:
-            m = _dvr_pixels_re.match(next(f))
-            if m:
+    # Each row is listed with the row number in the first column.
+    # Convert the whole block with a single call.
+    n = ny * (nx + 1)
+    values = text[start:].split(None, n)[:n]
+    if len(values) < n:
+        raise ValueError("Detector data is incomplete")
+    values = np.array(values, dtype=np.float64).reshape((ny, nx + 1))
+
+    if out is None:
+        out = np.empty((ny, nx), dtype)
+    elif isinstance(out, basestring):
+        out = np.memmap(out, dtype, "w+", shape=(ny, nx))
+    out[...] = values[:, 1:]
+    return out, info
+
+
+def get_detector_text(conn, settingspath=None, out=None):
+    """Return the detector viewer data and a DetectorInfo instance.
+
+    See parse_detector_text for the meaning of `out`."""
+    text = conn.GetTextFileString("Dvr", settingspath)
+    return parse_detector_text(text, out)
+
+
+def get_detector_data(conn, settingspath=None, out=None):
+    data, info = get_detector_text(conn, settingspath, out)
+    return data
+
+
+class DetectorFormatError(ValueError):
+    pass
+
+
+# Layout of the binary files written by SaveDetector for detector
+# rectangle objects (".DDR"), as described in the Zemax manual.
+detector_header_dtype = np.dtype([
+    ("version", "<i4"), ("type", "<i4"), ("lens_units", "<i4"),
+    ("source_units", "<i4"), ("source_multiplier", "<i4"),
+    ("i_data", "<i4", (50,)), ("d_data", "<f8", (50,))])
+# i_data[0:2] : number of pixels (x, y)
+# d_data[0:2] : half widths of the detector (x, y)
+
+_pixel_fields = [("incoherent", "<f8"), ("coherent_real", "<f8"),
+                 ("coherent_imag", "<f8"), ("angle_incoherent", "<f8"),
+                 ("hits", "<i4")]
+# The pixel records may be packed, or padded to 8 byte alignment.
+detector_pixel_dtypes = [np.dtype(_pixel_fields),
+                         np.dtype(_pixel_fields, align=True)]
+
+detector_data_types = {
+    "incoherent": "Incoherent Irradiance",
+    "coherent_real": "Coherent Irradiance (real)",
+    "coherent_imag": "Coherent Irradiance (imaginary)",
+    "angle_incoherent": "Radiant Intensity",
+    "hits": "Hits",
+}
+
+_lens_units = {0: "Millimeters", 1: "Centimeters", 2: "Inches", 3: "Meters"}
+
+
+class DetectorFile(object):
+    """Memory-mapped view of a detector file written by SaveDetector.
+
+    The pixel records are available as a structured array of shape
+    (y pixels, x pixels) from the attribute `pixels`.  Individual
+    fields (eg. `pixels["incoherent"]`) are views on the file, so large
+    detectors are not read into memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        if size < detector_header_dtype.itemsize:
+            raise DetectorFormatError("File too short for detector header")
+        self.header = np.fromfile(path, detector_header_dtype, 1)[0]
+        nx, ny = (int(n) for n in self.header["i_data"][:2])
+        if nx < 1 or ny < 1:
+            raise DetectorFormatError("Invalid number of pixels",
+                                      (nx, ny))
+
+        remaining = size - detector_header_dtype.itemsize
+        for dtype in detector_pixel_dtypes:
+            if remaining == nx * ny * dtype.itemsize:
                 break
-        sz = tuple(int(x) for x in m.groups())
-        # allocate array of floats
-        ar = np.zeros(sz, np.float32)
-        # skip to column numbers
-        while not _dvr_cols_re.match(next(f)):
-            pass
-        # read detector data
-        for i in range(sz[1]):
-            row = next(f).split('\t')
-            # skip row number in first column
-            ar[i, :] = row[1:]
-    return ar
+        else:
+            raise DetectorFormatError("Unexpected size of pixel data",
+                                      remaining, (nx, ny))
+        self.pixels = np.memmap(path, dtype, "r",
+                                detector_header_dtype.itemsize, (ny, nx))
+
+    def get_info(self, field="incoherent"):
+        data = self.pixels[field]
+        d_data = self.header["d_data"]
+        return DetectorInfo(
+            self.pixels.shape[::-1],
+            (2*float(d_data[0]), 2*float(d_data[1])),
+            _lens_units.get(int(self.header["lens_units"])),
+            int(self.pixels["hits"].sum()),
+            float(data.max()), float(data.sum()),
+            detector_data_types[field])
+
+
+def read_detector(conn, surf, obj, field="incoherent", path=None,
+                  settingspath=None):
+    """Return the data and a DetectorInfo instance for a detector.
+
+    The detector is saved with SaveDetector, in binary format.  If a
+    `path` is given, the file is retained there and the returned data
+    is memory-mapped from it.  Otherwise the data is read into memory
+    from a temporary file.
+
+    field :
+        One of the pixel record fields: "incoherent", "coherent_real",
+        "coherent_imag", "angle_incoherent" or "hits".
+
+    If the detector cannot be saved or read in binary format, the data
+    is obtained from the detector viewer text output ("Dvr") with the
+    settings file `settingspath` (which should select the same detector
+    and data type).
+    """
+    remove = path is None
+    if remove:
+        (fd, path) = tempfile.mkstemp(".DDR")
+        os.close(fd)
+    try:
+        try:
+            # a file left at `path` by an earlier save must not be read
+            # if this save fails
+            error = conn.SaveDetector(surf, obj, os.path.abspath(path))
+            if error:
+                raise ZemaxServerError(
+                    "SaveDetector signalled an error: %s" % error)
+            detector = DetectorFile(path)
+        except (DetectorFormatError, ZemaxServerError):
+            return get_detector_text(conn, settingspath)
+        data = detector.pixels[field]
+        info = detector.get_info(field)
+        if remove:
+            data = np.array(data)
+        del detector
+        return data, info
+    finally:
+        if remove:
+            os.remove(path)
+
+
+class DetectorAccumulator(object):
+    """Accumulates the per-pixel mean and variance of detector data.
+
+    Each call to add() contributes the data from one independent trace.
+    The running statistics are updated with Welford's algorithm.
+    """
+    def __init__(self):
+        self.runs = 0
+        self.mean = None
+        self._m2 = None
+
+    def add(self, data):
+        data = np.asarray(data, np.float64)
+        self.runs += 1
+        if self.mean is None:
+            self.mean = data.copy()
+            self._m2 = np.zeros_like(self.mean)
+            return
+        delta = data - self.mean
+        self.mean += delta / self.runs
+        self._m2 += delta * (data - self.mean)
+
+    @property
+    def variance(self):
+        """Variance of the data from a single run."""
+        if self.runs < 2:
+            return None
+        return self._m2 / (self.runs - 1)
+
+    @property
+    def uncertainty(self):
+        """Standard error of the mean."""
+        if self.runs < 2:
+            return None
+        return np.sqrt(self.variance / self.runs)
+
+    def noise(self, threshold=0.1):
+        """Return the greatest relative uncertainty of the mean.
+
+        Only pixels with a mean of at least `threshold` times the peak
+        are considered, since the relative noise on dark pixels does not
+        converge."""
+        if self.runs < 2:
+            return np.inf
+        peak = self.mean.max()
+        if peak <= 0:
+            return np.inf
+        bright = self.mean >= threshold * peak
+        return float((self.uncertainty[bright] / self.mean[bright]).max())
+
+
+DetectorEstimate = namedtuple("DetectorEstimate", [
+    "mean", "uncertainty", "runs", "noise"])
+
+
+def accumulate_detector(conn, surf, obj, target_noise=0.05, max_runs=100,
+                        min_runs=3, threshold=0.1, field="incoherent",
+                        pool=None, **trace_args):
+    """Average detector data over repeated traces, to a target noise.
+
+    Each run clears the detectors, traces with a new random seed (see
+    Connection.NSCTrace, whose arguments may be given as keywords) and
+    reads the detector with read_detector.  Runs are distributed over
+    the connections of `pool` (default: a LocalPool on `conn`).  The
+    runs stop when the relative noise on the mean (see
+    DetectorAccumulator.noise) falls below `target_noise`, or after
+    `max_runs` runs.
+
+    Returns a DetectorEstimate instance.
+    """
+    if pool is None:
+        pool = LocalPool(conn)
+    trace_args["no_random_seed"] = 0
+    trace_args.setdefault("surf", surf)
+
+    def run(conn, i):
+        conn.NSCDetectorData(surf, 0)  # clear all detectors
+        conn.NSCTrace(**trace_args)
+        data, info = read_detector(conn, surf, obj, field)
+        return data
+
+    acc = DetectorAccumulator()
+    noise = np.inf
+    for i, data in pool.as_completed(run, count()):
+        acc.add(data)
+        noise = acc.noise(threshold)
+        if acc.runs >= max_runs or (acc.runs >= min_runs and
+                                    noise <= target_noise):
+            break
+    return DetectorEstimate(acc.mean, acc.uncertainty, acc.runs, noise)
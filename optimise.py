@@ -0,0 +1,399 @@
+# Client-side optimisation of the lens held by the Zemax server.
+#
+# Connection.Optimize runs the server's damped least squares and blocks
+# until it is done.  Here the merit function is a list of operands,
+# evaluated with OperandValue in a single batch of requests for each set
+# of variable values.  Evaluations at independent points (the finite
+# difference perturbations and the trial steps) are made through a pool
+# (see pool.py), while the Levenberg-Marquardt steps are computed
+# locally.
+#
+# Operands are evaluated one at a time, so operands which refer to the
+# values of other rows of the merit function editor cannot be used.
+
+from __future__ import print_function
+import time
+import numpy as np
+from collections import namedtuple
+from libzmx import (SurfaceSequence, Standard, AuxParameter,
+                    CurvatureParameter, ThicknessParameter,
+                    SemiDiameterParameter)
+from zemaxclient import Untraceable
+from pool import LocalPool
+from solves import SolveTable
+
+
+Operand = namedtuple("Operand", ["type", "args", "target", "weight"])
+Operand.__new__.__defaults__ = ((), 0.0, 1.0)
+# type : operand type (eg. "EFFL")
+# args :
+#     arguments of OperandValue: int1, int2 and data1-data4 (trailing
+#     arguments may be omitted)
+
+
+def operand_requests(conn, operands):
+    return [conn.build_req("OperandValue", op.type, *op.args)
+            for op in operands]
+
+
+def evaluate_operands(conn, operands):
+    """Evaluate the operands with a single batch of requests."""
+    responses = conn.req_batch(operand_requests(conn, operands))
+    return np.array([float(r) for r in responses])
+
+
+def write_merit_function(conn, operands):
+    """Replace the merit function in the server with the operands."""
+    total = conn.InsertMFO(1)
+    requests = ["DeleteMFO,2"] * (total - 1)
+    requests.extend(["InsertMFO,1"] * (len(operands) - 1))
+    for row, op in enumerate(operands, 1):
+        columns = [op.type] + list(op.args)
+        for column, value in enumerate(columns, 1):
+            requests.append(conn.build_req("SetOperand", row, column, value))
+        requests.append(conn.build_req("SetOperand", row, 8, op.target))
+        requests.append(conn.build_req("SetOperand", row, 9, op.weight))
+    conn.req_batch(requests)
+
+
+_solve_names = {0: "curvature", 1: "thickness", 3: "semidia", 4: "conic"}
+_solve_names.update((code, "par%d" % (code - 4)) for code in range(5, 17))
+
+
+def _solve_parameter(surface, code):
+    """Return the parameter with the given GetSolve code."""
+    if code == 0:
+        return CurvatureParameter(surface)
+    elif code == 1:
+        return ThicknessParameter(surface)
+    elif code == 3:
+        return SemiDiameterParameter(surface)
+    elif code == 4:
+        # as defined for Standard, whatever the type of the surface
+        return Standard.conic.fget(surface)
+    elif 5 <= code <= 16:
+        return AuxParameter(surface, code - 4)
+    raise ValueError("No parameter for solve code %d" % code)
+
+
+def find_variables(model):
+    """Return the parameters of the model which are variable.
+
+    The solves of all surfaces are read with a single batch (see
+    solves.SolveTable).
+    """
+    surfaces = list(model)
+    table = SolveTable(model.conn, len(surfaces) - 1)
+    return [_solve_parameter(surfaces[n], code)
+            for (n, code) in table.variables()]
+
+
+class MeritFunction(object):
+    """Evaluates operands for sets of values of the variables.
+
+    The surface numbers of the variables are resolved once, so the
+    surfaces must not be inserted or deleted while it is in use.
+    """
+    def __init__(self, conn, variables, operands):
+        self.conn = conn
+        self.variables = list(variables)
+        self.operands = list(operands)
+        self.surf_nums = [p.surface.get_surf_num() for p in self.variables]
+        self.targets = np.array([op.target for op in self.operands], float)
+        self.weights = np.array([op.weight for op in self.operands], float)
+        self._operand_requests = operand_requests(conn, self.operands)
+        self.evaluations = 0
+
+    def get_values(self):
+        """Read the current values of the variables."""
+        requests = [p.get_request(n)
+                    for (p, n) in zip(self.variables, self.surf_nums)]
+        return np.array([float(p.parse_value(r)) for (p, r) in
+                         zip(self.variables, self.conn.req_batch(requests))])
+
+    def set_requests(self, x):
+        return [p.set_request(n, float(value)) for (p, n, value)
+                in zip(self.variables, self.surf_nums, x)]
+
+    def set_values(self, x):
+        self.conn.req_batch(self.set_requests(x))
+        self.conn.GetUpdate()
+
+    def requests(self, x):
+        """Requests which evaluate the operands at the values `x`."""
+        return self.set_requests(x) + ["GetUpdate"] + self._operand_requests
+
+    def evaluate(self, conn, x):
+        """Evaluate the operands with `conn`, for the pools.
+
+        Returns None if the lens cannot be traced.
+        """
+        responses = conn.req_batch(self.requests(x))
+        if int(responses[len(self.variables)]):
+            return None
+        return np.array([float(r) for r in
+                         responses[len(self.variables)+1:]])
+
+    def residuals(self, values):
+        """Weighted residuals, whose sum of squares is the merit."""
+        if values is None:
+            return None
+        return np.sqrt(self.weights) * (values - self.targets)
+
+    def merit(self, residuals):
+        """Merit function value, as defined by Zemax."""
+        if residuals is None:
+            return np.inf
+        return np.sqrt(np.dot(residuals, residuals) / self.weights.sum())
+
+    def map(self, pool, points):
+        """Return the operand values at each of the points, using the
+        pool (None where the lens cannot be traced)."""
+        self.evaluations += len(points)
+        return pool.map(self.evaluate, points)
+
+    def labels(self):
+        """Labels of the variables and of the operands."""
+        variables = ["%d:%s" % (n, _solve_names.get(p.solve_code,
+                                                    p.solve_code))
+                     for (p, n) in zip(self.variables, self.surf_nums)]
+        operands = ["%s(%s)" % (op.type, ",".join(str(a) for a in op.args))
+                    for op in self.operands]
+        return variables, operands
+
+
+def _derivatives(mf, pool, x, values, step, central=False):
+    """Finite difference derivatives of the operand values.
+
+    Returns an array of shape (operands, variables).  The step of each
+    variable is `step` relative to its value (or absolute for values
+    smaller than 1).
+    """
+    h = step * np.maximum(1.0, np.abs(x))
+    offsets = np.diag(h)
+    points = [x + d for d in offsets]
+    if central:
+        points.extend(x - d for d in offsets)
+    results = mf.map(pool, points)
+    if any(v is None for v in results):
+        raise Untraceable()
+    results = np.array(results).T
+    if central:
+        n = len(x)
+        return (results[:, :n] - results[:, n:]) / (2 * h)
+    return (results - values[:, np.newaxis]) / h
+
+
+class CriteriaEvaluator(object):
+    """Evaluates criteria for sets of values of some parameters.
+
+    criteria :
+        Operand specifications, evaluated with the batch of requests
+        which sets the parameters, or functions which are called as
+        func(conn) and return a number
+
+    The values last written on each connection are kept, so that an
+    evaluation only sets the parameters which differ.  Each connection
+    is assumed to start with the values the parameters have on `conn`.
+    """
+    def __init__(self, conn, params, criteria):
+        self.params = list(params)
+        self.surf_nums = [p.surface.get_surf_num() for p in self.params]
+        criteria = list(criteria)
+        self.operands = [c for c in criteria if isinstance(c, Operand)]
+        self.functions = [c for c in criteria if not isinstance(c, Operand)]
+        self._operand_requests = operand_requests(conn, self.operands)
+        # position of each criterion in the order of evaluation
+        self.order = np.argsort([not isinstance(c, Operand)
+                                 for c in criteria], kind="mergesort")
+        requests = [p.get_request(n)
+                    for (p, n) in zip(self.params, self.surf_nums)]
+        self.nominal = np.array([
+            float(p.parse_value(r)) for (p, r) in
+            zip(self.params, conn.req_batch(requests))])
+        self.writes = 0
+        self._written = {}
+
+    def set_requests(self, conn, x):
+        last = self._written.get(conn, self.nominal)
+        self._written[conn] = x
+        requests = [p.set_request(n, float(value)) for (p, n, value, old)
+                    in zip(self.params, self.surf_nums, x, last)
+                    if value != old]
+        self.writes += len(requests)
+        return requests
+
+    def evaluate(self, conn, x):
+        """Return the criteria for the parameter values `x`.  The
+        criteria are NaN if the lens cannot be traced."""
+        requests = self.set_requests(conn, x)
+        n = len(requests)
+        requests.append("GetUpdate")
+        requests.extend(self._operand_requests)
+        responses = conn.req_batch(requests)
+        values = np.empty(len(self.operands) + len(self.functions))
+        if int(responses[n]):
+            values.fill(np.nan)
+        else:
+            values[:len(self.operands)] = [float(r) for r in
+                                           responses[n+1:]]
+            values[len(self.operands):] = [f(conn) for f in self.functions]
+        criteria = np.empty_like(values)
+        criteria[self.order] = values
+        return criteria
+
+    def restore(self, conn):
+        """Set the starting values of the parameters on `conn`."""
+        conn.req_batch(self.set_requests(conn, self.nominal))
+        conn.GetUpdate()
+
+
+OptimiseResult = namedtuple("OptimiseResult", [
+    "values", "merit", "initial_merit", "iterations", "evaluations",
+    "elapsed"])
+
+
+def optimise(conn, variables, operands, pool=None, max_iter=50, step=1e-6,
+             tolerance=1e-9, damping=1e-3):
+    """Minimise the merit function by varying the variables.
+
+    variables :
+        Parameter instances (see find_variables)
+    operands :
+        Operand specifications
+    pool :
+        Pool on which evaluations are made, by default a LocalPool of
+        `conn`.  The workers of a ConnectionPool, which must reach
+        separate servers (see pool.py), must hold a copy of the lens
+        (see pool.copy_lens_setup).  Each evaluation sets all the
+        variables, so the workers need no other synchronisation.
+    step :
+        Relative finite difference step
+    tolerance :
+        The optimisation stops when an iteration reduces the merit by
+        less than this fraction.
+
+    The best values found are set in the server lens.
+    """
+    start = time.time()
+    if pool is None:
+        pool = LocalPool(conn)
+    mf = MeritFunction(conn, variables, operands)
+    x = mf.get_values()
+    (values,) = mf.map(pool, [x])
+    if values is None:
+        raise Untraceable()
+    r = mf.residuals(values)
+    initial_merit = merit = mf.merit(r)
+    root_weights = np.sqrt(mf.weights)[:, np.newaxis]
+
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        jacobian = root_weights * _derivatives(mf, pool, x, values, step)
+        a = np.dot(jacobian.T, jacobian)
+        g = np.dot(jacobian.T, r)
+        scale = np.maximum(np.diag(a), 1e-12)
+
+        # try a damping factor for each worker of the pool at once
+        improved = False
+        while not improved and damping < 1e12:
+            dampings = damping * 10.0 ** np.arange(pool.size)
+            trials = [x - np.linalg.solve(a + d * np.diag(scale), g)
+                      for d in dampings]
+            results = mf.map(pool, trials)
+            merits = [mf.merit(mf.residuals(v)) for v in results]
+            best = int(np.argmin(merits))
+            if merits[best] < merit:
+                improved = True
+                change = (merit - merits[best]) / merit
+                x, values, merit = trials[best], results[best], merits[best]
+                r = mf.residuals(values)
+                damping = dampings[best] / 10.0
+            else:
+                damping = dampings[-1] * 10.0
+        if not improved or change < tolerance:
+            break
+
+    mf.set_values(x)
+    return OptimiseResult(x, merit, initial_merit, iteration, mf.evaluations,
+                          time.time() - start)
+
+
+Sensitivity = namedtuple("Sensitivity", [
+    "matrix", "variables", "operands", "values"])
+# matrix :
+#     derivatives d(operand)/d(variable), of shape (operands, variables)
+# variables, operands :
+#     labels of the columns and rows of the matrix
+# values :
+#     operand values at the current values of the variables
+
+
+def sensitivity_matrix(params, operands, step=1e-6, central=False,
+                       pool=None):
+    """Return the derivatives of the operands with respect to the
+    variables.
+
+    params :
+        Parameter instances, or a SurfaceSequence whose variables are
+        found with find_variables
+    step :
+        Relative finite difference step (see optimise)
+    central :
+        Use central, rather than forward, differences
+    pool :
+        Pool on which the perturbations are evaluated (see optimise)
+
+    The variables are restored to their values afterwards.  ValueError
+    is raised if there are no variables.
+    """
+    if isinstance(params, SurfaceSequence):
+        conn = params.conn
+        params = find_variables(params)
+    else:
+        params = list(params)
+        conn = params[0].surface.conn if params else None
+    if not params:
+        raise ValueError("No variables for the sensitivity matrix")
+    if pool is None:
+        pool = LocalPool(conn)
+    mf = MeritFunction(conn, params, operands)
+    x = mf.get_values()
+    try:
+        (values,) = mf.map(pool, [x])
+        if values is None:
+            raise Untraceable()
+        matrix = _derivatives(mf, pool, x, values, step, central)
+    finally:
+        mf.set_values(x)
+    variable_labels, operand_labels = mf.labels()
+    return Sensitivity(matrix, variable_labels, operand_labels, values)
+
+
+OptimiserComparison = namedtuple("OptimiserComparison", [
+    "client", "server_merit", "server_elapsed", "speedup"])
+
+
+def compare_with_server(conn, variables, operands, pool=None, cycles=0,
+                        **kwargs):
+    """Time optimise against Connection.Optimize from the same start.
+
+    The operands are written to the server's merit function for
+    Connection.Optimize, which varies the parameters with variable
+    solves.  The variables are reset to their starting values
+    afterwards.  The speedup is the ratio of the server's time to the
+    client's time.
+    """
+    mf = MeritFunction(conn, variables, operands)
+    start_values = mf.get_values()
+    client = optimise(conn, variables, operands, pool, **kwargs)
+
+    mf.set_values(start_values)
+    write_merit_function(conn, operands)
+    start = time.time()
+    conn.Optimize(cycles)
+    server_elapsed = time.time() - start
+    server_merit = mf.merit(mf.residuals(mf.evaluate(conn, mf.get_values())))
+    mf.set_values(start_values)
+    return OptimiserComparison(client, server_merit, server_elapsed,
+                               server_elapsed / client.elapsed)
@@ -0,0 +1,181 @@
+# Distribution of work over several Zemax conversations.
+#
+# Engines which evaluate many independent tasks (traces, merit function
+# evaluations, trials) accept a pool.  Tasks are functions called as
+# func(conn, item) and the pool decides which connection runs them.
+# LocalPool runs tasks on a single connection, in the calling thread.
+# ConnectionPool runs them in worker threads, each with its own
+# connection.  Zemax serves all DDE conversations from a single lens,
+# and every Connection reaches the same server (see Connection.server),
+# so ConnectionPool refuses workers which share a server: with
+# Connection, only LocalPool and pools of one worker can be used.
+
+import os
+import tempfile
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class LocalPool(object):
+    """Runs tasks on a single connection, in the calling thread."""
+    size = 1
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def as_completed(self, func, items):
+        """Yield (index, result) for each item, as results are obtained."""
+        for i, item in enumerate(items):
+            yield i, func(self.conn, item)
+
+    def map(self, func, items):
+        return [func(self.conn, item) for item in items]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class ConnectionPool(object):
+    """Runs tasks in worker threads, each with its own connection.
+
+    A DDE conversation can only be used by the thread which opened it,
+    so each worker makes its connection by calling `factory`.  The
+    workers would change a shared lens under each other, so ValueError
+    is raised if the `server` attributes of two workers' connections
+    are equal, as they are for any two Connection instances.  If given,
+    `setup(conn)` is then called to prepare the worker's lens (see
+    copy_lens_setup).
+    """
+    def __init__(self, size, factory, setup=None):
+        self.size = size
+        self.factory = factory
+        self.setup = setup
+        self._tasks = queue.Queue()
+        self._servers = queue.Queue()
+        self._checked = threading.Event()
+        self._refused = False
+        self._workers = [threading.Thread(target=self._work)
+                         for i in range(size)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+        # the servers are checked before any worker sets up its lens
+        servers = [self._servers.get() for worker in self._workers]
+        servers = [server for server in servers if server is not None]
+        self._refused = len(set(servers)) < len(servers)
+        self._checked.set()
+        if self._refused:
+            for worker in self._workers:
+                worker.join()
+            raise ValueError("workers of the pool share a server: %r"
+                             % (servers,))
+
+    def _work(self):
+        try:
+            conn = self.factory()
+        except Exception as e:
+            conn = _Failure(e)
+        self._servers.put(getattr(conn, "server", None))
+        self._checked.wait()
+        if self._refused:
+            self._disconnect(conn)
+            return
+        if self.setup is not None and not isinstance(conn, _Failure):
+            try:
+                self.setup(conn)
+            except Exception as e:
+                conn = _Failure(e)
+
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            func, index, item, results = task
+            if isinstance(conn, _Failure):
+                results.put((index, conn))
+                continue
+            try:
+                result = func(conn, item)
+            except Exception as e:
+                result = _Failure(e)
+            results.put((index, result))
+        self._disconnect(conn)
+
+    @staticmethod
+    def _disconnect(conn):
+        if not isinstance(conn, _Failure) and hasattr(conn, "disconnect"):
+            conn.disconnect()
+
+    def as_completed(self, func, items):
+        """Yield (index, result) for each item, as results are obtained.
+
+        Items are submitted as workers become free, so `items` may be an
+        unbounded iterator, provided the caller stops consuming results
+        at some point.  An exception raised by a task is raised here.
+        """
+        results = queue.Queue()
+        items = enumerate(items)
+        in_flight = 0
+        exhausted = False
+        while True:
+            while not exhausted and in_flight < 2 * self.size:
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self._tasks.put((func, index, item, results))
+                in_flight += 1
+            if not in_flight:
+                break
+            index, result = results.get()
+            in_flight -= 1
+            if isinstance(result, _Failure):
+                raise result.error
+            yield index, result
+
+    def map(self, func, items):
+        results = dict(self.as_completed(func, items))
+        return [results[i] for i in range(len(results))]
+
+    def close(self):
+        for worker in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def copy_lens_setup(conn):
+    """Save the server lens, for loading by the workers of a pool.
+
+    Returns (setup, path), where setup(conn) loads the saved lens.  The
+    caller should remove the file at `path` when the pool is closed.
+    """
+    (fd, path) = tempfile.mkstemp(".ZMX")
+    os.close(fd)
+    conn.SaveFile(path)
+
+    def setup(worker_conn):
+        worker_conn.LoadFile(path)
+    return setup, path
@@ -0,0 +1,281 @@
+# Bulk snapshots of the lens prescription held in the Zemax server.
+#
+# Reading a surface through the Parameter objects in libzmx costs a
+# FindLabel and a request per attribute.  A snapshot reads the whole
+# prescription with one batch of requests and holds it in plain
+# (immutable) Python values, so that client-side engines can work on it
+# without further round trips.
+
+from __future__ import print_function
+from collections import namedtuple
+
+
+SurfaceData = namedtuple("SurfaceData", [
+    "type", "comment", "curvature", "thickness", "glass", "semidia",
+    "conic", "parameters", "coord_return", "extra"])
+SurfaceData.__new__.__defaults__ = ((),)
+# parameters :
+#     tuple of surface parameter values, indexed from parameter 0
+# coord_return :
+#     (code, surface number) of the coordinate return (see
+#     CoordinateBreak.return_to).  Code 0 indicates no return.
+# extra :
+#     tuple of (column, value) of the non-zero extra data values
+
+SystemData = namedtuple("SystemData", [
+    "unitcode", "stopsurf", "rayaimingtype", "adjust_index", "temperature",
+    "pressure", "globalrefsurf", "aperture_type", "aperture_value"])
+
+FieldData = namedtuple("FieldData", [
+    "x", "y", "weight", "vdx", "vdy", "vcx", "vcy", "van"])
+
+WavelengthData = namedtuple("WavelengthData", ["wavelength", "weight"])
+
+ConfigOperand = namedtuple("ConfigOperand", ["type", "args", "values"])
+# args : the three integer arguments of the operand
+# values :
+#     value of the operand in each configuration (a number, or a
+#     string for operands such as GLSS)
+
+ObjectSpec = namedtuple("ObjectSpec", [
+    "type", "comment", "material", "position", "parameters", "ref",
+    "ignore"])
+ObjectSpec.__new__.__defaults__ = ("", "", (0.0,) * 6, {}, 0, 0)
+# Non-sequential object (see nscsurf.NonSequentialComponent.set_objects)
+# type : object type code (eg. "NSC_SSUR")
+# position : (x, y, z, tilt-x, tilt-y, tilt-z)
+# parameters :
+#     dict of values keyed by parameter number, or a sequence of values
+#     of the parameters from 1
+# ref : number of the object to which the position is referred
+# ignore :
+#     0 to trace the object, 1 to ignore it or 2 to ignore it only on
+#     launch (see NonSequentialComponent.set_obj_ignored)
+
+
+class Prescription(object):
+    """Snapshot of a lens prescription.
+
+    Besides the surfaces and system data, a prescription holds the
+    fields, wavelengths and multi-configuration operands, the objects
+    of non-sequential components (a dict of lists of ObjectSpec keyed
+    by surface number) and, optionally, the solves of the surfaces (a
+    list, for each surface, of the solve data of each code, see
+    read_solves).
+    """
+    num_parameters = 13  # parameters 0-12
+    num_extra = 242  # extra data columns 1-242
+
+    def __init__(self, surfaces, system, field_type=0, fields=(),
+                 primary_wave=1, wavelengths=(), current_config=1,
+                 configs=(), objects=None, solves=None):
+        self.surfaces = list(surfaces)
+        self.system = system
+        self.field_type = field_type
+        self.fields = list(fields)
+        self.primary_wave = primary_wave
+        self.wavelengths = list(wavelengths)
+        self.current_config = current_config
+        self.configs = list(configs)
+        self.objects = dict(objects or {})
+        self.solves = solves if solves is None else list(solves)
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def __getitem__(self, surfno):
+        return self.surfaces[surfno]
+
+    def _key(self):
+        return (self.surfaces, self.system, self.field_type, self.fields,
+                self.primary_wave, self.wavelengths, self.current_config,
+                self.configs, self.objects, self.solves)
+
+    def __eq__(self, other):
+        return (isinstance(other, Prescription) and
+                self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def read_surfaces(conn, surfs, num_parameters=Prescription.num_parameters,
+                  num_extra=0):
+    """Read the data of the numbered surfaces with a single batch.
+
+    num_extra :
+        number of extra data columns to read.  The type of a surface
+        does not tell how many it uses, and each column costs a request
+        for every surface, so none are read by default and `extra` is
+        left empty.  Only the non-zero values are kept (as in a .ZMX
+        file).
+    """
+    surfs = list(surfs)
+    data_codes = (0, 1, 2, 3, 4, 5, 6, 80, 81)
+    requests = []
+    for n in surfs:
+        requests.extend("GetSurfaceData,%d,%d" % (n, code)
+                        for code in data_codes)
+        requests.extend("GetSurfaceParameter,%d,%d" % (n, code)
+                        for code in range(num_parameters))
+        requests.extend("GetExtra,%d,%d" % (n, column)
+                        for column in range(1, num_extra + 1))
+    responses = conn.req_batch(requests)
+
+    stride = len(data_codes) + num_parameters + num_extra
+    surfaces = []
+    for i in range(len(surfs)):
+        values = responses[i*stride:(i+1)*stride]
+        (_type, comment, curvature, thickness, glass, semidia, conic,
+         return_code, return_surf) = values[:len(data_codes)]
+        parameters = values[len(data_codes):len(data_codes)+num_parameters]
+        extra = [(column, _float(v)) for (column, v) in enumerate(
+            values[len(data_codes)+num_parameters:], 1)]
+        surfaces.append(SurfaceData(
+            _type, comment, _float(curvature), _float(thickness), glass,
+            _float(semidia), _float(conic),
+            tuple(_float(v) for v in parameters),
+            (int(_float(return_code)), int(_float(return_surf))),
+            tuple((column, v) for (column, v) in extra if v != 0)))
+    return surfaces
+
+
+def read_system(conn):
+    (numsurfs, unitcode, stopsurf, nonaxialflag, rayaimingtype,
+     adjust_index, temp, pressure, globalrefsurf) = conn.GetSystem()
+    aperture_type, _, aperture_value = conn.GetSystemAper()
+    system = SystemData(unitcode, stopsurf, rayaimingtype, adjust_index,
+                        temp, pressure, globalrefsurf, aperture_type,
+                        aperture_value)
+    return numsurfs, system
+
+
+def read_fields(conn):
+    """Return (field type, list of FieldData)."""
+    field_type, number = conn.GetFieldsConfig()[:2]
+    responses = conn.req_batch(["GetField,%d" % n
+                                for n in range(1, number + 1)])
+    fields = [FieldData(*[float(x) for x in r.split(",")])
+              for r in responses]
+    return field_type, fields
+
+
+def read_wavelengths(conn):
+    """Return (primary wavelength, list of WavelengthData)."""
+    primary, number = conn.GetWavelengthsCount()
+    responses = conn.req_batch(["GetWave,%d" % n
+                                for n in range(1, number + 1)])
+    waves = [WavelengthData(*[float(x) for x in r.split(",")])
+             for r in responses]
+    return primary, waves
+
+
+def config_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def read_configs(conn):
+    """Return (current configuration, list of ConfigOperand)."""
+    current, num_configs, num_operands = conn.GetConfig()
+    requests = []
+    for row in range(1, num_operands + 1):
+        requests.append("GetMulticon,0,%d" % row)
+        requests.extend("GetMulticon,%d,%d" % (config, row)
+                        for config in range(1, num_configs + 1))
+    responses = iter(conn.req_batch(requests))
+    operands = []
+    for row in range(num_operands):
+        fields = next(responses).split(",")
+        values = [config_value(next(responses).split(",")[0])
+                  for config in range(num_configs)]
+        operands.append(ConfigOperand(
+            fields[0], tuple(int(float(x)) for x in fields[1:4]),
+            tuple(values)))
+    return current, operands
+
+
+solve_codes = range(17)  # GetSolve codes, from curvature to parameter 12
+
+
+def read_solves(conn, surfs):
+    """Read the solves of the numbered surfaces with a single batch.
+
+    Returns, for each surface, a tuple of the solve data of each code
+    (as tuples of the values of the GetSolve response).
+    """
+    surfs = list(surfs)
+    requests = ["GetSolve,%d,%d" % (n, code)
+                for n in surfs for code in solve_codes]
+    responses = iter(conn.req_batch(requests))
+    return [tuple(tuple(config_value(x) for x in next(responses).split(","))
+                  for code in solve_codes)
+            for n in surfs]
+
+
+def nsc_surfaces(surfaces):
+    """Numbers of the non-sequential components among the surfaces (a
+    sequence of SurfaceData numbered from 0)."""
+    return [n for (n, s) in enumerate(surfaces) if s.type == "NONSEQCO"]
+
+
+def read_nsc_objects(conn, surfs, num_params=12):
+    """Read the objects of the numbered non-sequential components.
+
+    Returns a dict of lists of ObjectSpec keyed by surface number.
+    Parameters 1 to `num_params` of each object are read.
+    """
+    # importing nscsurf imports the DDE client, which is not needed to
+    # handle snapshots
+    from nscsurf import read_objects
+    surfs = list(surfs)
+    counts = conn.req_batch(["GetNSCData,%d,0" % n for n in surfs])
+    params = range(1, num_params + 1)
+    objects = {}
+    for n, count in zip(surfs, counts):
+        count = int(float(count))
+        if count:
+            objects[n] = read_objects(conn, n, range(1, count + 1),
+                                      [params] * count)
+    return objects
+
+
+def read_prescription(conn, solves=True, objects=True, extra=False):
+    """Take a snapshot of the prescription in the server memory.
+
+    The solves and the non-sequential objects are read unless `solves`
+    or `objects` are false.  The extra data of the surfaces (all
+    Prescription.num_extra columns of each) are only read if `extra` is
+    true.
+    """
+    numsurfs, p = read_system_prescription(conn)
+    num_extra = Prescription.num_extra if extra else 0
+    p.surfaces = read_surfaces(conn, range(numsurfs + 1), num_extra=num_extra)
+    if objects:
+        p.objects = read_nsc_objects(conn, nsc_surfaces(p.surfaces))
+    if solves:
+        p.solves = read_solves(conn, range(numsurfs + 1))
+    return p
+
+
+def read_system_prescription(conn):
+    """Read the prescription without its surfaces.
+
+    Returns (number of surfaces, Prescription with no surfaces).
+    """
+    numsurfs, system = read_system(conn)
+    field_type, fields = read_fields(conn)
+    primary_wave, wavelengths = read_wavelengths(conn)
+    current_config, configs = read_configs(conn)
+    return numsurfs, Prescription([], system, field_type, fields,
+                                  primary_wave, wavelengths, current_config,
+                                  configs)
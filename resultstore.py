@@ -0,0 +1,127 @@
+# Resumable on-disk storage of the results of long runs.
+#
+# A store is a directory holding a table of float results, with one row
+# per trial (or design point), split into chunks of rows saved as .npy
+# files.  Each chunk has a mask of the rows which are done.  The mask
+# of a row is only set on disk after its values have been flushed, so
+# that a run which is interrupted can be resumed by evaluating the
+# pending rows.
+
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+class ResultStore(object):
+    def __init__(self, path, rows, columns, chunk_rows=4096, flush_every=64):
+        """Open the store at `path`, creating it if it does not exist.
+
+        An existing store must have the same shape.
+        """
+        self.path = path
+        self.rows = rows
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.flush_every = flush_every
+        self._chunks = {}
+        self._unflushed = {}
+
+        shape_path = os.path.join(path, "shape.npy")
+        shape = np.array([rows, columns, chunk_rows])
+        if os.path.exists(shape_path):
+            stored = np.load(shape_path)
+            if not np.array_equal(stored, shape):
+                raise ValueError("Store at %s has shape %s, not %s" %
+                                 (path, tuple(stored), tuple(shape)))
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            np.save(shape_path, shape)
+
+    def _chunk_path(self, chunk, name):
+        return os.path.join(self.path, "%s-%05d.npy" % (name, chunk))
+
+    def _chunk(self, chunk, create=False):
+        """Return the (values, done) memmaps of a chunk, or None if the
+        chunk does not exist and create is false."""
+        if chunk in self._chunks:
+            return self._chunks[chunk]
+        values_path = self._chunk_path(chunk, "values")
+        done_path = self._chunk_path(chunk, "done")
+        if os.path.exists(done_path):
+            arrays = (open_memmap(values_path, "r+"),
+                      open_memmap(done_path, "r+"))
+        elif create:
+            n = int(min(self.chunk_rows,
+                        self.rows - chunk * self.chunk_rows))
+            values = open_memmap(values_path, "w+", np.float64,
+                                 (n, self.columns))
+            values[:] = np.nan
+            values.flush()
+            # the mask is created last, marking the chunk as complete
+            done = open_memmap(done_path, "w+", np.bool_, (n,))
+            done.flush()
+            arrays = (values, done)
+        else:
+            return None
+        self._chunks[chunk] = arrays
+        return arrays
+
+    @property
+    def num_chunks(self):
+        return -(-self.rows // self.chunk_rows)
+
+    @property
+    def done(self):
+        """Mask of the rows which are done, as flushed to disk."""
+        done = np.zeros(self.rows, bool)
+        for chunk in range(self.num_chunks):
+            arrays = self._chunk(chunk)
+            if arrays is not None:
+                start = chunk * self.chunk_rows
+                done[start:start+len(arrays[1])] = arrays[1]
+        return done
+
+    def pending(self):
+        """Indices of the rows which are not done."""
+        return np.flatnonzero(~self.done)
+
+    def write(self, row, values):
+        chunk, i = divmod(int(row), self.chunk_rows)
+        self._chunk(chunk, create=True)[0][i] = values
+        self._unflushed.setdefault(chunk, []).append(i)
+        if sum(len(v) for v in self._unflushed.values()) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for chunk, rows in self._unflushed.items():
+            values, done = self._chunks[chunk]
+            values.flush()
+            done[rows] = True
+            done.flush()
+        self._unflushed = {}
+
+    def read(self, rows=None):
+        """Return the values of the rows (all rows by default).  Rows
+        which are not done hold NaN."""
+        table = np.empty((self.rows, self.columns))
+        table.fill(np.nan)
+        for chunk in range(self.num_chunks):
+            arrays = self._chunk(chunk)
+            if arrays is not None:
+                start = chunk * self.chunk_rows
+                values, done = arrays
+                table[start:start+len(done)][done] = values[done]
+        if rows is not None:
+            table = table[rows]
+        return table
+
+    def close(self):
+        self.flush()
+        self._chunks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,336 @@
+# The solves of the surfaces of a lens, read and written in bulk.
+#
+# Reading the solves through the surface parameters (see
+# UnknownSurface.fix_variables) costs a GetSolve request for each code
+# of each surface, and a SetSolve request for each change.  A SolveTable
+# reads the solves of all the surfaces with a single batch of requests,
+# and its bulk operations (fixing all variables, varying a selection,
+# redirecting pickups) write only the solves which change, in another
+# batch.
+#
+# A PickupGraph holds the dependencies of the pickup solves of a table,
+# so that the picked up values of a prescription (see prescription.py)
+# can be computed on the client after their sources are changed,
+# without a GetUpdate and a new snapshot.
+
+from __future__ import print_function
+import copy
+import numpy as np
+from prescription import solve_codes as codes
+
+# GetSolve codes run from curvature (0) to parameter 12.  Code 2 is the
+# glass, code 3 the semi-diameter and codes 5-16 are the surface
+# parameters 1-12 (see _solve_names in optimise.py).
+glass_code = 2
+semidia_code = 3
+
+variable_type = 1
+# solve types of a fixed value and of a pickup, which depend on the code
+fix_types = dict((code, 0) for code in codes)
+fix_types[semidia_code] = 1
+pickup_types = dict((code, 2) for code in codes)
+pickup_types.update({0: 4, 1: 5})
+
+solve_dtype = np.dtype([("type", "i4"), ("source", "i4"),
+                        ("scale", "f8"), ("offset", "f8"),
+                        ("column", "i4")])
+# type : solve type (see the Zemax manual, Solves >> Introduction)
+# source : for pickups, the surface from which the value is picked up
+# scale, offset : for pickups, value = scale * source value + offset
+# column :
+#     for pickups on surface parameters, the GetSolve code (plus one) of
+#     the source column.  0 for the same column.
+
+
+def _pickup_layout(code):
+    """Names of the fields following the source surface in the
+    arguments of a pickup solve."""
+    if code == 0:
+        return ("scale",)
+    elif code == 1:
+        return ("scale", "offset")
+    elif code == glass_code:
+        return ()
+    elif code in (semidia_code, 4):
+        return ("scale",)
+    # Solves on "parameters" seem to require the scale and offset
+    # reversed, contrary to the Zemax manual (see PickupFormat).
+    return ("offset", "scale", "column")
+
+
+def can_vary(code):
+    return code not in (glass_code, semidia_code)
+
+
+def parse_solve(code, response):
+    """Return the record (see solve_dtype) of a GetSolve response."""
+    fields = response.split(",")
+    record = np.zeros((), solve_dtype)
+    record["type"] = int(float(fields[0]))
+    record["scale"] = 1.0
+    if record["type"] == pickup_types[code] and len(fields) > 1:
+        record["source"] = int(float(fields[1]))
+        for name, value in zip(_pickup_layout(code), fields[2:]):
+            record[name] = float(value)
+    return record
+
+
+def pickup_args(code, source, scale=1.0, offset=0.0, column=0):
+    """Arguments of SetSolve (following the code) for a pickup solve."""
+    layout = _pickup_layout(code)
+    if scale != 1 and "scale" not in layout:
+        raise TypeError(
+            "Multiplication not applicable for this pickup solve type")
+    if offset != 0 and "offset" not in layout:
+        raise TypeError("Addition not applicable for this pickup solve type")
+    if column and "column" not in layout:
+        raise TypeError("Pickup solves on this parameter cannot "
+                        "dereference other columns")
+    values = {"scale": float(scale), "offset": float(offset),
+              "column": int(column)}
+    return [pickup_types[code], int(source)] + [values[name]
+                                                for name in layout]
+
+
+class SolveTable(object):
+    """Solves of the surfaces of the lens in the server.
+
+    The table is an array of records (see solve_dtype) of shape
+    (surfaces, codes), indexed by surface number and GetSolve code, and
+    the responses are kept as read, for solves other than fixed values,
+    variables and pickups.
+    """
+    def __init__(self, conn, numsurfs=None):
+        self.conn = conn
+        self.read(numsurfs)
+
+    def read(self, numsurfs=None):
+        """Read the solves of all the surfaces, with a single batch."""
+        if numsurfs is None:
+            numsurfs = self.conn.GetSystem()[0]
+        self.table = np.zeros((numsurfs + 1, len(codes)), solve_dtype)
+        requests = ["GetSolve,%d,%d" % (n, code)
+                    for n in range(numsurfs + 1) for code in codes]
+        responses = self.conn.req_batch(requests)
+        self.responses = np.array(responses, object).reshape(
+            self.table.shape)
+        for (n, code), response in np.ndenumerate(self.responses):
+            self.table[n, code] = parse_solve(code, response)
+
+    def __len__(self):
+        return len(self.table)
+
+    def variable_mask(self):
+        """Boolean array of the variable parameters (surfaces, codes)."""
+        mask = self.table["type"] == variable_type
+        mask[:, glass_code] = False
+        mask[:, semidia_code] = False
+        return mask
+
+    def variables(self):
+        """List of (surface, code) of the variable parameters."""
+        return [tuple(int(i) for i in index)
+                for index in np.argwhere(self.variable_mask())]
+
+    def pickups(self):
+        """List of (surface, code) of the pickup solves."""
+        types = np.array([pickup_types[code] for code in codes])
+        return [tuple(int(i) for i in index)
+                for index in np.argwhere(self.table["type"] == types)]
+
+    def write(self, changes):
+        """Set solves with a single batch of requests.
+
+        changes :
+            sequence of ((surface, code), args), where args are the
+            arguments of SetSolve following the code
+        Returns the number of requests sent.
+        """
+        changes = list(changes)
+        requests = [self.conn.build_req("SetSolve", n, code, *args)
+                    for ((n, code), args) in changes]
+        responses = self.conn.req_batch(requests)
+        for ((n, code), args), response in zip(changes, responses):
+            # SetSolve responds with the data of the solve, as GetSolve
+            if not response:
+                response = ",".join(str(a) for a in args)
+            self.responses[n, code] = response
+            self.table[n, code] = parse_solve(code, response)
+        return len(requests)
+
+    def fix(self, selection=None):
+        """Fix the variables among the selected (surface, code), or all
+        variables by default.  Returns the number of requests sent."""
+        if selection is None:
+            selection = self.variables()
+        mask = self.variable_mask()
+        return self.write(((n, code), [fix_types[code]])
+                          for (n, code) in selection if mask[n, code])
+
+    def vary(self, selection):
+        """Make the selected (surface, code) variable.  Parameters which
+        are already variable are not written."""
+        changes = []
+        for n, code in sorted(set(selection)):
+            if not can_vary(code):
+                raise ValueError("Solve code %d cannot be varied" % code)
+            if self.table[n, code]["type"] != variable_type:
+                changes.append(((n, code), [variable_type]))
+        return self.write(changes)
+
+    def set_pickup(self, n, code, source, scale=1.0, offset=0.0, column=0):
+        return self.write([((n, code), pickup_args(code, source, scale,
+                                                   offset, column))])
+
+    def replace_pickups(self, sources):
+        """Redirect pickup solves to other surfaces.
+
+        sources :
+            dict of the new source surface keyed by the old
+        Scales, offsets and columns are kept.  Returns the number of
+        requests sent.
+        """
+        changes = []
+        for n, code in self.pickups():
+            record = self.table[n, code]
+            source = int(record["source"])
+            if source in sources and sources[source] != source:
+                changes.append(((n, code), pickup_args(
+                    code, sources[source], record["scale"],
+                    record["offset"], record["column"])))
+        return self.write(changes)
+
+    def graph(self):
+        """Return the PickupGraph of the table."""
+        return PickupGraph(self)
+
+
+class PickupCycleError(ValueError):
+    pass
+
+
+def surface_value(surface, code):
+    """Value of a SurfaceData (see prescription.py) with a GetSolve
+    code."""
+    if code == 0:
+        return surface.curvature
+    elif code == 1:
+        return surface.thickness
+    elif code == glass_code:
+        return surface.glass
+    elif code == semidia_code:
+        return surface.semidia
+    elif code == 4:
+        return surface.conic
+    return surface.parameters[code - 4]
+
+
+def replace_value(surface, code, value):
+    """Return a SurfaceData with the value of a GetSolve code replaced."""
+    names = {0: "curvature", 1: "thickness", glass_code: "glass",
+             semidia_code: "semidia", 4: "conic"}
+    if code in names:
+        return surface._replace(**{names[code]: value})
+    parameters = list(surface.parameters)
+    parameters[code - 4] = value
+    return surface._replace(parameters=tuple(parameters))
+
+
+class PickupGraph(object):
+    """Dependencies between the parameters of a lens due to pickup
+    solves.
+
+    Parameters are identified by (surface, GetSolve code).  Each pickup
+    has a single source, so the dependencies form trees rooted at
+    parameters which are not picked up, unless the pickups form a
+    cycle.
+    """
+    def __init__(self, table):
+        table = getattr(table, "table", table)
+        types = np.array([pickup_types[code] for code in codes])
+        # pickup : (source parameter, scale, offset)
+        self.pickups = {}
+        self.dependents = {}
+        for n, code in np.argwhere(table["type"] == types):
+            n, code = int(n), int(code)
+            record = table[n, code]
+            column = int(record["column"])
+            source = (int(record["source"]), column - 1 if column else code)
+            self.pickups[n, code] = (source, float(record["scale"]),
+                                     float(record["offset"]))
+            self.dependents.setdefault(source, []).append((n, code))
+
+    def _depths(self):
+        """Return the number of pickups between each pickup and the
+        root of its tree, or raise PickupCycleError."""
+        depths = {}
+        for start in self.pickups:
+            chain = []
+            node = start
+            while node in self.pickups and node not in depths:
+                if node in chain:
+                    cycle = chain[chain.index(node):]
+                    raise PickupCycleError(
+                        "Pickup solves form a cycle: %s" % cycle, cycle)
+                chain.append(node)
+                node = self.pickups[node][0]
+            depth = depths.get(node, 0)
+            for node in reversed(chain):
+                depth += 1
+                depths[node] = depth
+        return depths
+
+    def cycles(self):
+        """Return the list of the cycles of pickups (each a list of
+        parameters)."""
+        cycles = []
+        seen = set()
+        for start in self.pickups:
+            chain = []
+            node = start
+            while node in self.pickups and node not in seen:
+                seen.add(node)
+                chain.append(node)
+                node = self.pickups[node][0]
+            if node in chain:
+                cycles.append(chain[chain.index(node):])
+        return cycles
+
+    def affected(self, changed):
+        """Set of the pickups which depend on the changed parameters,
+        directly or through other pickups."""
+        affected = set()
+        stack = list(changed)
+        while stack:
+            for node in self.dependents.get(stack.pop(), ()):
+                if node not in affected:
+                    affected.add(node)
+                    stack.append(node)
+        return affected
+
+    def order(self, changed=None):
+        """Return the pickups in an order in which they can be evaluated
+        (each after its source), or only those affected by the changed
+        parameters.  Raises PickupCycleError if the pickups form a
+        cycle."""
+        depths = self._depths()
+        nodes = self.pickups if changed is None else self.affected(changed)
+        return sorted(nodes, key=lambda node: (depths[node], node))
+
+    def evaluate(self, prescription, changed=None):
+        """Return a copy of a Prescription in which the picked up values
+        are computed from their sources.
+
+        changed :
+            parameters whose values have changed.  By default all the
+            pickups are evaluated.
+        """
+        p = copy.copy(prescription)
+        p.surfaces = list(prescription.surfaces)
+        for n, code in self.order(changed):
+            (source_n, source_code), scale, offset = self.pickups[n, code]
+            value = surface_value(p.surfaces[source_n], source_code)
+            if code != glass_code:
+                value = scale * value + offset
+            p.surfaces[n] = replace_value(p.surfaces[n], code, value)
+        return p
@@ -0,0 +1,187 @@
+# Surrogate models for expensive evaluations.
+#
+# SurrogateCache wraps a function of the parameter values (typically a
+# merit function or operand evaluation made by the server) and keeps
+# every evaluation.  A query at a point which was evaluated is answered
+# from the cache.  Otherwise, if the surrogate is enabled and enough
+# evaluations lie within the trust radius, a local model is fitted to
+# them.  The model answers the query if its leave-one-out error
+# (the error in predicting each of the neighbours from the others) is
+# within the tolerance, and the server is called otherwise.
+
+from __future__ import print_function
+import numpy as np
+from optimise import CriteriaEvaluator
+
+
+def _polynomial_terms(x, degree):
+    """Columns of a polynomial basis of the given degree (1 or 2) at the
+    points x, of shape (N, d)."""
+    n, d = x.shape
+    terms = [np.ones(n)] + [x[:, i] for i in range(d)]
+    if degree == 2:
+        terms.extend(x[:, i] * x[:, j]
+                     for i in range(d) for j in range(i, d))
+    return np.array(terms).T
+
+
+def rbf_fit(x, y):
+    """Fit a cubic radial basis function interpolant, with a linear
+    polynomial tail, to the values y at the points x.
+
+    Returns (predict, loo_errors), where predict(x) evaluates the
+    interpolant and loo_errors are the leave-one-out errors at the
+    points, of the same shape as y.
+    """
+    n, d = x.shape
+    phi = np.sqrt(((x[:, np.newaxis] - x[np.newaxis]) ** 2).sum(-1)) ** 3
+    p = _polynomial_terms(x, 1)
+    m = p.shape[1]
+    a = np.zeros((n + m, n + m))
+    a[:n, :n] = phi
+    a[:n, n:] = p
+    a[n:, :n] = p.T
+    inverse = np.linalg.inv(a)
+    rhs = np.zeros((n + m,) + y.shape[1:])
+    rhs[:n] = y
+    coeffs = np.dot(inverse, rhs)
+    # Rippa's formula for the leave-one-out errors of an interpolant
+    # (prediction less value, as for quadratic_fit)
+    diagonal = np.diag(inverse)[:n].reshape((n,) + (1,) * (y.ndim - 1))
+    loo_errors = -coeffs[:n] / diagonal
+
+    def predict(points):
+        points = np.atleast_2d(points)
+        r = np.sqrt(((points[:, np.newaxis] - x[np.newaxis]) ** 2).sum(-1))
+        basis = np.hstack([r ** 3, _polynomial_terms(points, 1)])
+        return np.dot(basis, coeffs)
+    return predict, loo_errors
+
+
+def quadratic_fit(x, y):
+    """Least squares fit of a quadratic polynomial (see rbf_fit)."""
+    p = _polynomial_terms(x, 2)
+    if len(x) <= p.shape[1]:
+        raise np.linalg.LinAlgError("Too few points for a quadratic fit")
+    coeffs, _, rank, _ = np.linalg.lstsq(p, y, rcond=-1)
+    if rank < p.shape[1]:
+        raise np.linalg.LinAlgError("Points do not determine a quadratic")
+    # leave-one-out (PRESS) residuals from the hat matrix
+    hat = np.einsum("ij,ji->i", p, np.linalg.pinv(p))
+    hat = hat.reshape((len(x),) + (1,) * (y.ndim - 1))
+    loo_errors = (np.dot(p, coeffs) - y) / (1 - hat)
+
+    def predict(points):
+        return np.dot(_polynomial_terms(np.atleast_2d(points), 2), coeffs)
+    return predict, loo_errors
+
+
+class SurrogateCache(object):
+    """Cache of evaluations which answers nearby queries from a local
+    surrogate model.
+
+    evaluate :
+        function of an array of parameter values, returning a number
+        or an array of values (NaN where the lens cannot be traced)
+    trust_radius :
+        evaluations within this distance of the query are used to fit
+        the model
+    tolerance :
+        largest leave-one-out error accepted, for each value
+    scale :
+        parameter values are divided by `scale` before distances are
+        measured
+    method :
+        "rbf" (rbf_fit) or "quadratic" (quadratic_fit)
+    max_points :
+        number of nearest evaluations used to fit the model
+    """
+    fits = {"rbf": rbf_fit, "quadratic": quadratic_fit}
+
+    def __init__(self, evaluate, trust_radius, tolerance, scale=1.0,
+                 method="rbf", max_points=30, enabled=True):
+        self.evaluate = evaluate
+        self.trust_radius = trust_radius
+        self.tolerance = tolerance
+        self.scale = scale
+        self.fit = self.fits[method]
+        self.max_points = max_points
+        self.enabled = enabled
+        self.points = []
+        self.values = []
+        self.queries = 0
+        self.exact_hits = 0
+        self.surrogate_hits = 0
+        self.server_calls = 0
+        self.error_estimate = None
+
+    def add(self, x, values):
+        """Add an evaluation made elsewhere to the cache."""
+        self.points.append(np.array(x, float))
+        self.values.append(np.asarray(values, float))
+
+    def __call__(self, x):
+        x = np.array(x, float)
+        self.queries += 1
+        self.error_estimate = None
+        if self.points:
+            points = np.array(self.points) / self.scale
+            distance = np.sqrt(((points - x / self.scale) ** 2).sum(1))
+            nearest = np.argmin(distance)
+            if distance[nearest] == 0:
+                self.exact_hits += 1
+                self.error_estimate = 0.0
+                return self.values[nearest]
+            if self.enabled:
+                values = self._predict(x / self.scale, points, distance)
+                if values is not None:
+                    self.surrogate_hits += 1
+                    return values
+
+        self.server_calls += 1
+        values = np.asarray(self.evaluate(x), float)
+        self.add(x, values)
+        return values
+
+    def _predict(self, x, points, distance):
+        """Return the surrogate's prediction, or None if it is not
+        trusted."""
+        near = np.flatnonzero(distance <= self.trust_radius)
+        near = near[np.argsort(distance[near])][:self.max_points]
+        near = [i for i in near if not np.isnan(self.values[i]).any()]
+        if len(near) < len(x) + 2:
+            return None
+        values = np.array([self.values[i] for i in near])
+        try:
+            predict, loo_errors = self.fit(points[near], values)
+        except np.linalg.LinAlgError:
+            return None
+        error = abs(loo_errors).max(0)
+        self.error_estimate = error
+        if np.any(error > self.tolerance):
+            return None
+        return predict(x)[0]
+
+    @property
+    def hit_rate(self):
+        """Fraction of queries answered without calling the server."""
+        if not self.queries:
+            return 0.0
+        return float(self.exact_hits + self.surrogate_hits) / self.queries
+
+    @property
+    def calls_avoided(self):
+        return self.exact_hits + self.surrogate_hits
+
+
+def cached_criteria(conn, params, criteria, trust_radius, tolerance,
+                    **kwargs):
+    """Return a SurrogateCache of the criteria (see CriteriaEvaluator)
+    as functions of the values of the parameters.
+
+    For example, the merit function of the server is cached with
+    criteria=[lambda conn: conn.Optimize(-1)].
+    """
+    evaluator = CriteriaEvaluator(conn, params, criteria)
+    return SurrogateCache(lambda x: evaluator.evaluate(conn, x),
+                          trust_radius, tolerance, **kwargs)
@@ -0,0 +1,188 @@
+# Parameter sweeps and designs of experiments.
+#
+# A design is an array of points, of shape (N, number of parameters).
+# Grids are ordered so that consecutive points differ in a single
+# parameter (a reflected mixed-radix Gray code, which snakes through
+# the grid), and the sweep only writes the parameters which change, so
+# a grid of N points costs about N parameter writes.  Latin hypercube
+# and Sobol designs fill a box with fewer points.
+#
+# Results are saved in a ResultStore (see resultstore.py), so that an
+# interrupted sweep resumes with the pending points.
+
+from __future__ import print_function
+import numpy as np
+from optimise import CriteriaEvaluator
+from pool import LocalPool
+from resultstore import ResultStore
+
+
+def gray_order(shape):
+    """Return the grid indices of a reflected Gray code, of shape
+    (N, len(shape)).  Consecutive rows differ by one in one index."""
+    shape = tuple(shape)
+    i = np.arange(int(np.prod(shape)))
+    indices = np.empty((len(i), len(shape)), int)
+    stride = len(i)
+    for k, n in enumerate(shape):
+        # position in the sequence of the more significant indices
+        prefix = i // stride
+        stride //= n
+        digit = (i // stride) % n
+        indices[:, k] = np.where(prefix % 2, n - 1 - digit, digit)
+    return indices
+
+
+def grid(levels):
+    """Design of all combinations of the levels of each parameter.
+
+    levels :
+        sequence of the values of each parameter
+    """
+    levels = [np.asarray(values, float) for values in levels]
+    indices = gray_order([len(values) for values in levels])
+    return np.array([values[indices[:, k]]
+                     for (k, values) in enumerate(levels)]).T
+
+
+def _scale(unit, bounds):
+    bounds = np.asarray(bounds, float)
+    return bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+
+def latin_hypercube(n, bounds, seed=0):
+    """Latin hypercube design of n points.
+
+    bounds :
+        (low, high) of each parameter
+    """
+    rng = np.random.RandomState(seed)
+    unit = np.empty((n, len(bounds)))
+    for k in range(len(bounds)):
+        unit[:, k] = (rng.permutation(n) + rng.uniform(size=n)) / n
+    return _scale(unit, bounds)
+
+
+# Primitive polynomials and initial direction numbers of dimensions 2-8
+# (S. Joe and F. Y. Kuo, "Constructing Sobol sequences with better
+# two-dimensional projections", SIAM J. Sci. Comput. 30, 2008).
+# (degree s, coefficients a, m_1..m_s)
+_sobol_directions = [
+    (1, 0, (1,)),
+    (2, 1, (1, 3)),
+    (3, 1, (1, 3, 1)),
+    (3, 2, (1, 1, 1)),
+    (4, 1, (1, 1, 3, 3)),
+    (4, 4, (1, 3, 5, 13)),
+    (5, 2, (1, 1, 5, 5, 17))]
+_sobol_bits = 30
+
+
+def _direction_integers(dim):
+    bits = _sobol_bits
+    v = np.zeros(bits + 1, np.int64)
+    if dim == 0:
+        for k in range(1, bits + 1):
+            v[k] = 1 << (bits - k)
+        return v
+    s, a, m = _sobol_directions[dim - 1]
+    for k in range(1, s + 1):
+        v[k] = m[k-1] << (bits - k)
+    for k in range(s + 1, bits + 1):
+        v[k] = v[k-s] ^ (v[k-s] >> s)
+        for j in range(1, s):
+            if (a >> (s - 1 - j)) & 1:
+                v[k] ^= v[k-j]
+    return v
+
+
+def sobol(n, bounds, skip=0):
+    """Sobol design of n points (unscrambled, starting from point
+    `skip` of the sequence).  At most 8 parameters are supported.
+
+    bounds :
+        (low, high) of each parameter
+    """
+    dims = len(bounds)
+    if dims > len(_sobol_directions) + 1:
+        raise ValueError("Sobol designs support at most %d parameters" %
+                         (len(_sobol_directions) + 1))
+    directions = [_direction_integers(d) for d in range(dims)]
+    x = np.zeros(dims, np.int64)
+    unit = np.empty((skip + n, dims))
+    for i in range(skip + n):
+        unit[i] = x
+        # index of the lowest zero bit of i
+        c = 1
+        j = i
+        while j & 1:
+            j >>= 1
+            c += 1
+        for d in range(dims):
+            x[d] ^= directions[d][c]
+    return _scale(unit[skip:] / 2.0 ** _sobol_bits, bounds)
+
+
+def _blocks(indices, size):
+    return [indices[i:i+size] for i in range(0, len(indices), size)]
+
+
+def run_sweep(conn, params, points, criteria, path, pool=None,
+              block_size=None, progress=None):
+    """Evaluate the criteria at the points of a design.
+
+    params :
+        Parameter instances
+    points :
+        design, of shape (N, len(params))
+    criteria :
+        Operand specifications or functions (see CriteriaEvaluator)
+    path :
+        directory of the ResultStore.  Each row holds a point followed
+        by the values of its criteria.  If the store exists, only the
+        pending points are evaluated.
+    pool :
+        Pool on which points are evaluated.  Consecutive points are
+        evaluated in blocks on the same connection, to keep the saving
+        of the design order.  A ConnectionPool is only of use with
+        workers on separate servers (see pool.py), each holding a copy
+        of the lens (see pool.copy_lens_setup).
+    progress :
+        function called as progress(num_done, num_points) after each
+        block
+
+    Returns the criteria, of shape (N, number of criteria).  The
+    parameters are restored on `conn`.
+    """
+    points = np.asarray(points, float)
+    criteria = list(criteria)
+    if pool is None:
+        pool = LocalPool(conn)
+    evaluator = CriteriaEvaluator(conn, params, criteria)
+    num_params = len(evaluator.params)
+
+    def run(worker_conn, block):
+        return [evaluator.evaluate(worker_conn, points[i]) for i in block]
+
+    with ResultStore(path, len(points), num_params + len(criteria)) as store:
+        done = store.done
+        if not np.array_equal(store.read(done)[:, :num_params],
+                              points[done]):
+            raise ValueError("Store at %s holds a different design" % path)
+        pending = store.pending()
+        if block_size is None:
+            block_size = max(1, min(64, len(pending) // (4 * pool.size)))
+        blocks = _blocks(pending, block_size)
+        num_done = len(points) - len(pending)
+        try:
+            for index, results in pool.as_completed(run, blocks):
+                for i, values in zip(blocks[index], results):
+                    store.write(i, np.concatenate([points[i], values]))
+                num_done += len(results)
+                if progress is not None:
+                    progress(num_done, len(points))
+        finally:
+            evaluator.restore(conn)
+        store.flush()
+        table = store.read()
+    return table[:, num_params:]
@@ -9,14 +9,36 @@
 
 from __future__ import print_function
 import zemaxclient
-from zemaxclient import Connection, SurfaceLabelError
+from zemaxclient import Connection, SurfaceLabelError, PushScheduler
 from libzmx import (SurfaceSequence, return_to_coordinate_frame,
-                    SystemConfig, make_singlet, NamedElements)
+                    SystemConfig, make_singlet, NamedElements,
+                    transform_rays)
 import libzmx
 import surface
+import nscsurf
+import frames
+import optimise
+import tolerance
+import sweep
+import surrogate
+from resultstore import ResultStore
+import zrd
+import zmxfile
+import glasscat
+import glasssub
+import solves
+import modelhash
+from analysiscache import AnalysisCache
+from pool import ConnectionPool, LocalPool
+import prescription
+from prescription import (read_prescription, Prescription, SurfaceData,
+                          SystemData)
 import unittest
 import numpy
 import os
+import shutil
+import struct
+import threading
 import time
 import tempfile
 from itertools import count
@@ -321,6 +343,56 @@ class SurfaceSequenceManipulate(unittest.TestCase):
 
         self.verifyIdentical()
 
+    def testInsertMany(self):
+        comments = ["Inserted %d" % i for i in range(5)]
+        surfs = self.model.insert_many(1, [
+            (surface.Standard, {"comment": c}) for c in comments])
+        self._list[1:1] = comments
+        self.verifyIdentical()
+        self.assertEqual([s.get_surf_num() for s in surfs], list(range(1, 6)))
+        self.assertEqual(self.model.labels(),
+                         [self.z.GetLabel(i) for i in range(7)])
+
+        pickup = surfs[0].thickness.linked()
+        cb = self.model.insert_many(-1, [
+            surface.Standard,
+            (surface.CoordinateBreak, {"comment": "cb", "rotate_x": 5.0,
+                                       "thickness": pickup})])[1]
+        self._list[-1:-1] = ["", "cb"]
+        self.verifyIdentical()
+        self.assertEqual(cb.__class__, surface.CoordinateBreak)
+        self.assertAlmostEqual(cb.rotate_x.value, 5.0)
+        surfs[0].thickness = 3.0
+        self.z.GetUpdate()
+        self.assertAlmostEqual(cb.thickness.value, 3.0)
+
+    def testSlices(self):
+        comments = ["Inserted %d" % i for i in range(6)]
+        self.model.insert_many(1, [(surface.Standard, {"comment": c})
+                                   for c in comments])
+        self._list[1:1] = comments
+
+        self.assertEqual([s.comment.value for s in self.model[2:5]],
+                         self._list[2:5])
+
+        del self.model[2:4]
+        del self._list[2:4]
+        self.verifyIdentical()
+
+        self.model[1:3] = [(surface.Standard, {"comment": "new"})]
+        self._list[1:3] = ["new"]
+        self.verifyIdentical()
+
+        self.model[2:2] = [(surface.Standard, {"comment": "empty slice"})]
+        self._list[2:2] = ["empty slice"]
+        self.verifyIdentical()
+
+        self.assertRaises(IndexError, self.model.__delitem__, slice(0, 2))
+        self.assertRaises(IndexError, self.model.__delitem__, slice(-2, None))
+        self.model.clear()
+        self._list[1:-1] = []
+        self.verifyIdentical()
+
     def testIndexing(self):
         new_surf = self.model.insert_new(1, surface.Grating, "Inserted 1")
         indexed_surf = self.model[1]
@@ -540,6 +612,70 @@ class SetSurfacePickups(unittest.TestCase):
         self.assertAlmostEqual(cb1.rotate_x.value, cb1.rotate_y.value)
 
 
+class SolveTableBatch(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        model = SurfaceSequence(self.z)
+        self.s1 = model.insert_new(1, surface.Standard, curvature=0.01,
+                                   thickness=5.0)
+        self.s2 = model.insert_new(-1, surface.Standard, thickness=3.0)
+        self.s3 = model.insert_new(-1, surface.Standard, curvature=-0.02,
+                                   thickness=7.0)
+        self.cb1 = model.insert_new(-1, surface.CoordinateBreak,
+                                    rotate_x=12.0)
+        self.cb2 = model.insert_new(-1, surface.CoordinateBreak)
+        self.model = model
+
+    def testScan(self):
+        self.s1.curvature.vary()
+        self.s3.thickness.vary()
+        self.cb1.rotate_x.vary()
+        self.s2.curvature = 2 * self.s1.curvature.linked()
+        self.s2.thickness = self.s1.thickness.linked() + 1.0
+        self.cb2.rotate_x = 3 * self.cb1.rotate_x.linked()
+        numbers = [s.get_surf_num() for s in
+                   (self.s1, self.s2, self.s3, self.cb1, self.cb2)]
+        n1, n2, n3, ncb1, ncb2 = numbers
+
+        table = solves.SolveTable(self.z)
+        self.assertEqual(len(table), self.z.GetSystem()[0] + 1)
+        rotate_x = self.cb1.rotate_x.solve_code
+        self.assertEqual(table.variables(),
+                         sorted([(n1, 0), (n3, 1), (ncb1, rotate_x)]))
+        self.assertEqual(table.pickups(),
+                         sorted([(n2, 0), (n2, 1), (ncb2, rotate_x)]))
+        curvature = table.table[n2, 0]
+        self.assertEqual((curvature["source"], curvature["scale"]),
+                         (n1, 2.0))
+        thickness = table.table[n2, 1]
+        self.assertEqual((thickness["source"], thickness["scale"],
+                          thickness["offset"]), (n1, 1.0, 1.0))
+        rotation = table.table[ncb2, rotate_x]
+        self.assertEqual((rotation["source"], rotation["scale"]),
+                         (ncb1, 3.0))
+
+        # only the changed solves are written
+        self.assertEqual(table.vary([(n1, 0), (n2, 4)]), 1)
+        self.assertEqual(table.fix(), 4)
+        self.assertEqual(table.variables(), [])
+        self.assertEqual(solves.SolveTable(self.z).variables(), [])
+
+        # redirect the pickups of s1 to s3
+        self.assertEqual(table.replace_pickups({n1: n3}), 2)
+        self.z.GetUpdate()
+        self.assertAlmostEqual(self.s2.curvature.value, -0.04)
+        self.assertAlmostEqual(self.s2.thickness.value, 8.0)
+        self.assertEqual(solves.SolveTable(self.z).table[n2, 1]["source"],
+                         n3)
+
+    def testFixVariables(self):
+        self.s1.curvature.vary()
+        self.s1.thickness.vary()
+        self.assertEqual(self.s1.fix_variables(), [0, 1])
+        self.assertEqual(optimise.find_variables(self.model), [])
+
+
 class NamedSurfaces(unittest.TestCase):
     def testTagging(self):
         z = Connection()
@@ -669,6 +805,170 @@ class Optimisation(unittest.TestCase):
         self.assertEqual(0, len(s.fix_variables()))
 
 
+class ClientOptimisation(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        model = SurfaceSequence(self.z, empty=True)
+        self.z.SetSystemAper(0, 1, 10.0)
+        self.front = model.insert_new(1, surface.Standard, glass="BK7",
+                                      thickness=5.0, curvature=0.02)
+        self.back = model.insert_new(2, surface.Standard, curvature=-0.01)
+        self.back.thickness.focus_on_next()
+        self.model = model
+        self.operands = [optimise.Operand("EFFL", (0, 1), 80.0)]
+
+    def testFindVariables(self):
+        self.front.curvature.vary()
+        self.back.thickness.vary()
+        variables = optimise.find_variables(self.model)
+        self.assertEqual([(p.surface.get_surf_num(), p.solve_code)
+                          for p in variables], [(1, 0), (2, 1)])
+
+    def testOptimise(self):
+        self.front.curvature.vary()
+        variables = optimise.find_variables(self.model)
+        result = optimise.optimise(self.z, variables, self.operands)
+        self.assertTrue(result.merit < 1e-6)
+        self.assertTrue(result.merit < result.initial_merit)
+        (effl,) = optimise.evaluate_operands(self.z, self.operands)
+        self.assertAlmostEqual(effl, 80.0, 5)
+        self.assertAlmostEqual(self.front.curvature.value, result.values[0])
+
+    def testSensitivity(self):
+        self.front.curvature.vary()
+        self.back.curvature.vary()
+        start = self.front.curvature.value
+        operands = self.operands + [optimise.Operand("TTHI", (1, 2))]
+        forward = optimise.sensitivity_matrix(self.model, operands)
+        central = optimise.sensitivity_matrix(self.model, operands,
+                                              central=True)
+        self.assertEqual(forward.matrix.shape, (2, 2))
+        self.assertEqual(forward.variables, ["1:curvature", "2:curvature"])
+        self.assertEqual(forward.operands, ["EFFL(0,1)", "TTHI(1,2)"])
+        # focal length decreases with the power of either surface
+        self.assertTrue(central.matrix[0, 0] < 0)
+        self.assertTrue(central.matrix[0, 1] > 0)
+        self.assertTrue(abs(forward.matrix - central.matrix).max() <
+                        1e-3 * abs(central.matrix).max())
+        self.assertAlmostEqual(self.front.curvature.value, start)
+
+    def testNoVariables(self):
+        self.assertRaises(ValueError, optimise.sensitivity_matrix,
+                          self.model, self.operands)
+        self.assertRaises(ValueError, optimise.sensitivity_matrix, [],
+                          self.operands)
+
+    def testMonteCarlo(self):
+        tolerances = [
+            tolerance.Tolerance(self.front.curvature,
+                                tolerance.Normal(0.0005)),
+            tolerance.Tolerance(self.front.thickness,
+                                tolerance.Uniform(-0.2, 0.2))]
+        criteria = [optimise.Operand("EFFL", (0, 1))]
+        nominal = optimise.evaluate_operands(self.z, criteria)[0]
+        path = tempfile.mkdtemp()
+        done = []
+
+        def interrupt(trial, row, statistics):
+            done.append(trial)
+            if len(done) == 10:
+                raise KeyboardInterrupt()
+        try:
+            self.assertRaises(KeyboardInterrupt, tolerance.monte_carlo,
+                              self.z, tolerances, criteria, 30, path,
+                              limits=[(nominal - 1, nominal + 1)],
+                              progress=interrupt)
+            # the run resumes with the remaining trials
+            statistics = tolerance.monte_carlo(
+                self.z, tolerances, criteria, 30, path,
+                limits=[(nominal - 1, nominal + 1)],
+                progress=lambda *args: done.append(args[0]))
+            self.assertEqual(sorted(done), list(range(30)))
+            self.assertEqual(statistics.trials, 30)
+            self.assertTrue(0 < statistics.yield_fraction <= 1)
+            self.assertTrue(statistics.std[0] > 0)
+        finally:
+            shutil.rmtree(path)
+        # the nominal lens is restored
+        self.assertAlmostEqual(
+            optimise.evaluate_operands(self.z, criteria)[0], nominal)
+
+    def testSweep(self):
+        params = [self.front.thickness, self.front.curvature]
+        points = sweep.grid([[4.0, 5.0, 6.0], [0.018, 0.02, 0.022]])
+        criteria = [optimise.Operand("EFFL", (0, 1))]
+        path = tempfile.mkdtemp()
+        try:
+            results = sweep.run_sweep(self.z, params, points, criteria, path)
+            self.assertEqual(results.shape, (9, 1))
+            self.assertFalse(numpy.isnan(results).any())
+            # the same point gives the same result
+            self.front.thickness = 6.0
+            self.front.curvature = 0.018
+            self.assertAlmostEqual(
+                optimise.evaluate_operands(self.z, criteria)[0],
+                results[points.tolist().index([6.0, 0.018]), 0])
+            # a completed sweep is read from the store
+            calls = []
+            again = sweep.run_sweep(self.z, params, points, criteria, path,
+                                    progress=lambda *args: calls.append(1))
+            self.assertEqual(calls, [])
+            self.assertTrue(numpy.array_equal(again, results))
+            self.assertRaises(ValueError, sweep.run_sweep, self.z, params,
+                              points[::-1], criteria, path)
+        finally:
+            shutil.rmtree(path)
+
+    def testCachedMerit(self):
+        self.z.SetOperand(1, 1, "EFFL")
+        self.z.SetOperand(1, 8, 80.0)
+        self.z.SetOperand(1, 9, 1.0)
+        cache = surrogate.cached_criteria(
+            self.z, [self.front.curvature, self.front.thickness],
+            [lambda conn: conn.Optimize(-1)], trust_radius=2.0,
+            tolerance=0.05, scale=[0.001, 0.1], method="quadratic")
+        for c, t in sweep.grid([[0.019, 0.02, 0.021], [4.9, 5.0, 5.1]]):
+            cache([c, t])
+        self.assertEqual(cache.server_calls, 9)
+        value = cache([0.0201, 5.02])
+        self.assertEqual(cache.server_calls, 9)
+        self.front.curvature = 0.0201
+        self.front.thickness = 5.02
+        self.assertTrue(abs(value - self.z.Optimize(-1)) < 0.05)
+
+    def testCompareWithServer(self):
+        self.front.curvature.vary()
+        start = self.front.curvature.value
+        variables = optimise.find_variables(self.model)
+        comparison = optimise.compare_with_server(self.z, variables,
+                                                  self.operands)
+        self.assertTrue(comparison.server_merit < 1e-3)
+        self.assertTrue(comparison.speedup > 0)
+        # the starting lens is restored
+        self.assertAlmostEqual(self.front.curvature.value, start)
+
+    def testGlassSubstitution(self):
+        glasses = glasscat.load_catalogs(glasscat.catalog_directory(self.z),
+                                         ["SCHOTT"])
+        self.front.glass = "N-BK7"
+        self.z.SetWavelengthsCount(2, 3)
+        for n, wave in enumerate([0.486, 0.588, 0.656], 1):
+            self.z.SetWave(n, wave)
+        self.front.curvature.vary()
+        optimise.write_merit_function(self.z, self.operands)
+        best = []
+        # the workers of a ConnectionPool would share the server lens
+        results = glasssub.substitute_glasses(
+            self.z, glasses, [1], top_k=4, pool=LocalPool(self.z), cycles=5,
+            progress=lambda result, b: best.append(b))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(best[-1], results[0])
+        merits = [r.merit for r in results]
+        self.assertEqual(merits, sorted(merits))
+        self.assertEqual(self.front.glass.value, "N-BK7")
+
+
 def build_coord_break_sequence(model):
     s = model[0]
     s.thickness.value = 1
@@ -812,6 +1112,40 @@ class CoordinateReturn(unittest.TestCase):
         self.z.GetUpdate()
         self.coord_return_common_tests(return_surf)
 
+    def testBatched(self):
+        # the batched insertion creates the same surfaces as a factory
+        specs = libzmx.coordinate_return_specs(self.model, self.first,
+                                               self.last)
+        n = len(self.model)
+        return_surf = return_to_coordinate_frame(self.model, self.first,
+                                                 self.last)
+        self.assertEqual(len(self.model), n + len(specs))
+        self.assertEqual(return_surf, self.last + len(specs))
+        batched = [self.z.GetSurfaceData(i, 1)
+                   for i in range(self.last + 1, return_surf + 1)]
+
+        del self.model[self.last + 1:return_surf + 1]
+        return_surf = return_to_coordinate_frame(
+            self.model, self.first, self.last,
+            factory=lambda: self.model.append_new(surface.CoordinateBreak))
+        self.assertEqual(batched,
+                         [self.z.GetSurfaceData(i, 1)
+                          for i in range(self.last + 1, return_surf + 1)])
+        self.z.GetUpdate()
+        self.coord_return_common_tests(return_surf)
+
+    def testNothingToUndo(self):
+        first = self.model.append_new(surface.Standard).get_surf_num()
+        last = self.model.append_new(surface.Standard).get_surf_num()
+        n = len(self.model)
+        for factory in (None, lambda: self.model.append_new(
+                surface.CoordinateBreak)):
+            return_surf = return_to_coordinate_frame(
+                self.model, first, last, include_null_transforms=False,
+                factory=factory)
+            self.assertEqual(return_surf, last)
+            self.assertEqual(len(self.model), n)
+
     def testWithAppend(self):
         def factory():
             return self.model.append_new(surface.CoordinateBreak)
@@ -861,6 +1195,88 @@ class ChangeGlobalReferenceSurface(unittest.TestCase):
             last = surf
 
 
+class FrameComposition(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        self.model = SurfaceSequence(self.z, empty=True)
+        self.first, self.last = build_coord_break_sequence(self.model)
+        self.system = SystemConfig(self.z)
+
+    def compare_frames(self):
+        self.z.GetUpdate()
+        local = frames.prescription_frames(read_prescription(self.z))
+        server = self.model.global_frames()
+        self.assertEqual(local.shape, server.shape)
+        self.assertAlmostEqual(abs(local - server).max(), 0, 6)
+
+    def testComposition(self):
+        self.compare_frames()
+
+    def testGlobalReference(self):
+        for i in (self.first, self.last):
+            self.system.globalrefsurf = i
+            self.compare_frames()
+
+    def testCoordinateReturn(self):
+        for code in (1, 2, 3):
+            cb = self.model.append_new(surface.CoordinateBreak,
+                                       thickness=7.0)
+            cb.rotate_x = 12.0
+            self.z.SetSurfaceData(cb.get_surf_num(), 81, self.first)
+            self.z.SetSurfaceData(cb.get_surf_num(), 80, code)
+            self.compare_frames()
+
+    def testPickups(self):
+        return_surf = return_to_coordinate_frame(self.model, self.first,
+                                                 self.last)
+        self.z.GetUpdate()
+        p = read_prescription(self.z)
+        graph = solves.SolveTable(self.z).graph()
+        # change the sources of the pickups and evaluate them locally
+        cb = self.first + 1
+        parameters = list(p.surfaces[cb].parameters)
+        parameters[1] += 1.5
+        parameters[3] -= 20.0
+        p.surfaces[cb] = p.surfaces[cb]._replace(
+            thickness=p.surfaces[cb].thickness + 3.0,
+            parameters=tuple(parameters))
+        changed = [(cb, 1), (cb, 5), (cb, 7)]
+        local = graph.evaluate(p, changed)
+        self.assertTrue(graph.order(changed))
+
+        self.z.SetSurfaceData(cb, 3, p.surfaces[cb].thickness)
+        self.z.SetSurfaceParameter(cb, 1, parameters[1])
+        self.z.SetSurfaceParameter(cb, 3, parameters[3])
+        self.z.GetUpdate()
+        server = read_prescription(self.z)
+        for n in range(cb, return_surf + 1):
+            self.assertAlmostEqual(local.surfaces[n].thickness,
+                                   server.surfaces[n].thickness)
+            for a, b in zip(local.surfaces[n].parameters,
+                            server.surfaces[n].parameters):
+                self.assertAlmostEqual(a, b)
+        self.assertAlmostEqual(
+            abs(frames.prescription_frames(local) -
+                self.model.global_frames()).max(), 0, 6)
+
+    def testSweep(self):
+        inputs = frames.frame_inputs(read_prescription(self.z))
+        cb = self.first + 1
+        angles = numpy.linspace(-10.0, 10.0, 5)
+        breaks = numpy.repeat(inputs["breaks"][numpy.newaxis],
+                              len(angles), 0)
+        breaks[:, cb, frames.ROTATE_Y] = angles
+        inputs["breaks"] = breaks
+        swept = frames.compose_frames(**inputs)
+
+        for angle, local in zip(angles, swept):
+            self.model[cb].rotate_y = angle
+            self.z.GetUpdate()
+            server = self.model.global_frames()
+            self.assertAlmostEqual(abs(local - server).max(), 0, 6)
+
+
 class ConfigureSystemParameters(unittest.TestCase):
     # numsurfs = SystemParameter(0, int)
     # unitcode = SystemParameter(1, int)
@@ -1011,17 +1427,8 @@ class RayCoordinates(unittest.TestCase):
         reference of each surface by applying the inverse of the new
         global reference."""
 
-        def trans_mat(rotation, offset):
-            m = numpy.zeros((4, 4), float)
-            m[0:3, 0:3] = rotation
-            m[0:3, 3] = offset
-            m[3, 3] = 1.0
-            return numpy.matrix(m)
-
         surf_ids = range(len(self.model))
-        initial_global_ref = self.system.globalrefsurf
-        initial_surface_coord_frames = [
-            trans_mat(*self.z.GetGlobalMatrix(i)) for i in surf_ids]
+        initial_surface_coord_frames = self.model.global_frames().copy()
 
         for i in surf_ids:
             if isinstance(self.model[i], surface.CoordinateBreak):
@@ -1031,15 +1438,51 @@ class RayCoordinates(unittest.TestCase):
 
             self.system.globalrefsurf = i
             # find inverse transformation
-            trans = initial_surface_coord_frames[i].I
+            trans = numpy.linalg.inv(initial_surface_coord_frames[i])
 
             self.z.GetUpdate()
-            for j in surf_ids:
-                new_frame = trans_mat(*self.z.GetGlobalMatrix(j))
-                # calc_frame = numpy.dot(trans,
-                #     initial_surface_coord_frames[j])
-                calc_frame = trans * initial_surface_coord_frames[j]
-                self.assertAlmostEqual(abs(new_frame - calc_frame).max(), 0)
+            new_frames = self.model.global_frames()
+            calc_frames = numpy.matmul(trans, initial_surface_coord_frames)
+            self.assertAlmostEqual(abs(new_frames - calc_frames).max(), 0)
+
+    def testCachedFrames(self):
+        frames = self.model.global_frames()
+        self.assertEqual(frames.shape, (len(self.model), 4, 4))
+        for i, frame in enumerate(frames):
+            rotation, offset = self.z.GetGlobalMatrix(i)
+            self.assertAlmostEqual(abs(frame[:3, :3] - rotation).max(), 0)
+            self.assertAlmostEqual(abs(frame[:3, 3] - offset).max(), 0)
+
+        # the frames are cached while the lens is unmodified
+        self.assertTrue(frames is self.model.global_frames())
+        self.model[0].thickness = 20.0
+        new_frames = self.model.global_frames()
+        self.assertFalse(frames is new_frames)
+        self.assertNotAlmostEqual(abs(frames - new_frames).max(), 0)
+
+    def testTransformRayBundle(self):
+        pcs = [(0.3, 0.5), (0.0, 0.0), (-0.2, 0.7)]
+        frames = self.model.global_frames()
+        for surf in self.model:
+            n = surf.get_surf_num()
+            rays = [surf.get_ray_intersect((0, 0), pc) for pc in pcs]
+            intersect = numpy.array([ray.intersect for ray in rays])
+            cosines = numpy.array([ray.exit_cosines for ray in rays])
+            gl_intersect, gl_cosines, normal = transform_rays(
+                frames[n], intersect, cosines)
+            self.assertTrue(normal is None)
+            for pc, gl_int, gl_cos in zip(pcs, gl_intersect, gl_cosines):
+                glray = surf.get_ray_intersect((0, 0), pc, _global=True)
+                self.assertAlmostEqual(abs(glray.intersect - gl_int).max(),
+                                       0, self.tracing_accuracy)
+                self.assertAlmostEqual(abs(glray.exit_cosines - gl_cos).max(),
+                                       0, self.tracing_accuracy)
+
+            # the inverse transformation recovers the local vectors
+            loc_intersect, loc_cosines, normal = transform_rays(
+                frames[n], gl_intersect, gl_cosines, inverse=True)
+            self.assertAlmostEqual(abs(loc_intersect - intersect).max(), 0)
+            self.assertAlmostEqual(abs(loc_cosines - cosines).max(), 0)
 
     def testCheckRayTraceResults(self):
         pc = (0.3, 0.5)  # normalised pupil coordinate under test
@@ -1120,6 +1563,1453 @@ class ZemaxTextOutput(unittest.TestCase):
             first = next(f).strip()
         self.assertEqual(u"System/Prescription Data", first)
 
+    def testCache(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            with AnalysisCache(path) as cache:
+                text = cache.text(self.z, "Pre")
+                self.assertEqual(u"System/Prescription Data",
+                                 text.splitlines()[0])
+                requests = []
+                req = self.z.req
+                self.z.req = lambda *args: requests.append(args) or req(*args)
+                try:
+                    self.assertEqual(cache.text(self.z, "Pre"), text)
+                finally:
+                    del self.z.req
+                self.assertEqual(requests, [])
+                # a change to the lens misses the cache
+                self.z.SetSurfaceData(1, 3, 10.0)
+                self.assertEqual(cache.hits, 1)
+                cache.text(self.z, "Pre")
+                self.assertEqual(cache.hits, 1)
+        finally:
+            os.remove(path)
+
+
+def make_dvr_text(data):
+    """Generate detector viewer text output listing the array."""
+    ny, nx = data.shape
+    lines = ["Listing of Detector Viewer Data", "", "File : C:\\test.zmx",
+             "Title: ", "", "Detector 3, NSCG Surface 1: ",
+             "Size 10.000 W X 8.000 H Millimeters, Pixels %d W X %d H, "
+             "Total Hits = 12345" % (nx, ny), "",
+             "Peak Irradiance : %.4E Watts/cm^2" % data.max(),
+             "Total Power     : %.4E Watts" % data.sum(), "",
+             "Data Type : Incoherent Irradiance", "",
+             "\t" + "\t".join(str(i+1) for i in range(nx))]
+    for i, row in enumerate(data):
+        lines.append("%d\t" % (i + 1) + "\t".join("%.6E" % v for v in row))
+    return "\n".join(lines) + "\n"
+
+
+class DetectorTextParsing(unittest.TestCase):
+    def setUp(self):
+        self.data = numpy.random.rand(3, 5).astype(numpy.float32)
+        self.text = make_dvr_text(self.data)
+
+    def testParse(self):
+        data, info = nscsurf.parse_detector_text(self.text)
+        self.assertEqual(data.shape, (3, 5))
+        self.assertAlmostEqual(abs(data - self.data).max(), 0, 5)
+        self.assertEqual(info.pixels, (5, 3))
+        self.assertEqual(info.size, (10.0, 8.0))
+        self.assertEqual(info.units, "Millimeters")
+        self.assertEqual(info.hits, 12345)
+        self.assertAlmostEqual(info.total, self.data.sum(), 3)
+        self.assertEqual(info.data_type, "Incoherent Irradiance")
+
+    def testOutputArray(self):
+        out = numpy.zeros((3, 5))
+        data, info = nscsurf.parse_detector_text(self.text, out)
+        self.assertTrue(data is out)
+        self.assertAlmostEqual(abs(out - self.data).max(), 0, 5)
+
+    def testMemoryMapped(self):
+        (fd, path) = tempfile.mkstemp(".dat")
+        os.close(fd)
+        data, info = nscsurf.parse_detector_text(self.text, path)
+        self.assertTrue(isinstance(data, numpy.memmap))
+        self.assertAlmostEqual(abs(data - self.data).max(), 0, 5)
+        del data
+        os.remove(path)
+
+    def testIncomplete(self):
+        truncated = self.text[:self.text.rindex("\n", 0, -1)]
+        self.assertRaises(ValueError, nscsurf.parse_detector_text, truncated)
+
+
+def write_detector_file(path, pixels, half_widths=(5.0, 4.0), align=False):
+    """Write a synthetic detector file in the format of SaveDetector.
+
+    pixels is a structured array of detector pixel records."""
+    header = numpy.zeros(1, nscsurf.detector_header_dtype)
+    header["version"] = 1
+    header["type"] = 1
+    header["i_data"][0, :2] = pixels.shape[::-1]
+    header["d_data"][0, :2] = half_widths
+    dtype = nscsurf.detector_pixel_dtypes[int(align)]
+    with open(path, "wb") as f:
+        header.tofile(f)
+        pixels.astype(dtype).tofile(f)
+
+
+class DetectorBinaryFile(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(".DDR")
+        os.close(fd)
+        self.pixels = numpy.zeros((3, 5), nscsurf.detector_pixel_dtypes[0])
+        for name in self.pixels.dtype.names:
+            self.pixels[name] = numpy.random.randint(0, 100, (3, 5))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def checkRead(self, align):
+        write_detector_file(self.path, self.pixels, align=align)
+        detector = nscsurf.DetectorFile(self.path)
+        self.assertTrue(isinstance(detector.pixels, numpy.memmap))
+        self.assertEqual(detector.pixels.shape, (3, 5))
+        for name in self.pixels.dtype.names:
+            self.assertTrue(numpy.all(detector.pixels[name] ==
+                                      self.pixels[name]), name)
+
+        info = detector.get_info("coherent_real")
+        self.assertEqual(info.pixels, (5, 3))
+        self.assertEqual(info.size, (10.0, 8.0))
+        self.assertEqual(info.units, "Millimeters")
+        self.assertEqual(info.hits, self.pixels["hits"].sum())
+        self.assertEqual(info.total, self.pixels["coherent_real"].sum())
+        del detector
+
+    def testPacked(self):
+        self.checkRead(False)
+
+    def testAligned(self):
+        self.checkRead(True)
+
+    def testTruncated(self):
+        write_detector_file(self.path, self.pixels)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(nscsurf.DetectorFormatError,
+                          nscsurf.DetectorFile, self.path)
+
+
+class FakeDetectorConnection(object):
+    """Saves synthetic detector files, whose pixels are given by a
+    function of the number of the save."""
+    def __init__(self, incoherent, error=0):
+        self.incoherent = incoherent
+        self.error = error
+        self.saves = []
+        self.traces = 0
+
+    def SaveDetector(self, surf, obj, filename):
+        self.saves.append(filename)
+        if self.error:
+            return self.error
+        pixels = numpy.zeros((3, 5), nscsurf.detector_pixel_dtypes[0])
+        pixels["incoherent"] = self.incoherent(len(self.saves))
+        pixels["hits"] = 1
+        write_detector_file(filename, pixels)
+        return 0
+
+    def GetTextFileString(self, type, settingspath=None, flag=0,
+                          timeout=None):
+        return make_dvr_text(numpy.ones((3, 5)))
+
+    def NSCDetectorData(self, surf, obj):
+        pass
+
+    def NSCTrace(self, **kwargs):
+        self.traces += 1
+
+
+class DetectorReading(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(".DDR")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testSaved(self):
+        conn = FakeDetectorConnection(lambda i: numpy.arange(15).reshape(3, 5))
+        data, info = nscsurf.read_detector(conn, 1, 3)
+        self.assertFalse(isinstance(data, numpy.memmap))
+        self.assertTrue(numpy.all(data == numpy.arange(15).reshape(3, 5)))
+        self.assertEqual(info.hits, 15)
+        self.assertTrue(os.path.isabs(conn.saves[0]))
+        self.assertFalse(os.path.exists(conn.saves[0]))
+
+        data, info = nscsurf.read_detector(conn, 1, 3, path=self.path)
+        self.assertTrue(isinstance(data, numpy.memmap))
+        self.assertEqual(conn.saves[-1], os.path.abspath(self.path))
+        del data
+
+    def testFailure(self):
+        # a stale file at the path is not read when the save fails
+        pixels = numpy.zeros((3, 5), nscsurf.detector_pixel_dtypes[0])
+        pixels["incoherent"] = 7.0
+        write_detector_file(self.path, pixels)
+        conn = FakeDetectorConnection(None, error=-1)
+        data, info = nscsurf.read_detector(conn, 1, 3, path=self.path)
+        self.assertAlmostEqual(abs(data - 1.0).max(), 0)
+        self.assertEqual(info.data_type, "Incoherent Irradiance")
+
+
+class ObjectTableRecords(unittest.TestCase):
+    def testObjectSpec(self):
+        objects = numpy.zeros(2, nscsurf.object_table_dtype(3))
+        objects[0]["type"] = "NSC_SLEN"
+        objects[0]["material"] = "n-bk7"
+        objects[0]["z"] = 10.0
+        objects[0]["tilt_x"] = 5.0
+        objects[0]["parameters"] = [50.0, 0.0, 5.0]
+        objects[1]["type"] = "NSC_DETE"
+        objects[1]["ref"] = 1
+        specs = [nscsurf.object_spec(obj) for obj in objects]
+        self.assertEqual(specs[0], nscsurf.ObjectSpec(
+            "NSC_SLEN", "", "N-BK7", (0.0, 0.0, 10.0, 5.0, 0.0, 0.0),
+            {1: 50.0, 2: 0.0, 3: 5.0}))
+        self.assertEqual(specs[1].ref, 1)
+        self.assertEqual(specs[1].position, (0.0,) * 6)
+
+
+def write_zrd(path, rays, version=2002):
+    """Write a synthetic uncompressed ZRD file.
+
+    rays is a list of structured arrays of ray segments."""
+    with open(path, "wb") as f:
+        f.write(zrd.zrd_header.pack(version, max(len(r) for r in rays)))
+        for ray in rays:
+            f.write(struct.pack("<i", len(ray)))
+            ray.astype(zrd.zrd_segment_dtype).tofile(f)
+
+
+def make_rays(n, seed=0):
+    """Generate rays with random numbers of segments and field values."""
+    rng = numpy.random.RandomState(seed)
+    rays = []
+    for i in range(n):
+        nseg = rng.randint(1, 6)
+        ray = numpy.zeros(nseg, zrd.zrd_segment_dtype)
+        ray["level"] = numpy.arange(nseg)
+        ray["parent"] = numpy.maximum(numpy.arange(nseg) - 1, 0)
+        ray["hit_object"] = rng.randint(0, 5, nseg)
+        ray["status"] = rng.randint(0, 64, nseg)
+        for name in ("x", "y", "z", "l", "m", "n", "intensity", "path_to"):
+            ray[name] = rng.rand(nseg)
+        rays.append(ray)
+    return rays
+
+
+class RayDatabaseReader(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(".ZRD")
+        os.close(fd)
+        self.rays = make_rays(500)
+        write_zrd(self.path, self.rays)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testHeader(self):
+        with zrd.ZRDReader(self.path) as reader:
+            self.assertEqual(reader.version, 2002)
+            self.assertEqual(reader.max_segments, 5)
+
+    def testChunks(self):
+        expected = numpy.concatenate(self.rays)
+        with zrd.ZRDReader(self.path) as reader:
+            chunks = list(reader.chunks(chunk_size=100))
+        self.assertTrue(len(chunks) > 1)
+        segments = numpy.concatenate(chunks)
+        self.assertEqual(len(segments), len(expected))
+        for name in zrd.zrd_segment_dtype.names:
+            self.assertTrue(numpy.all(segments[name] == expected[name]), name)
+        # check rays are complete within chunks, and numbered in order
+        ray_numbers = numpy.repeat(numpy.arange(len(self.rays)),
+                                   [len(r) for r in self.rays])
+        self.assertTrue(numpy.all(segments["ray"] == ray_numbers))
+        for chunk in chunks[1:]:
+            self.assertEqual(chunk["level"][0], 0)
+
+    def testIterRays(self):
+        with zrd.ZRDReader(self.path) as reader:
+            for expected, ray in zip(self.rays, reader):
+                self.assertTrue(numpy.all(ray["x"] == expected["x"]))
+                self.assertEqual(len(ray), len(expected))
+
+    def testReadAll(self):
+        segments = zrd.read_zrd(self.path)
+        self.assertEqual(len(segments), sum(len(r) for r in self.rays))
+
+    def testTruncated(self):
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 8)
+
+        def read():
+            with zrd.ZRDReader(self.path) as reader:
+                for chunk in reader.chunks():
+                    pass
+        self.assertRaises(zrd.ZRDFormatError, read)
+
+
+class RayDatabaseFilter(unittest.TestCase):
+    def setUp(self):
+        self.rays = make_rays(300)
+        segments = []
+        for i, ray in enumerate(self.rays):
+            chunk = numpy.zeros(len(ray), zrd.zrd_chunk_dtype)
+            for name in ray.dtype.names:
+                chunk[name] = ray[name]
+            chunk["ray"] = i
+            segments.append(chunk)
+        self.chunk = numpy.concatenate(segments)
+
+    def check(self, text, predicate):
+        mask = zrd.RayFilter(text).rays(self.chunk)
+        expected = [bool(predicate(ray)) for ray in self.rays]
+        self.assertEqual(list(mask), expected, text)
+
+    def testTerms(self):
+        self.check("H3", lambda r: (r["hit_object"] == 3).any())
+        self.check("M3", lambda r: not (r["hit_object"] == 3).any())
+        self.check("R2", lambda r: ((r["hit_object"] == 2) &
+                                    (r["status"] & zrd.REFLECTED != 0)).any())
+        self.check("G1", lambda r: ((r["hit_object"] == 1) &
+                                    (r["status"] & zrd.GHOST != 0)).any())
+        self.check("L3", lambda r: (r["level"] >= 3).any())
+
+    def testOperators(self):
+        def hit(r, n):
+            return (r["hit_object"] == n).any()
+        self.check("H1 & H2", lambda r: hit(r, 1) and hit(r, 2))
+        self.check("H1 | H2 & !H3",
+                   lambda r: hit(r, 1) or (hit(r, 2) and not hit(r, 3)))
+        self.check("(H1 | H2) & !H3",
+                   lambda r: (hit(r, 1) or hit(r, 2)) and not hit(r, 3))
+        self.check("H1 ^ H2", lambda r: hit(r, 1) != hit(r, 2))
+        self.check("!!h4", lambda r: hit(r, 4))
+
+    def testSyntaxErrors(self):
+        for text in ("H1 &", "(H1", "H1 H2", "Q1", "H"):
+            self.assertRaises(zrd.FilterSyntaxError, zrd.RayFilter, text)
+
+    def testFilterSegments(self):
+        chunks = [self.chunk[:400], self.chunk[400:]]
+        selected = numpy.concatenate(list(zrd.filter_rays(chunks, "H2")))
+        expected = [r for r in self.rays if (r["hit_object"] == 2).any()]
+        self.assertEqual(len(selected), sum(len(r) for r in expected))
+
+    def testPathBudget(self):
+        # rays have a single chain of segments (see make_rays)
+        expected = {}
+        for ray in self.rays:
+            path = tuple(int(obj) for obj in ray["hit_object"] if obj)
+            power, count = expected.get(path, (0.0, 0))
+            expected[path] = (power + ray["intensity"][-1], count + 1)
+
+        budget = zrd.path_budget([self.chunk])
+        self.assertEqual(sorted(budget), sorted(expected))
+        for path, (power, count) in expected.items():
+            self.assertAlmostEqual(budget[path][0], power)
+            self.assertEqual(budget[path][1], count)
+
+    def testPathBudgetTerminalObject(self):
+        budget = zrd.path_budget([self.chunk], "!G4", terminal_object=4)
+        total = sum(p for p, n in budget.values())
+        expected = 0.0
+        for ray in self.rays:
+            if ((ray["hit_object"] == 4) & (ray["status"] & zrd.GHOST != 0)
+                    ).any():
+                continue
+            expected += ray["intensity"][ray["hit_object"] == 4].sum()
+        self.assertAlmostEqual(total, expected)
+        for path in budget:
+            self.assertEqual(path[-1], 4)
+
+
+class NSCObjectTable(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        model = SurfaceSequence(self.z, empty=True)
+        self.nsc = model.insert_new(1, nscsurf.NonSequentialComponent)
+        spec = nscsurf.ObjectSpec
+        self.specs = [
+            spec("NSC_SR2A", "source", parameters={6: 1.0, 7: 2.0}),
+            spec("NSC_SLEN", "lens", "N-BK7", (0, 0, 10.0, 0, 0, 0),
+                 {1: 50.0, 3: 5.0, 5: 3.0, 8: 5.0}),
+            dict(type="NSC_DETE", comment="detector", ref=2,
+                 position=(0, 0, 50.0, 0, 0, 0), parameters=[2.0, 2.0])]
+
+    def tearDown(self):
+        self.z.GetUpdate()
+
+    def verifyTable(self):
+        specs = [nscsurf.object_spec(s) for s in self.specs]
+        self.assertEqual(len(self.nsc), len(specs))
+        params = sorted(set().union(*[s.parameters for s in specs]))
+        objects = self.nsc.read_objects(params=params)
+        for obj, spec in zip(objects, specs):
+            obj_params = dict((p, obj.parameters[p]) for p in spec.parameters)
+            self.assertEqual(obj._replace(parameters=obj_params), spec)
+
+    def testBuild(self):
+        self.nsc.set_objects(self.specs)
+        self.verifyTable()
+        # writing the same table changes nothing
+        self.assertEqual(self.nsc.set_objects(self.specs), 0)
+
+    def testUpdate(self):
+        self.nsc.set_objects(self.specs)
+        self.specs[1] = self.specs[1]._replace(comment="moved",
+                                               position=(0, 0, 20.0, 0, 0, 0))
+        self.assertEqual(self.nsc.set_objects(self.specs), 2)
+        self.verifyTable()
+
+        del self.specs[1]
+        self.nsc.set_objects(self.specs)
+        self.verifyTable()
+
+    def testSnapshot(self):
+        self.nsc.set_objects(self.specs)
+        objects, frames = self.nsc.snapshot(num_params=8)
+        self.assertEqual(list(objects["type"]),
+                         ["NSC_SR2A", "NSC_SLEN", "NSC_DETE"])
+        self.assertEqual(objects[1]["material"], "N-BK7")
+        self.assertEqual(objects[2]["ref"], 2)
+        self.assertAlmostEqual(objects[1]["z"], 10.0)
+        self.assertAlmostEqual(objects[1]["parameters"][0], 50.0)
+        self.assertEqual(frames.shape, (3, 4, 4))
+        n = self.nsc.get_surf_num()
+        for obj, frame in enumerate(frames, 1):
+            rotation, offset = self.z.GetNSCMatrix(n, obj)
+            self.assertAlmostEqual(abs(frame[:3, :3] - rotation).max(), 0)
+            self.assertAlmostEqual(abs(frame[:3, 3] - offset).max(), 0)
+
+    def testSnapshotRoundTrip(self):
+        self.nsc.set_objects(self.specs)
+        objects, frames = self.nsc.snapshot()
+        # the records of a snapshot are specifications of the objects
+        self.assertEqual(self.nsc.set_objects(objects), 0)
+        objects[1]["z"] = 20.0
+        self.assertEqual(self.nsc.set_objects(objects), 1)
+        self.assertAlmostEqual(self.nsc.snapshot()[0][1]["z"], 20.0)
+
+    def testInsert(self):
+        self.nsc.set_objects(self.specs[-1:])
+        slots = self.nsc.insert_objects(1, self.specs[:-1])
+        self.assertEqual(slots, [1, 2])
+        self.verifyTable()
+
+
+class ZmxFileTransfer(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        self.model = SurfaceSequence(self.z, empty=True)
+        build_coord_break_sequence(self.model)
+        self.z.GetUpdate()
+
+    def testLoad(self):
+        original = read_prescription(self.z)
+        self.z.NewLens()
+        zmxfile.load_prescription(self.z, original)
+        self.z.GetUpdate()
+        self.assertEqual(read_prescription(self.z).surfaces,
+                         original.surfaces)
+
+    def testExtraData(self):
+        s = self.model.insert_new(1, surface.Toroidal, thickness=2.0)
+        s.num_poly_terms = 2
+        s.norm_radius = 12.5
+        self.z.GetUpdate()
+        self.assertEqual(read_prescription(self.z).surfaces[1].extra, ())
+        snapshot = read_prescription(self.z, extra=True)
+        self.assertEqual(snapshot.surfaces[1].extra, ((1, 2.0), (2, 12.5)))
+
+        (fd, path) = tempfile.mkstemp(".ZMX")
+        os.close(fd)
+        try:
+            self.z.SaveFile(path)
+            parsed = zmxfile.read_zmx(path)
+        finally:
+            os.remove(path)
+        self.assertEqual([surf.extra for surf in parsed.surfaces],
+                         [surf.extra for surf in snapshot.surfaces])
+
+    def testAppend(self):
+        original = read_prescription(self.z, solves=False)
+        n = len(original)
+        zmxfile.load_prescription(self.z, original, append=n - 1)
+        self.assertTrue(self.z.GetSystem()[0] > n - 1)
+
+    def testSolves(self):
+        s = self.model.insert_new(1, surface.Standard, thickness=4.0)
+        t = self.model.insert_new(2, surface.Standard)
+        s.curvature.vary()
+        t.thickness = 2 * s.thickness.linked() + 1.0
+        s.semidia = 7.5
+        self.z.GetUpdate()
+        original = read_prescription(self.z)
+        self.assertRaises(ValueError, zmxfile.load_prescription, self.z,
+                          original, len(original) - 1)
+
+        self.z.NewLens()
+        zmxfile.load_prescription(self.z, original)
+        self.z.GetUpdate()
+        loaded = read_prescription(self.z)
+        self.assertEqual(loaded.solves, original.solves)
+        self.assertEqual(loaded.surfaces, original.surfaces)
+
+
+class ModelHashing(unittest.TestCase):
+    def setUp(self):
+        lines = ZmxFileParsing.text.splitlines()
+        self.p = zmxfile.parse_zmx(lines)
+        self.q = zmxfile.parse_zmx(lines)
+
+    def testCanonical(self):
+        h = modelhash.ModelHash(self.p)
+        self.assertEqual(h.hexdigest, modelhash.ModelHash(self.q).hexdigest)
+        self.assertEqual(len(h.hexdigest), 64)
+        # order of dict entries and sign of zero do not matter
+        mirror = self.q.objects[3][0]
+        self.q.objects[3][0] = mirror._replace(
+            parameters=dict(reversed(list(mirror.parameters.items()))))
+        self.q.surfaces[0] = self.q.surfaces[0]._replace(curvature=-0.0)
+        self.assertEqual(h.digest, modelhash.ModelHash(self.q).digest)
+
+    def testChanges(self):
+        h = modelhash.ModelHash(self.p).digest
+        changes = [
+            lambda p: p.surfaces.__setitem__(
+                1, p.surfaces[1]._replace(thickness=5.000000001)),
+            lambda p: p.objects[3].pop(),
+            lambda p: p.configs.pop(),
+            lambda p: setattr(p, "system", p.system._replace(stopsurf=2)),
+            lambda p: setattr(p, "solves", [()] * len(p.surfaces)),
+            lambda p: p.surfaces.__setitem__(
+                2, p.surfaces[2]._replace(extra=((1, 3.0),))),
+            lambda p: p.surfaces.append(p.surfaces[-1])]
+        for change in changes:
+            q = zmxfile.parse_zmx(ZmxFileParsing.text.splitlines())
+            change(q)
+            self.assertNotEqual(modelhash.ModelHash(q).digest, h)
+
+    def testIncremental(self):
+        h = modelhash.ModelHash(self.p)
+        surfaces = self.p.surfaces
+        for n in (4, 1, 2):
+            surfaces[n] = surfaces[n]._replace(comment="changed %d" % n)
+            digest = h.update(self.p, [n])
+            self.assertEqual(digest, modelhash.ModelHash(self.p).digest)
+        self.p.objects[3] = self.p.objects[3][:1]
+        self.assertEqual(h.update(self.p),
+                         modelhash.ModelHash(self.p).digest)
+        # leaves are combined in a tree
+        self.assertEqual(h.surface_digest(1),
+                         modelhash.ModelHash(self.p).surface_digest(1))
+        self.assertEqual(len(h._tree), 4)
+
+
+class ModelHashRefresh(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        self.model = SurfaceSequence(self.z, empty=True)
+        build_coord_break_sequence(self.model)
+        self.z.GetUpdate()
+
+    def testRefresh(self):
+        h = modelhash.ModelHash(read_prescription(self.z))
+        original = h.digest
+        s = self.model[2]
+        s.thickness = 11.0
+        self.assertEqual(h.refresh(self.z, [s.get_surf_num()]),
+                         modelhash.ModelHash(read_prescription(self.z)).digest)
+        self.assertNotEqual(h.digest, original)
+        # solves are part of the hash
+        changed = h.digest
+        s.thickness.vary()
+        self.assertNotEqual(h.refresh(self.z), changed)
+
+    def testExtraData(self):
+        n = self.model.insert_new(1, surface.Toroidal).get_surf_num()
+        h = modelhash.ModelHash(read_prescription(self.z, extra=True))
+        original = h.digest
+        digest = modelhash.model_hash(self.z, extra=True)
+        plain = modelhash.model_hash(self.z)
+        self.z.SetExtra(n, 2, 12.5)
+        self.assertNotEqual(h.refresh(self.z, [n], extra=True), original)
+        self.assertEqual(h.hexdigest, modelhash.model_hash(self.z, True))
+        self.assertNotEqual(modelhash.model_hash(self.z, True), digest)
+        # by default extra data are not read
+        self.assertEqual(modelhash.model_hash(self.z), plain)
+
+
+class GlassIndexValidation(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        self.glasses = glasscat.load_catalogs(
+            glasscat.catalog_directory(self.z), ["SCHOTT"])
+
+    def testGetIndex(self):
+        waves = [0.45, 0.55, 0.65, 1.06]
+        self.z.SetWavelengthsCount(1, len(waves))
+        for n, wave in enumerate(waves, 1):
+            self.z.SetWave(n, wave)
+        system = self.z.GetSystem()
+        adjust_index, temperature, pressure = system[5:8]
+        for name in ("N-BK7", "F2", "N-LASF9"):
+            self.z.SetSurfaceData(1, 4, name)
+            self.z.GetUpdate()
+            if adjust_index:
+                local = glasscat.refractive_index(
+                    [self.glasses[name]], waves, [temperature],
+                    pressure)[0, :, 0]
+            else:
+                local = glasscat.refractive_index([self.glasses[name]],
+                                                  waves)[0]
+            server = numpy.array(self.z.GetIndex(1))
+            self.assertAlmostEqual(abs(local - server).max(), 0, 6)
+
+
+class DetectorAccumulation(unittest.TestCase):
+    def testStatistics(self):
+        runs = numpy.random.rand(10, 4, 6) + 1.0
+        acc = nscsurf.DetectorAccumulator()
+        self.assertEqual(acc.noise(), numpy.inf)
+        for data in runs:
+            acc.add(data)
+        self.assertEqual(acc.runs, 10)
+        self.assertAlmostEqual(abs(acc.mean - runs.mean(0)).max(), 0)
+        self.assertAlmostEqual(abs(acc.variance - runs.var(0, ddof=1)).max(),
+                               0)
+        noise = numpy.sqrt(runs.var(0, ddof=1) / 10) / runs.mean(0)
+        self.assertAlmostEqual(acc.noise(0.0), noise.max())
+
+    def testDarkPixels(self):
+        acc = nscsurf.DetectorAccumulator()
+        for i in range(5):
+            data = numpy.ones((2, 2))
+            data[0, 0] = numpy.random.rand() * 1e-3
+            acc.add(data)
+        # the dark pixel is excluded from the noise estimate
+        self.assertAlmostEqual(acc.noise(0.1), 0)
+
+    def testMinRuns(self):
+        conn = FakeDetectorConnection(lambda i: 1.0)
+        estimate = nscsurf.accumulate_detector(conn, 1, 3, min_runs=4)
+        self.assertEqual(estimate.runs, 4)
+        self.assertEqual(conn.traces, 4)
+        self.assertEqual(estimate.noise, 0)
+        self.assertTrue(numpy.all(estimate.mean == 1.0))
+
+    def testMaxRuns(self):
+        conn = FakeDetectorConnection(
+            lambda i: numpy.random.rand(3, 5) + 1.0)
+        estimate = nscsurf.accumulate_detector(conn, 1, 3, target_noise=0,
+                                               max_runs=6)
+        self.assertEqual(estimate.runs, 6)
+        self.assertEqual(conn.traces, 6)
+        self.assertTrue(estimate.noise > 0)
+
+    def testTargetNoise(self):
+        runs = []
+
+        def incoherent(i):
+            runs.append(numpy.random.rand(3, 5) * 0.2 + 1.0)
+            return runs[-1]
+        conn = FakeDetectorConnection(incoherent)
+        estimate = nscsurf.accumulate_detector(conn, 1, 3, target_noise=0.02,
+                                               max_runs=1000)
+        self.assertTrue(estimate.noise <= 0.02)
+        self.assertTrue(3 <= estimate.runs < 1000)
+        # the runs stop as soon as the target is reached
+        acc = nscsurf.DetectorAccumulator()
+        for data in runs[:-1]:
+            acc.add(data)
+        self.assertTrue(acc.noise() > 0.02)
+        self.assertEqual(len(runs), estimate.runs)
+
+    def testPool(self):
+        conns = []
+
+        def factory():
+            conns.append(FakeDetectorConnection(lambda i: 1.0))
+            return conns[-1]
+        with ConnectionPool(2, factory=factory) as pool:
+            # the runs are drawn from an unbounded sequence
+            estimate = nscsurf.accumulate_detector(None, 1, 3, min_runs=5,
+                                                   pool=pool)
+        self.assertEqual(estimate.runs, 5)
+        traces = sum(conn.traces for conn in conns)
+        # no more than the runs in flight are traced after the break
+        self.assertTrue(5 <= traces <= 5 + 2 * pool.size)
+
+
+class WorkerPool(unittest.TestCase):
+    def testMap(self):
+        def task(conn, item):
+            return (conn, item * 2)
+        with ConnectionPool(3, factory=threading.current_thread) as pool:
+            results = pool.map(task, range(20))
+        self.assertEqual([r[1] for r in results], list(range(0, 40, 2)))
+        # tasks ran on the workers' connections
+        self.assertTrue(threading.current_thread() not in
+                        [r[0] for r in results])
+
+        pool = LocalPool("conn")
+        self.assertEqual(pool.map(task, [1]), [("conn", 2)])
+
+    def testUnbounded(self):
+        with ConnectionPool(2, factory=object) as pool:
+            for index, result in pool.as_completed(lambda c, i: i, count()):
+                if index > 10:
+                    break
+
+    def testErrors(self):
+        def fails(conn, item):
+            raise ValueError(item)
+        with ConnectionPool(2, factory=object) as pool:
+            self.assertRaises(ValueError, pool.map, fails, range(3))
+
+        def factory():
+            raise IOError()
+        with ConnectionPool(1, factory=factory) as pool:
+            self.assertRaises(IOError, pool.map, fails, range(3))
+
+    def testSharedServer(self):
+        class ServerConnection(object):
+            def __init__(self, server):
+                self.server = server
+                self.connected = True
+
+            def disconnect(self):
+                self.connected = False
+
+        conns = []
+
+        def factory(server="ZEMAX"):
+            conns.append(ServerConnection(server))
+            return conns[-1]
+        setups = []
+        self.assertRaises(ValueError, ConnectionPool, 2, factory,
+                          setups.append)
+        # the shared lens is left alone
+        self.assertEqual(setups, [])
+        self.assertFalse(any(conn.connected for conn in conns))
+
+        numbers = count()
+        with ConnectionPool(2, lambda: factory(next(numbers)),
+                            setups.append) as pool:
+            self.assertEqual(pool.map(lambda conn, i: i, range(4)),
+                             list(range(4)))
+        self.assertEqual(len(setups), 2)
+        # all connections reach the same server
+        self.assertEqual(GatedConnection().server, GatedConnection().server)
+
+
+class ResultStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "store")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testResume(self):
+        rows = numpy.random.rand(25, 3)
+        with ResultStore(self.path, 25, 3, chunk_rows=10,
+                         flush_every=4) as store:
+            for i in range(0, 25, 2):
+                store.write(i, rows[i])
+        store = ResultStore(self.path, 25, 3, chunk_rows=10)
+        self.assertEqual(list(store.pending()), list(range(1, 25, 2)))
+        table = store.read()
+        self.assertTrue(numpy.isnan(table[1::2]).all())
+        self.assertTrue(numpy.array_equal(table[::2], rows[::2]))
+        for i in store.pending():
+            store.write(i, rows[i])
+        store.close()
+        store = ResultStore(self.path, 25, 3, chunk_rows=10)
+        self.assertEqual(len(store.pending()), 0)
+        self.assertTrue(numpy.array_equal(store.read(), rows))
+
+    def testUnflushed(self):
+        store = ResultStore(self.path, 10, 2, flush_every=5)
+        for i in range(7):
+            store.write(i, (i, i))
+        # only flushed rows are marked as done
+        self.assertEqual(list(ResultStore(self.path, 10, 2).pending()),
+                         list(range(5, 10)))
+        store.close()
+
+    def testShapeMismatch(self):
+        ResultStore(self.path, 10, 2).close()
+        self.assertRaises(ValueError, ResultStore, self.path, 10, 3)
+
+
+class ToleranceStatistics(unittest.TestCase):
+    def testYield(self):
+        criteria = numpy.random.randn(200, 2)
+        criteria[5] = numpy.nan
+        statistics = tolerance.YieldStatistics(2, [(None, 1.0), (-1.0, 1.0)])
+        for row in criteria:
+            statistics.add(row)
+        traced = criteria[~numpy.isnan(criteria).any(1)]
+        passed = ((traced[:, 0] <= 1.0) & (abs(traced[:, 1]) <= 1.0)).sum()
+        self.assertEqual(statistics.trials, 200)
+        self.assertEqual(statistics.traced, 199)
+        self.assertAlmostEqual(statistics.yield_fraction, passed / 200.0)
+        self.assertAlmostEqual(abs(statistics.mean - traced.mean(0)).max(), 0)
+        self.assertAlmostEqual(
+            abs(statistics.std - traced.std(0, ddof=1)).max(), 0)
+        self.assertTrue(numpy.array_equal(statistics.maximum,
+                                          traced.max(0)))
+
+    def testPerturbations(self):
+        tolerances = [tolerance.Tolerance(None, tolerance.Normal(0.1)),
+                      tolerance.Tolerance(None, tolerance.Uniform(-1, 1))]
+        trials = [tolerance.trial_perturbations(tolerances, 7, i)
+                  for i in range(500)]
+        # trials are reproducible, and independent of order
+        self.assertTrue(numpy.array_equal(
+            trials[3], tolerance.trial_perturbations(tolerances, 7, 3)))
+        trials = numpy.array(trials)
+        self.assertTrue(abs(trials[:, 0]).max() <= 0.2)
+        self.assertTrue(abs(trials[:, 1]).max() <= 1.0)
+        self.assertFalse(numpy.array_equal(
+            trials[3], tolerance.trial_perturbations(tolerances, 8, 3)))
+
+
+class ExperimentDesigns(unittest.TestCase):
+    def testGrayOrder(self):
+        indices = sweep.gray_order((3, 2, 4))
+        self.assertEqual(len(set(map(tuple, indices))), 24)
+        # consecutive points differ by one step of one index
+        steps = abs(numpy.diff(indices, axis=0)).sum(1)
+        self.assertTrue((steps == 1).all())
+
+    def testGrid(self):
+        points = sweep.grid([[1, 2], [10, 20, 30]])
+        self.assertEqual(points.tolist(), [[1, 10], [1, 20], [1, 30],
+                                           [2, 30], [2, 20], [2, 10]])
+
+    def testLatinHypercube(self):
+        points = sweep.latin_hypercube(20, [(0, 1), (-5, 5)], seed=3)
+        self.assertEqual(points.shape, (20, 2))
+        # one point in each of the 20 intervals of each parameter
+        self.assertEqual(sorted(numpy.floor(points[:, 0] * 20)),
+                         list(range(20)))
+        self.assertEqual(sorted(numpy.floor((points[:, 1] + 5) * 2)),
+                         list(range(20)))
+
+    def testSobol(self):
+        points = sweep.sobol(8, [(0, 1), (0, 2)])
+        self.assertEqual(points[:4].tolist(),
+                         [[0, 0], [0.5, 1.0], [0.75, 0.5], [0.25, 1.5]])
+        points = sweep.sobol(64, [(0, 1)] * 8)
+        for column in points.T:
+            self.assertEqual(sorted(column * 64), list(range(64)))
+        self.assertTrue(numpy.array_equal(
+            sweep.sobol(4, [(0, 1)] * 3, skip=4), points[4:8, :3]))
+        self.assertRaises(ValueError, sweep.sobol, 4, [(0, 1)] * 9)
+
+
+class SurrogateModels(unittest.TestCase):
+    def function(self, x):
+        return numpy.array([1 + x[0]**2 + 0.5*x[0]*x[1] - x[1],
+                            numpy.sin(x[0])])
+
+    def testLeaveOneOut(self):
+        x = numpy.random.RandomState(1).uniform(-1, 1, (12, 2))
+        y = numpy.array([self.function(p) for p in x])
+        for fit in (surrogate.rbf_fit, surrogate.quadratic_fit):
+            predict, loo_errors = fit(x, y)
+            for i in range(len(x)):
+                others = numpy.arange(len(x)) != i
+                predict_i, _ = fit(x[others], y[others])
+                error = predict_i(x[i])[0] - y[i]
+                self.assertAlmostEqual(abs(error - loo_errors[i]).max(), 0)
+        # the rbf interpolates
+        predict, _ = surrogate.rbf_fit(x, y)
+        self.assertAlmostEqual(abs(predict(x) - y).max(), 0)
+
+    def testQuadratic(self):
+        x = numpy.random.RandomState(2).uniform(-1, 1, (10, 2))
+        y = numpy.array([self.function(p)[0] for p in x])
+        predict, loo_errors = surrogate.quadratic_fit(x, y)
+        self.assertAlmostEqual(abs(loo_errors).max(), 0)
+        self.assertAlmostEqual(predict([0.3, 0.4])[0],
+                               self.function([0.3, 0.4])[0])
+        self.assertRaises(numpy.linalg.LinAlgError,
+                          surrogate.quadratic_fit, x[:6], y[:6])
+
+    def testCache(self):
+        calls = []
+
+        def evaluate(x):
+            calls.append(x)
+            return self.function(x)
+        cache = surrogate.SurrogateCache(evaluate, 0.5, 0.02,
+                                         method="quadratic")
+        points = numpy.random.RandomState(0).uniform(-0.3, 0.3, (30, 2))
+        for p in points:
+            cache(p)
+        self.assertEqual(cache.server_calls, len(calls))
+        self.assertTrue(cache.surrogate_hits > 0)
+        self.assertEqual(cache.queries, 30)
+
+        # evaluated points are answered exactly
+        x = calls[-1]
+        self.assertTrue(numpy.array_equal(cache(x), self.function(x)))
+        self.assertEqual(cache.exact_hits, 1)
+        # surrogate answers are within the estimated error
+        value = cache([0.05, -0.02])
+        self.assertEqual(cache.server_calls, len(calls))
+        error = abs(value - self.function([0.05, -0.02]))
+        self.assertTrue((error <= 0.02).all())
+        # distant points are evaluated
+        cache([3.0, 3.0])
+        self.assertEqual(cache.server_calls, len(calls))
+        self.assertEqual(cache.calls_avoided, cache.queries - len(calls))
+        self.assertAlmostEqual(cache.hit_rate,
+                               cache.calls_avoided / float(cache.queries))
+
+        cache.enabled = False
+        cache([0.05, -0.02])
+        self.assertEqual(cache.server_calls, len(calls))
+        self.assertTrue(numpy.array_equal(calls[-1], [0.05, -0.02]))
+
+
+class ZmxFileParsing(unittest.TestCase):
+    text = u"""VERS 140404 5 3303
+MODE SEQ
+NAME A singlet
+UNIT MM X W X CM MR CPMM
+ENPD 1.0E+1
+ENVD 2.5E+1 1 0
+GLRS 1 0
+RAIM 0 1 1 1 0 0 0 0 0
+FTYP 0 0 2 2 0 0 0
+XFLN 0 0 0 0 0 0 0 0 0 0 0 0
+YFLN 0 5 0 0 0 0 0 0 0 0 0 0
+FWGN 1 2 1 1 1 1 1 1 1 1 1 1
+WAVM 1 0.55 1
+WAVM 2 0.65 0.5
+WAVM 3 0.55 1
+PWAV 2
+MNUM 2 1
+SURF 0
+  TYPE STANDARD
+  CURV 0.0 0 0 0 0 ""
+  DISZ INFINITY
+SURF 1
+  STOP
+  COMM Front \u00e9
+  CURV 2.0E-2 1 0 0 0 ""
+  GLAS N-BK7 0 0 1.5 40 0 0 0 0 0 0
+  DISZ 5
+  CONI -1
+  DIAM 6 1 0 0 1 ""
+SURF 2
+  TYPE COORDBRK
+  PARM 1 0.5
+  PARM 3 2
+  XDAT 1 0.25 0 0 0 0 0 0
+  CRTN 2 1
+  DISZ 0
+SURF 3
+  TYPE NONSEQCO
+  NSOB NSC_SSUR
+  NSOC a mirror
+  NSOP 0 0 1 0 5 0 1
+  NSOM MIRROR
+  NSOD 1 2.5
+  NSOI 1
+  NSOB NSC_DETE
+SURF 4
+  TYPE STANDARD
+BLNK
+TOL TOFF 0 0 0 0 0 0
+THIC 1 0 0
+Z 5.0 0 0 0 0 0 ""
+Z 6.0 0 0 0 0 0 ""
+GLSS 1 0 0
+Z N-BK7 0 0 0 0 0 ""
+Z F2 0 0 0 0 0 ""
+"""
+
+    def check(self, p):
+        self.assertEqual(len(p.surfaces), 5)
+        s0, s1, s2, s3, s4 = p.surfaces
+        self.assertEqual(s0.thickness, 1e10)
+        self.assertEqual(s1.type, "STANDARD")
+        self.assertEqual(s1.comment, u"Front \u00e9")
+        self.assertEqual(s1.curvature, 0.02)
+        self.assertEqual(s1.thickness, 5.0)
+        self.assertEqual(s1.glass, "N-BK7")
+        self.assertEqual(s1.conic, -1.0)
+        self.assertEqual(s1.semidia, 6.0)
+        self.assertEqual(s2.type, "COORDBRK")
+        self.assertEqual(s2.parameters[1], 0.5)
+        self.assertEqual(s2.parameters[3], 2.0)
+        self.assertEqual(s2.extra, ((1, 0.25),))
+        self.assertEqual(s2.coord_return, (2, 1))
+        self.assertEqual(s4.glass, "")
+
+        self.assertEqual(p.system.unitcode, 0)
+        self.assertEqual(p.system.stopsurf, 1)
+        self.assertEqual(p.system.aperture_type, 0)
+        self.assertEqual(p.system.aperture_value, 10.0)
+        self.assertEqual(p.system.temperature, 25.0)
+        self.assertEqual(p.system.rayaimingtype, 1)
+
+        self.assertEqual(len(p.fields), 2)
+        self.assertEqual(p.fields[1].y, 5.0)
+        self.assertEqual(p.fields[1].weight, 2.0)
+        self.assertEqual([w.wavelength for w in p.wavelengths],
+                         [0.55, 0.65])
+        self.assertEqual(p.primary_wave, 2)
+
+        self.assertEqual(p.current_config, 1)
+        self.assertEqual(len(p.configs), 2)
+        self.assertEqual(p.configs[0],
+                         ("THIC", (1, 0, 0), (5.0, 6.0)))
+        self.assertEqual(p.configs[1].values, ("N-BK7", "F2"))
+
+        self.assertEqual(sorted(p.objects), [3])
+        mirror, detector = p.objects[3]
+        self.assertEqual(mirror.type, "NSC_SSUR")
+        self.assertEqual(mirror.comment, "a mirror")
+        self.assertEqual(mirror.position, (0, 0, 1, 0, 5, 0))
+        self.assertEqual(mirror.ref, 1)
+        self.assertEqual(mirror.material, "MIRROR")
+        self.assertEqual(mirror.parameters, {1: 2.5})
+        self.assertEqual(mirror.ignore, 1)
+        self.assertEqual(detector.type, "NSC_DETE")
+
+    def testParse(self):
+        self.check(zmxfile.parse_zmx(self.text.splitlines()))
+
+    def testReadFile(self):
+        for encoding in ("utf-16", "latin-1"):
+            fd, path = tempfile.mkstemp(suffix=".zmx")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.text.encode(encoding))
+                p = zmxfile.read_zmx(path)
+            finally:
+                os.remove(path)
+            self.check(p)
+
+    def testWrite(self):
+        p = zmxfile.parse_zmx(self.text.splitlines())
+        self.assertEqual(zmxfile.parse_zmx(zmxfile.format_zmx(p)), p)
+        for encoding in ("utf-16", "latin-1"):
+            fd, path = tempfile.mkstemp(suffix=".zmx")
+            os.close(fd)
+            try:
+                zmxfile.write_zmx(p, path, encoding)
+                self.assertEqual(zmxfile.read_zmx(path), p)
+            finally:
+                os.remove(path)
+
+    def testWriteBuilt(self):
+        surfaces = [SurfaceData("STANDARD", "", 0.0, 1e10, "", 0.0, 0.0,
+                                (0.0,) * 13, (0, 0))]
+        for i in range(1, 50):
+            surfaces.append(SurfaceData(
+                "EVENASPH", "lens %d" % i, 1.0 / (3 * i), 0.1 * i,
+                "N-BK7" if i % 2 else "", 5.0, -0.5,
+                (0.0, 0.0, 1e-5 / 3, -2e-8) + (0.0,) * 9, (0, 0)))
+        p = Prescription(surfaces, SystemData(0, 3, 0, 0, 20.0, 1.0, 1,
+                                              1, 4.0))
+        p2 = zmxfile.parse_zmx(zmxfile.format_zmx(p))
+        self.assertEqual(p2, p)
+
+
+def count_lines(text):
+    return len(text.splitlines())
+
+
+class AnalysisCaching(unittest.TestCase):
+    class TextServer(object):
+        revision = 0
+
+        def __init__(self):
+            self.requests = []
+            self.traces = 0
+
+        def NSCTrace(self, *args):
+            self.traces += 1
+
+        def GetTextFileString(self, type, settingspath=None, flag=0,
+                              timeout=120000):
+            self.requests.append((type, settingspath, flag))
+            if type == "Dvr":
+                return make_dvr_text(
+                    numpy.arange(12.0).reshape(3, 4) + self.traces)
+            return u"%s analysis %d\n" % (type, len(self.requests)) * 100
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cache.sqlite")
+        self.server = self.TextServer()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testHits(self):
+        settings = os.path.join(self.dir, "spot.CFG")
+        with open(settings, "wb") as f:
+            f.write(b"settings 1")
+        with AnalysisCache(self.path) as cache:
+            first = cache.text(self.server, "Spt", model="a")
+            self.assertEqual(cache.text(self.server, "Spt", model="a"),
+                             first)
+            with cache.text_object(self.server, "Spt", model="a") as f:
+                self.assertEqual(f.read(), first)
+            self.assertEqual(len(self.server.requests), 1)
+            self.assertEqual(cache.hits, 2)
+            # the text is compressed
+            self.assertTrue(cache.size < len(first) / 4)
+
+            # a different lens, analysis or settings is a miss
+            cache.text(self.server, "Spt", model="b")
+            cache.text(self.server, "Pre", model="a")
+            cache.text(self.server, "Spt", settings, model="a")
+            self.assertEqual(len(self.server.requests), 4)
+            cache.text(self.server, "Spt", settings, model="a")
+            self.assertEqual(len(self.server.requests), 4)
+            with open(settings, "wb") as f:
+                f.write(b"settings 2")
+            cache.text(self.server, "Spt", settings, model="a")
+            self.assertEqual(len(self.server.requests), 5)
+
+            # parsed results are cached separately from the text
+            cache.text(self.server, "Pre", model="a")
+            self.assertEqual(len(self.server.requests), 5)
+            lines = cache.analysis(self.server, "Pre", parse=count_lines,
+                                   model="a")
+            self.assertEqual(lines, 100)
+            self.assertEqual(len(self.server.requests), 6)
+            self.assertEqual(cache.analysis(self.server, "Pre",
+                                            parse=count_lines, model="a"),
+                             lines)
+            self.assertEqual(len(self.server.requests), 6)
+
+        # the cache persists
+        with AnalysisCache(self.path) as cache:
+            self.assertEqual(len(cache), 6)
+            self.assertEqual(cache.text(self.server, "Spt", model="a"),
+                             first)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def testTraceAnalyses(self):
+        parse = nscsurf.parse_detector_text
+        with AnalysisCache(self.path) as cache:
+            data, info = cache.analysis(self.server, "Dvr", parse=parse,
+                                        model="a")
+            self.assertEqual(data[2, 3], 11.0)
+            # the same lens traced again has a different detector result
+            self.server.NSCTrace(1, 0)
+            data, info = cache.analysis(self.server, "Dvr", parse=parse,
+                                        model="a")
+            self.assertEqual(data[2, 3], 12.0)
+            self.assertEqual(cache.text(self.server, "Dvr", model="a"),
+                             self.server.GetTextFileString("Dvr"))
+            self.assertEqual(len(cache), 0)
+
+    def testEviction(self):
+        values = [numpy.random.RandomState(i).bytes(1000) for i in range(5)]
+        with AnalysisCache(self.path, max_bytes=3500, level=1) as cache:
+            for i in range(3):
+                cache.put(str(i), values[i])
+            # using the first result makes the second the oldest
+            cache.get("0")
+            cache.put("3", values[3])
+            self.assertEqual(len(cache), 3)
+            self.assertRaises(KeyError, cache.get, "1")
+            self.assertEqual(cache.get("0"), values[0])
+            self.assertTrue(cache.size <= 3500)
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+
+    def testKeys(self):
+        key = AnalysisCache.key
+        self.assertEqual(key("a", "Spt,0"), key("a", "Spt,0"))
+        self.assertNotEqual(key("a", "Spt,0"), key("aS", "pt,0"))
+        self.assertNotEqual(key("a", "Spt,0", b"x"), key("a", "Spt,0"))
+
+
+class CoordinateBreakMatrices(unittest.TestCase):
+    def testInverseBreak(self):
+        params = numpy.array([2.63, 753.3, 34, 42, 83, 0])
+        inverse = numpy.array([-2.63, -753.3, -34, -42, -83, 1])
+        m = frames.coordinate_break_matrices([params, inverse])
+        self.assertAlmostEqual(
+            abs(numpy.dot(m[0], m[1]) - numpy.eye(4)).max(), 0)
+
+
+class GlassCatalogs(unittest.TestCase):
+    agf = u"""CC Test catalog
+NM N-BK7 2 517642.251 1.5168 64.17 0 1
+GC borosilicate crown
+ED 7.1 8.3 2.51 -0.0009 0
+CD 1.03961212 0.00600069867 0.231792344 0.0200179144 1.01046945 103.560653
+TD 1.86E-06 1.31E-08 -1.37E-11 4.34E-07 6.27E-10 0.17 20
+OD 1 1 1 0 1 2.3
+LD 0.3 2.5
+NM BK7 1 517642 1.5168 64.17 0 2
+CD 2.2718929 -1.0108077E-2 1.0592509E-2 2.0816965E-4 -7.6472538E-6 4.9240991E-7 0 0 0 0
+TD 0 0 0 0 0 0 20
+OD - - - - - -
+LD 0.3 2.3
+"""
+    lines = [0.5875618, 0.4861327, 0.6562725]
+
+    def setUp(self):
+        self.glasses = glasscat.parse_agf(self.agf.splitlines(), "TEST")
+
+    def testParse(self):
+        nbk7, bk7 = self.glasses
+        self.assertEqual(nbk7.name, "N-BK7")
+        self.assertEqual(nbk7.formula, 2)
+        self.assertEqual(nbk7.status, 1)
+        self.assertEqual(nbk7.comment, "borosilicate crown")
+        self.assertEqual(nbk7.coefficients[5], 103.560653)
+        self.assertEqual(len(nbk7.coefficients), 10)
+        self.assertEqual(nbk7.thermal[6], 20.0)
+        self.assertEqual(nbk7.wavelength_range, (0.3, 2.5))
+        self.assertEqual(nbk7.tce, 7.1)
+        self.assertEqual(bk7.coefficients[5], 4.9240991E-7)
+        self.assertTrue(numpy.isnan(bk7.relative_cost))
+
+    def testIndex(self):
+        n = glasscat.refractive_index(self.glasses, self.lines)
+        self.assertEqual(n.shape, (2, 3))
+        self.assertAlmostEqual(abs(n[:, 0] - 1.5168).max(), 0, 5)
+        for glass in self.glasses:
+            self.assertAlmostEqual(glasscat.abbe_number(glass), glass.vd, 1)
+
+    def testFormulas(self):
+        # each formula, with coefficients which reproduce the Sellmeier
+        # index at one wavelength
+        nbk7 = self.glasses[0]
+        w = 0.55
+        n = glasscat.refractive_index([nbk7], [w])[0, 0]
+        coefficients = {
+            1: (n**2,), 3: (n,), 5: (n,), 7: (n**2,), 8: (n**2,),
+            9: (n**2,), 10: (n**2,), 12: (n**2,), 13: (n**2,),
+            4: (n**2 - 1,), 6: nbk7.coefficients, 11: nbk7.coefficients,
+            2: nbk7.coefficients}
+        glasses = [nbk7._replace(formula=f, coefficients=tuple(c) +
+                                 (0.0,) * (10 - len(c)))
+                   for (f, c) in sorted(coefficients.items())]
+        indices = glasscat.refractive_index(glasses, [w])
+        self.assertAlmostEqual(abs(indices - n).max(), 0)
+        self.assertRaises(ValueError, glasscat.refractive_index,
+                          [nbk7._replace(formula=14)], [w])
+
+    def testTemperature(self):
+        waves = numpy.linspace(0.4, 0.8, 5)
+        temperatures = [-20.0, 20.0, 60.0]
+        n = glasscat.refractive_index(self.glasses, waves, temperatures)
+        self.assertEqual(n.shape, (2, 5, 3))
+        # the data hold at the reference temperature and pressure
+        nominal = glasscat.refractive_index(self.glasses, waves)
+        self.assertAlmostEqual(abs(n[:, :, 1] - nominal).max(), 0)
+        # N-BK7 increases with temperature
+        self.assertTrue((numpy.diff(n[0], axis=-1) > 0).all())
+        # BK7 has no thermal data, but the air changes (as does the
+        # wavelength in air, slightly)
+        air = glasscat.air_index(waves[:, numpy.newaxis], temperatures)
+        self.assertAlmostEqual(
+            abs(n[1] * air - nominal[1][:, numpy.newaxis] *
+                air[:, 1:2]).max(), 0, 5)
+        # in a vacuum the index is the absolute index, at the wavelength
+        # in air of the reference conditions
+        vacuum = glasscat.refractive_index(self.glasses, waves, [20.0], 0.0)
+        absolute = glasscat.refractive_index(self.glasses,
+                                             waves / air[:, 1]) * air[:, 1]
+        self.assertAlmostEqual(abs(vacuum[..., 0] - absolute).max(), 0)
+
+    def testLoadCatalogs(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "first.agf"), "wb") as f:
+                f.write(self.agf.encode("utf-16"))
+            second = self.agf.replace("N-BK7", "N-SF5").replace(
+                "NM BK7", "NM XBK7").replace("BK7 1", "BK7 3")
+            with open(os.path.join(directory, "SECOND.AGF"), "wb") as f:
+                f.write(second.encode("latin-1"))
+            glasses = glasscat.load_catalogs(directory)
+            self.assertEqual(sorted(glasses), ["BK7", "N-BK7", "N-SF5",
+                                               "XBK7"])
+            self.assertEqual(glasses["N-BK7"].catalog, "FIRST")
+            glasses = glasscat.load_catalogs(directory, ["second"])
+            self.assertEqual(sorted(glasses), ["N-SF5", "XBK7"])
+        finally:
+            shutil.rmtree(directory)
+
+
+class GlassSubstitutionProxy(unittest.TestCase):
+    waves = [0.4861327, 0.5875618, 0.6562725]
+
+    def glass(self, name, nd, vd, status=0):
+        """Glass of a Cauchy formula (Schott formula) with the index and
+        Abbe number given."""
+        wf, wd, wc = self.waves
+        b = 2 * nd * (nd - 1) / vd / (wf**-2 - wc**-2)
+        a = nd**2 - b / wd**2
+        return glasscat.Glass(
+            name, "TEST", 1, nd, vd, status, (a, 0, b) + (0.0,) * 7,
+            (0.0,) * 6 + (20.0,), (0.3, 2.5), 0.0, 0.0, 0.0, 1.0, "")
+
+    def setUp(self):
+        self.glasses = dict((g.name, g) for g in [
+            self.glass("CROWN", 1.52, 64.0),
+            self.glass("FLINT", 1.62, 36.0),
+            self.glass("C50", 1.53, 50.0),
+            self.glass("C58", 1.51, 58.0),
+            self.glass("C70", 1.50, 70.0),
+            self.glass("C75", 1.52, 75.0),
+            self.glass("OLD", 1.52, 66.0, status=2),
+            self.glass("HIGH", 1.75, 64.0)])
+        system = SystemData(0, 1, 0, 0, 20.0, 1.0, 1, 0, 10.0)
+        surfaces = [
+            SurfaceData("STANDARD", "", 0.0, 1e10, "", 0.0, 0.0, (), (0, 0)),
+            SurfaceData("STANDARD", "", 0.02, 1e-6, "CROWN", 0.0, 0.0, (),
+                        (0, 0)),
+            SurfaceData("STANDARD", "", -0.01, 100.0, "", 0.0, 0.0, (),
+                        (0, 0)),
+            SurfaceData("STANDARD", "", 0.0, 0.0, "", 0.0, 0.0, (), (0, 0))]
+        waves = [prescription.WavelengthData(w, 1.0) for w in self.waves]
+        self.lens = Prescription(surfaces, system, wavelengths=waves)
+
+    def testThinLens(self):
+        media = glasssub._media(self.lens, self.glasses, self.waves)
+        foci = glasssub.axial_colour(self.lens, media)
+        n = media[1]
+        self.assertAlmostEqual(abs(foci - 1 / ((n - 1) * 0.03)).max(), 0,
+                               3)
+        # a concave mirror, whose focus is at z = -R/2
+        mirror = self.lens.surfaces[1]._replace(glass="MIRROR",
+                                                curvature=-0.02,
+                                                thickness=-50.0)
+        self.lens.surfaces[1:3] = [mirror]
+        media = glasssub._media(self.lens, self.glasses, self.waves)
+        foci = glasssub.axial_colour(self.lens, media)
+        self.assertAlmostEqual(abs(foci - -25.0).max(), 0)
+
+    def testRank(self):
+        candidates = glasssub.rank_candidates(self.lens, self.glasses, [1])
+        # within the windows, with a standard status, in order of
+        # increasing dispersion
+        self.assertEqual([c.glass for c in candidates],
+                         ["C70", "C58"])
+        self.assertTrue(candidates[0].proxy < candidates[1].proxy)
+        candidates = glasssub.rank_candidates(
+            self.lens, self.glasses, [1], vd_window=20.0, statuses=(0, 2))
+        self.assertEqual([c.glass for c in candidates],
+                         ["C75", "C70", "OLD", "C58", "C50"])
+        self.lens.surfaces[2] = self.lens.surfaces[2]._replace(
+            glass="UNKNOWN")
+        self.assertRaises(KeyError, glasssub.rank_candidates, self.lens,
+                          self.glasses, [1])
+
+
+class SolveParsing(unittest.TestCase):
+    def testPickups(self):
+        for code, args in [(0, [4, 3, 2.0]), (1, [5, 3, 2.0, -1.0]),
+                           (2, [2, 3]), (3, [2, 3, 0.5]), (4, [2, 3, 2.0]),
+                           (7, [2, 3, -1.0, 2.0, 9])]:
+            response = ",".join(str(a) for a in args)
+            record = solves.parse_solve(code, response)
+            self.assertEqual(record["source"], 3)
+            self.assertEqual(solves.pickup_args(
+                code, record["source"], record["scale"], record["offset"],
+                record["column"]), args)
+        # the offset precedes the scale for surface parameters
+        record = solves.parse_solve(7, "2,3,-1.0,2.0,9")
+        self.assertEqual((record["scale"], record["offset"],
+                          record["column"]), (2.0, -1.0, 9))
+        self.assertRaises(TypeError, solves.pickup_args, 0, 3, 1.0, 1.0)
+        self.assertRaises(TypeError, solves.pickup_args, 2, 3, 2.0)
+        self.assertRaises(TypeError, solves.pickup_args, 1, 3, 1.0, 0.0, 9)
+
+    def testOtherSolves(self):
+        record = solves.parse_solve(1, "2,0.0,0.2,0,0")
+        self.assertEqual(record["type"], 2)
+        self.assertEqual(record["source"], 0)
+        self.assertEqual(solves.parse_solve(3, "1")["type"], 1)
+        self.assertFalse(solves.can_vary(solves.semidia_code))
+        self.assertEqual(solves.fix_types[solves.semidia_code], 1)
+
+    def make_table(self, pickups, numsurfs=4):
+        table = numpy.zeros((numsurfs + 1, len(solves.codes)),
+                            solves.solve_dtype)
+        for (n, code), args in pickups.items():
+            table[n, code] = solves.parse_solve(
+                code, ",".join(str(a) for a in args))
+        return table
+
+    def testGraph(self):
+        surfaces = [SurfaceData("STANDARD", "", 0.0, 1e10, "", 0.0, 0.0,
+                                (0.0,) * 13, (0, 0))]
+        for n in range(1, 5):
+            surfaces.append(SurfaceData(
+                "STANDARD", "", 0.01 * n, float(n), "", 5.0, 0.0,
+                tuple(float(i) for i in range(13)), (0, 0)))
+        surfaces[1] = surfaces[1]._replace(glass="N-BK7")
+        p = Prescription(surfaces, None)
+        # a chain through surfaces 1 -> 2 -> 3 and a parameter pickup
+        # from another column
+        table = self.make_table({
+            (3, 1): [5, 2, -1.0, 0.5], (2, 1): [5, 1, 2.0, 0.0],
+            (2, 0): [4, 1, 3.0], (2, 2): [2, 1],
+            (4, 6): [2, 1, 0.0, 2.0, 6]})
+        graph = solves.PickupGraph(table)
+        self.assertEqual(graph.cycles(), [])
+        order = graph.order()
+        self.assertTrue(order.index((2, 1)) < order.index((3, 1)))
+
+        p.surfaces[1] = p.surfaces[1]._replace(thickness=10.0)
+        q = graph.evaluate(p)
+        self.assertEqual(q.surfaces[2].thickness, 20.0)
+        self.assertEqual(q.surfaces[3].thickness, -19.5)
+        self.assertAlmostEqual(q.surfaces[2].curvature, 0.03)
+        self.assertEqual(q.surfaces[2].glass, "N-BK7")
+        # parameter 2 of surface 4 picks up 2 * parameter 1 of surface 1
+        self.assertEqual(q.surfaces[4].parameters[2], 2.0)
+        # the original is not changed
+        self.assertEqual(p.surfaces[2].thickness, 2.0)
+
+        # only the dependents of the changed parameter are evaluated
+        self.assertEqual(graph.order([(1, 1)]), [(2, 1), (3, 1)])
+        q = graph.evaluate(p, [(1, 1)])
+        self.assertEqual(q.surfaces[3].thickness, -19.5)
+        self.assertEqual(q.surfaces[2].curvature, 0.02)
+
+    def testCycle(self):
+        table = self.make_table({
+            (1, 1): [5, 3, 1.0, 0.0], (2, 1): [5, 1, 1.0, 0.0],
+            (3, 1): [5, 2, 1.0, 0.0], (4, 1): [5, 3, 1.0, 0.0]})
+        graph = solves.PickupGraph(table)
+        cycles = graph.cycles()
+        self.assertEqual(len(cycles), 1)
+        self.assertEqual(sorted(cycles[0]), [(1, 1), (2, 1), (3, 1)])
+        self.assertRaises(solves.PickupCycleError, graph.order)
+
 
 class ExportModelToCAD(unittest.TestCase):
     def setUp(self):
@@ -1147,6 +3037,108 @@ class ExportModelToCAD(unittest.TestCase):
         os.remove(resultsf)
 
 
+class PushScheduling(unittest.TestCase):
+    def setUp(self):
+        self.z = Connection()
+        self.z.NewLens()
+        self.model = SurfaceSequence(self.z)
+        self.surf = self.model.append_new(surface.Standard)
+
+    def testRateLimited(self):
+        with PushScheduler(self.z, max_rate=2.0) as pusher:
+            start = time.time()
+            for i in range(50):
+                self.surf.thickness = 1.0 + i
+                pusher.request()
+            pusher.flush()
+            elapsed = time.time() - start
+            self.assertTrue(pusher.pushes <= 2 + 2*elapsed, pusher.pushes)
+            # the final state was pushed
+            self.assertEqual(pusher.pushed_revision, self.z.revision)
+
+        # check the editor holds the final state
+        self.z.NewLens()
+        self.z.GetRefresh()
+        self.assertAlmostEqual(self.model[-2].thickness.value, 50.0)
+
+    def testUnmodified(self):
+        with PushScheduler(self.z) as pusher:
+            pusher.flush()
+            self.assertEqual(pusher.pushes, 1)
+            # reading the model doesn't trigger a push
+            self.surf.thickness.value
+            pusher.flush()
+            self.assertEqual(pusher.pushes, 1)
+            self.surf.thickness = 2.0
+            pusher.flush()
+            self.assertEqual(pusher.pushes, 2)
+
+
+class GatedConnection(Connection):
+    """Connection with a fake DDE conversation, whose mutating requests
+    are held until `gate` is set."""
+    def __init__(self):
+        self.sent = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.requests = []
+        Connection.__init__(self)
+
+    def connect(self):
+        self.conversation = self
+
+    def disconnect(self):
+        self.conversation = None
+
+    def request(self, rs, timeout):
+        self.requests.append(rs)
+        if self.is_mutating(rs):
+            self.sent.set()
+            self.gate.wait()
+        return b"0"
+
+
+class PushRevisions(unittest.TestCase):
+    def testInFlightMutation(self):
+        conn = GatedConnection()
+        pushers = []
+
+        def factory():
+            pushers.append(GatedConnection())
+            return pushers[-1]
+
+        with PushScheduler(conn, max_rate=100.0, factory=factory) as pusher:
+            pusher.flush()
+            self.assertEqual(pusher.pushes, 1)
+
+            # a push while a mutation is in progress
+            conn.gate.clear()
+            self.addCleanup(conn.gate.set)
+            mutation = threading.Thread(target=conn.SetSurfaceData,
+                                        args=(1, 3, 2.0))
+            mutation.daemon = True
+            mutation.start()
+            conn.sent.wait()
+            pusher.flush()
+            pushes = pusher.pushes
+
+            conn.gate.set()
+            mutation.join()
+            # the state after the mutation is pushed
+            pusher.flush()
+            self.assertEqual(pusher.pushes, pushes + 1)
+            self.assertEqual(pusher.pushed_revision, conn.revision)
+        self.assertEqual(pushers[0].requests.count("PushLens,0"),
+                         pusher.pushes)
+
+    def testBadCommand(self):
+        conn = GatedConnection()
+        conn.request = lambda rs, timeout: b"BAD COMMAND"
+        self.assertRaises(zemaxclient.ZemaxServerError, conn.req,
+                          "SetSurfaceData,1,3,2.0")
+        self.assertEqual(conn.revision, 0)
+
+
 if __name__ == "__main__":
     print("Please ensure Zemax is in sequential mode before running the "
           "unit tests")
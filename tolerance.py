@@ -0,0 +1,169 @@
+# Monte Carlo tolerancing.
+#
+# Each trial perturbs the toleranced parameters by values drawn from
+# their distributions and evaluates the criteria.  The random numbers
+# of a trial are seeded by (seed, trial number), so that trials can be
+# evaluated in any order, on any connection of a pool, and a run which
+# was interrupted can be resumed.  Results are streamed into a
+# ResultStore (see resultstore.py) as the trials complete.
+
+from __future__ import print_function
+import numpy as np
+from collections import namedtuple
+from optimise import CriteriaEvaluator
+from pool import LocalPool
+from resultstore import ResultStore
+
+
+class Normal(object):
+    """Normal distribution, truncated at `cutoff` standard deviations."""
+    def __init__(self, sigma, mean=0.0, cutoff=2.0):
+        self.sigma = sigma
+        self.mean = mean
+        self.cutoff = cutoff
+
+    def sample(self, rng):
+        while True:
+            x = rng.standard_normal()
+            if self.cutoff is None or abs(x) <= self.cutoff:
+                return self.mean + self.sigma * x
+
+
+class Uniform(object):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return rng.uniform(self.low, self.high)
+
+
+Tolerance = namedtuple("Tolerance", ["parameter", "distribution"])
+# parameter : Parameter instance
+# distribution : distribution of the change of the parameter value
+
+
+def trial_perturbations(tolerances, seed, trial):
+    """Return the parameter changes of a trial."""
+    rng = np.random.RandomState([seed, trial])
+    return np.array([t.distribution.sample(rng) for t in tolerances])
+
+
+class YieldStatistics(object):
+    """Statistics of the criteria, updated one trial at a time.
+
+    limits :
+        (low, high) bounds of each criterion for a trial to pass.  None
+        for either bound leaves it open.  Trials which cannot be traced
+        (whose criteria are NaN) fail.
+    """
+    def __init__(self, num_criteria, limits=None):
+        if limits is None:
+            limits = [(None, None)] * num_criteria
+        self.low = np.array([-np.inf if lo is None else lo
+                             for (lo, hi) in limits])
+        self.high = np.array([np.inf if hi is None else hi
+                              for (lo, hi) in limits])
+        self.trials = 0
+        self.traced = 0
+        self.passed = 0
+        self.mean = np.zeros(num_criteria)
+        self._m2 = np.zeros(num_criteria)
+        self.minimum = np.empty(num_criteria)
+        self.minimum.fill(np.inf)
+        self.maximum = -self.minimum
+
+    def add(self, criteria):
+        criteria = np.asarray(criteria, float)
+        self.trials += 1
+        if np.isnan(criteria).any():
+            return
+        self.traced += 1
+        if ((criteria >= self.low) & (criteria <= self.high)).all():
+            self.passed += 1
+        delta = criteria - self.mean
+        self.mean += delta / self.traced
+        self._m2 += delta * (criteria - self.mean)
+        np.minimum(self.minimum, criteria, self.minimum)
+        np.maximum(self.maximum, criteria, self.maximum)
+
+    @property
+    def std(self):
+        if self.traced < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self._m2 / (self.traced - 1))
+
+    @property
+    def yield_fraction(self):
+        if not self.trials:
+            return np.nan
+        return float(self.passed) / self.trials
+
+    @property
+    def yield_uncertainty(self):
+        """Standard error of the yield fraction."""
+        p = self.yield_fraction
+        return np.sqrt(p * (1 - p) / self.trials)
+
+
+class _Trials(object):
+    def __init__(self, conn, tolerances, criteria, seed):
+        self.tolerances = list(tolerances)
+        self.evaluator = CriteriaEvaluator(
+            conn, [t.parameter for t in self.tolerances], criteria)
+        self.seed = seed
+
+    def run(self, conn, trial):
+        delta = trial_perturbations(self.tolerances, self.seed, trial)
+        criteria = self.evaluator.evaluate(conn,
+                                           self.evaluator.nominal + delta)
+        return np.concatenate([delta, criteria])
+
+
+def monte_carlo(conn, tolerances, criteria, trials, path, seed=0, pool=None,
+                limits=None, progress=None):
+    """Run a Monte Carlo tolerance analysis.
+
+    tolerances :
+        sequence of Tolerance
+    criteria :
+        Operand specifications or functions (see CriteriaEvaluator)
+    path :
+        directory of the ResultStore.  Each row holds the parameter
+        changes of a trial, followed by the values of the criteria.  If
+        the store exists, only the pending trials are evaluated.
+    pool :
+        Pool on which trials are evaluated (LocalPool by default).  The
+        workers of a ConnectionPool must reach servers other than that
+        of `conn` and hold a copy of the nominal lens (see
+        pool.copy_lens_setup).
+    limits :
+        bounds of the criteria for the yield (see YieldStatistics)
+    progress :
+        function called as progress(trial, row, statistics) when each
+        trial is done
+
+    Returns the YieldStatistics of all the trials.  The nominal lens is
+    restored on `conn`.
+    """
+    criteria = list(criteria)
+    if pool is None:
+        pool = LocalPool(conn)
+    runner = _Trials(conn, tolerances, criteria, seed)
+    num_params = len(runner.tolerances)
+    statistics = YieldStatistics(len(criteria), limits)
+
+    with ResultStore(path, trials, num_params + len(criteria)) as store:
+        done = store.done
+        for row in store.read(np.flatnonzero(done)):
+            statistics.add(row[num_params:])
+        pending = store.pending()
+        try:
+            for index, row in pool.as_completed(runner.run, pending):
+                store.write(pending[index], row)
+                statistics.add(row[num_params:])
+                if progress is not None:
+                    progress(pending[index], row, statistics)
+        finally:
+            runner.evaluator.restore(conn)
+    return statistics
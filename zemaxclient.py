@@ -4,12 +4,14 @@
 # $Date: 2013-12-17 16:52:04 +0000 (Tue, 17 Dec 2013) $
 from __future__ import print_function
 import os
+import time
 import tempfile
-import codecs
-from numpy import array, matrix
+import threading
+from numpy import array, empty
 from contextlib import contextmanager
 from functools import wraps
 import dde
+from zmxfile import decode_text_file
 
 # A Connection can manipulate a "Lens" in the Zemax server memory.
 # This is not the same as the Lens shown in the Zemax program window
@@ -68,6 +70,26 @@ def tmpfile_callback(callback, extension=".txt", mode="rb"):
         os.remove(path)
 
 
+def parse_frames(responses):
+    """Parse GetGlobalMatrix (or GetNSCMatrix) responses into an array of
+    homogeneous transformations, of shape (N, 4, 4)."""
+    frames = empty((len(responses), 4, 4))
+    for frame, response in zip(frames, responses):
+        elements = [float(x) for x in response.split(",")]
+        frame[:3, :3] = array(elements[:9]).reshape((3, 3))
+        frame[:3, 3] = elements[9:12]
+        frame[3] = (0.0, 0.0, 0.0, 1.0)
+    return frames
+
+
+def parse_nsc_position(response):
+    """Parse the response to GetNSCPosition."""
+    fields = response.split(",")
+    position = tuple(float(x) for x in fields[:6])
+    material = ",".join(fields[6:]).strip()
+    return position + (material,)
+
+
 class Connection:
     """Encapsulates a connection to the Zemax server.
 
@@ -77,10 +99,23 @@ class Connection:
     """
     def __init__(self, verbose=False):
         self.verbose = verbose
+        # incremented by every request that may modify the server lens,
+        # when its response is received
+        self.revision = 0
         self.connect()
 
+    # DDE service and topic of the server.  Every Zemax instance
+    # registers the same names, so a client cannot choose between
+    # instances: all connections reach the same server lens.
+    service = topic = "ZEMAX"
+
+    @property
+    def server(self):
+        """Identifies the server reached by the connection."""
+        return (self.service, self.topic)
+
     def connect(self):
-        self.conversation = dde.DDEClient("ZEMAX", "ZEMAX")
+        self.conversation = dde.DDEClient(self.service, self.topic)
 
     def disconnect(self):
         if self.conversation is not None:
@@ -89,6 +124,18 @@ class Connection:
 
     default_timeout = 2**28
 
+    # Requests which may modify the lens in the server memory (in
+    # addition to those named with one of the prefixes).
+    mutating_prefixes = ("Delete", "Insert", "Set")
+    mutating_requests = frozenset(["GetRefresh", "GetUpdate", "LoadFile",
+                                   "LoadMerit", "NewLens", "Optimize",
+                                   "QuickFocus", "RemoveVariables"])
+
+    def is_mutating(self, rs):
+        name = rs.split(",", 1)[0]
+        return (name.startswith(self.mutating_prefixes) or
+                name in self.mutating_requests)
+
     def req(self, rs, timeout=0):
         timeout = max(self.default_timeout, timeout)
         if self.verbose:
@@ -98,8 +145,26 @@ class Connection:
             print("Recv : " + response.rstrip())
         if response.startswith("BAD COMMAND"):
             raise ZemaxServerError("Bad command sent to server : %s" % str(rs))
+        # only once the server has applied the change, so that a
+        # revision read by another thread (see PushScheduler) never
+        # stands for a change still in progress
+        if self.is_mutating(rs):
+            self.revision += 1
         return response.rstrip("\r\n")
 
+    def req_batch(self, requests, timeout=0):
+        """Send a sequence of requests, returning the list of responses.
+
+        The DDE conversation handles one request at a time, so the
+        requests are sent back-to-back.  Bulk operations are written
+        in terms of this method so that they are issued together.
+        """
+        return [self.req(rs, timeout) for rs in requests]
+
+    def build_req(self, name, *args):
+        """Format a request string from the command name and arguments."""
+        return ",".join([name] + [self._str(a) for a in args])
+
     def _str(self, val):
         if isinstance(val, float):
             s = "%.20E" % val
@@ -120,6 +185,9 @@ class Connection:
         # returns the new number of operands
         return int(self.req("DeleteMFO,%d" % operand))
 
+    def DeleteObject(self, surf, obj):
+        return int(self.req("DeleteObject,%d,%d" % (surf, obj)))
+
     @returns_error_status
     def DeleteSurface(self, surf):
         """deletes the surface"""
@@ -223,10 +291,22 @@ class Connection:
     def GetGlobalMatrix(self, surf):
         response = self.req("GetGlobalMatrix,%d" % surf)
         elements = [float(x) for x in response.split(",")]
-        rotation = matrix(array(elements[:9]).reshape((3, 3)))
+        rotation = array(elements[:9]).reshape((3, 3))
         offset = array(elements[9:])
         return rotation, offset
 
+    def GetGlobalMatrices(self, surfs):
+        """Return the global frames of several surfaces.
+
+        The result is an array of shape (N, 4, 4), holding the
+        homogeneous transformation from the local coordinates of each
+        surface to global coordinates.
+        """
+        surfs = list(surfs)
+        responses = self.req_batch(["GetGlobalMatrix,%d" % surf
+                                    for surf in surfs])
+        return parse_frames(responses)
+
     def GetIndex(self, surf):
         response = self.req("GetIndex,%d" % surf)
         if not response:
@@ -286,6 +366,16 @@ class Connection:
         offset = array(elements[9:])
         return rotation, offset
 
+    def GetNSCMatrices(self, surf, objs):
+        """Return the frames of several objects as an (N, 4, 4) array.
+
+        The frames transform object coordinates to the coordinates of
+        the component (see GetGlobalMatrices).
+        """
+        responses = self.req_batch(["GetNSCMatrix,%d,%d" % (surf, obj)
+                                    for obj in objs])
+        return parse_frames(responses)
+
     def GetNSCObjectData(self, surf, obj, code):
         cmd = "GetNSCObjectData,%d,%d,%d" % (surf, obj, code)
         return self.req(cmd)
@@ -294,6 +384,11 @@ class Connection:
         cmd = "GetNSCParameter,%d,%d,%d" % (surf, obj, code)
         return self.req(cmd)
 
+    def GetNSCPosition(self, surf, obj):
+        # returns (x, y, z, tilt-x, tilt-y, tilt-z, material)
+        response = self.req("GetNSCPosition,%d,%d" % (surf, obj))
+        return parse_nsc_position(response)
+
     def GetNSCProperty(self, surf, obj, code, face=None):
         cmd = "GetNSCProperty,%d,%d,%d" % (surf, obj, code)
         if face is not None:
@@ -413,19 +508,6 @@ class Connection:
             # ensure `flag` is 1, otherwise Zemax default will be used.
             flag = 1
 
-        # Define custom stream object to decode the text file
-        def decoded(f):
-            bom = f.read(2)
-            f.seek(0)
-            # Older versions of Zemax wrote plain ascii files.  The
-            # output txt file format can be selected in the
-            # preferences dialog box.
-            if bom == codecs.BOM_UTF16:
-                reader = codecs.getreader("utf-16")
-            else:
-                reader = codecs.getreader("utf-8")
-            return reader(f)
-
         def acquire(resultsf):
             return self.GetTextFile(resultsf, type, settingspath,
                                     flag, timeout=timeout)
@@ -439,7 +521,10 @@ class Connection:
         # triggering before a resource (eg. temporary file) is released.
         with tmpfile_callback(acquire) as (response, f, path):
             assert(response == "OK")
-            yield decoded(f)
+            # Older versions of Zemax wrote plain ascii files.  The
+            # output txt file format can be selected in the
+            # preferences dialog box.
+            yield decode_text_file(f)
 
     def GetTrace(self, wave, mode, surf, h, p):
         # mode: 0=real, 1=paraxial
@@ -845,6 +930,130 @@ class Connection:
         return _wavelength, _weight
 
 
+class PushScheduler(object):
+    """Pushes the server lens to the Lens Data Editor at a limited rate.
+
+    Interactive clients call `request()` after each change to the
+    model.  The push is performed by a background thread, at most
+    `max_rate` times per second, and only when `conn.revision` shows
+    that the server lens was modified since the last push.  The final
+    state is always pushed by `flush()` and `close()`.
+
+    A DDE conversation can only be used by the thread which opened
+    it, so the background thread pushes through its own connection,
+    created by calling `factory`.  Both conversations manipulate the
+    same server lens.
+    """
+    def __init__(self, conn, max_rate=4.0, flag=0, factory=Connection):
+        self.conn = conn
+        self.interval = 1.0/max_rate
+        self.flag = flag
+        self.factory = factory
+
+        self.pushes = 0
+        self.pushed_revision = None
+        self.error = None
+
+        self._last_push = 0.0
+        self._pending = False
+        self._pushing = False
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _check_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def request(self):
+        """Schedule a push of the server lens. Does not block."""
+        self._check_error()
+        with self._cond:
+            self._pending = True
+            self._cond.notify_all()
+
+    def flush(self):
+        """Block until the current state of the server lens is pushed."""
+        self.request()
+        with self._cond:
+            while ((self._pending or self._pushing) and
+                   self._thread.is_alive()):
+                self._cond.wait(0.1)
+        self._check_error()
+
+    def close(self):
+        """Push the final state and stop the background thread."""
+        if self._thread.is_alive():
+            self.flush()
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._check_error()
+
+    def _run(self):
+        try:
+            push_conn = self.factory()
+        except Exception as e:
+            self.error = e
+            return
+
+        try:
+            self._cond.acquire()
+            while True:
+                if not self._pending:
+                    if self._closing:
+                        break
+                    self._cond.wait()
+                    continue
+
+                delay = self._last_push + self.interval - time.time()
+                if delay > 0 and not self._closing:
+                    # rate limit (further requests merge with this one)
+                    self._cond.wait(delay)
+                    continue
+
+                self._pending = False
+                revision = self.conn.revision
+                if revision == self.pushed_revision:
+                    # no modifications since the last push
+                    self._cond.notify_all()
+                    continue
+
+                self._pushing = True
+                self._cond.release()
+                try:
+                    try:
+                        push_conn.PushLens(self.flag)
+                    except Untraceable:
+                        # the lens was pushed regardless
+                        pass
+                    except Exception as e:
+                        self.error = e
+                    else:
+                        self.pushes += 1
+                finally:
+                    self._cond.acquire()
+                self._pushing = False
+                self._last_push = time.time()
+                self.pushed_revision = revision
+                self._cond.notify_all()
+        finally:
+            self._pushing = False
+            self._cond.notify_all()
+            self._cond.release()
+            push_conn.disconnect()
+
+
 if __name__ == "__main__":
     z = Connection()
     print("Zemax Version : " + str(z.GetVersion()))
@@ -0,0 +1,492 @@
+# Reading and writing of Zemax lens files (.ZMX) without a server.
+#
+# A .ZMX file is a text file of lines beginning with a four letter
+# keyword.  The system data come first, followed by a SURF block for
+# each surface, whose lines are indented.  The parser builds the same
+# Prescription (see prescription.py) as a snapshot taken from the
+# server (with its extra data, see read_prescription), from the
+# following keywords.  Other keywords are ignored.
+#
+# The writer formats a Prescription with the same keywords, so that a
+# lens built on the client is transferred to the server with a single
+# LoadFile request (see load_prescription), rather than a request for
+# each surface attribute.  Solves are not written: they are set after
+# the file is loaded, with a batch of SetSolve requests.
+#
+#   UNIT, ENVD, RAIM, GLRS    units, environment, ray aiming, global
+#                             reference surface
+#   ENPD, FNUM, OBNA, FLOA,   system aperture (the keyword gives the
+#   PWFN, OBCA                aperture type)
+#   FTYP                      field type and numbers of fields and
+#                             wavelengths
+#   XFLN, YFLN, FWGN, VDXN,   field data, one value for each field
+#   VDYN, VCXN, VCYN, VANN
+#   WAVM, PWAV                wavelength (number, wavelength, weight)
+#   WAVL, WWGT                and primary wavelength (older files list
+#                             the wavelengths and weights on one line)
+#   MNUM                      number of configurations and current
+#                             configuration.  The operands of the
+#                             multi-configuration editor are read from
+#                             the following unindented lines: a line
+#                             of the operand type and integer
+#                             arguments, then one Z line of the value
+#                             in each configuration.
+#
+#   SURF n                    start of the data of surface n
+#     TYPE, COMM, STOP        surface type, comment, stop surface
+#     CURV, DISZ, GLAS, CONI  curvature, thickness, glass and conic
+#     DIAM                    semi-diameter
+#     PARM n v, XDAT n v      parameter and extra data values
+#     CRTN code surf          coordinate return
+#
+#     NSOB type               start of a non-sequential object of the
+#                             surface, followed by
+#     NSOC comment
+#     NSOP x y z tx ty tz ref position and reference object
+#     NSOM material
+#     NSOD n v                parameter value
+#     NSOI status             ignore status
+
+from __future__ import print_function
+import os
+import codecs
+import tempfile
+from prescription import (Prescription, SurfaceData, SystemData, FieldData,
+                          WavelengthData, ConfigOperand, ObjectSpec,
+                          config_value)
+from solves import semidia_code
+
+
+def decode_text_file(f, encoding="utf-8"):
+    """Return a reader decoding a file written by Zemax.
+
+    Zemax writes UTF-16 files with a byte order mark, or (in older
+    versions, or depending on the preferences) plain text.
+    """
+    bom = f.read(2)
+    f.seek(0)
+    if bom in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        encoding = "utf-16"
+    return codecs.getreader(encoding)(f)
+
+
+infinity = 1e10  # thickness reported by the server for "INFINITY"
+
+aperture_keywords = {"ENPD": 0, "FNUM": 1, "OBNA": 2, "FLOA": 3, "PWFN": 4,
+                     "OBCA": 5}
+unit_codes = {"MM": 0, "CM": 1, "IN": 2, "METER": 3, "M": 3}
+unit_names = ("MM", "CM", "IN", "METER")
+field_keywords = ("XFLN", "YFLN", "FWGN", "VDXN", "VDYN", "VCXN", "VCYN",
+                  "VANN")
+
+
+def _float(token):
+    if token.upper() == "INFINITY":
+        return infinity
+    return float(token)
+
+
+def _int(token):
+    return int(float(token))
+
+
+class _Surface(object):
+    """Mutable surface data, while the surface block is read."""
+    def __init__(self):
+        self.type = "STANDARD"
+        self.comment = ""
+        self.curvature = 0.0
+        self.thickness = 0.0
+        self.glass = ""
+        self.semidia = 0.0
+        self.conic = 0.0
+        self.parameters = [0.0] * Prescription.num_parameters
+        self.coord_return = (0, 0)
+        self.extra = {}
+        self.objects = []
+
+    def data(self):
+        return SurfaceData(
+            self.type, self.comment, self.curvature, self.thickness,
+            self.glass, self.semidia, self.conic, tuple(self.parameters),
+            self.coord_return, tuple(sorted(
+                (n, v) for (n, v) in self.extra.items() if v != 0)))
+
+
+class _Parser(object):
+    def __init__(self):
+        self.surfaces = {}
+        self.surface = None
+        self.object = None
+        self.system = dict(unitcode=0, stopsurf=1, rayaimingtype=0,
+                           adjust_index=0, temperature=20.0, pressure=1.0,
+                           globalrefsurf=1, aperture_type=0,
+                           aperture_value=0.0)
+        self.field_type = 0
+        self.num_fields = None
+        self.num_waves = None
+        self.field_columns = {}
+        self.waves = {}
+        self.old_waves = None
+        self.old_weights = None
+        self.primary_wave = 1
+        self.num_configs = 0
+        self.current_config = 1
+        self.configs = []
+
+    def line(self, line):
+        fields = line.split()
+        if not fields:
+            return
+        keyword, args = fields[0].upper(), fields[1:]
+        rest = line.strip()[len(fields[0]):].strip()
+        if not line[:1].isspace():
+            # the lines of a surface block are indented
+            self.surface = None
+        if self.surface is not None and keyword in self.surface_keywords:
+            self.surface_keywords[keyword](self, args, rest)
+        elif keyword in self.keywords:
+            self.keywords[keyword](self, args, rest)
+        elif self.num_configs and self.surface is None:
+            self.config_line(keyword, args)
+
+    def config_line(self, keyword, args):
+        if keyword == "Z":
+            if self.configs and self.configs[-1] is not None:
+                self.configs[-1][2].append(config_value(args[0]))
+            return
+        try:
+            operand = (keyword, tuple(_int(a) for a in args[:3]), [])
+        except ValueError:
+            # not an operand of the multi-configuration editor
+            operand = None
+        self.configs.append(operand)
+
+    # system data
+
+    def surf(self, args, rest):
+        self.surface = self.surfaces[_int(args[0])] = _Surface()
+        self.object = None
+
+    def unit(self, args, rest):
+        self.system["unitcode"] = unit_codes.get(args[0].upper(), 0)
+
+    def envd(self, args, rest):
+        self.system["temperature"] = float(args[0])
+        self.system["pressure"] = float(args[1])
+        if len(args) > 2:
+            self.system["adjust_index"] = _int(args[2])
+
+    def raim(self, args, rest):
+        self.system["rayaimingtype"] = _int(args[1])
+
+    def glrs(self, args, rest):
+        self.system["globalrefsurf"] = _int(args[0])
+
+    def ftyp(self, args, rest):
+        self.field_type = _int(args[0])
+        self.num_fields = _int(args[2])
+        self.num_waves = _int(args[3])
+
+    def field_data(self, keyword, args):
+        self.field_columns[keyword] = [float(a) for a in args]
+
+    def wavm(self, args, rest):
+        self.waves[_int(args[0])] = WavelengthData(float(args[1]),
+                                                   float(args[2]))
+
+    def wavl(self, args, rest):
+        self.old_waves = [float(a) for a in args]
+
+    def wwgt(self, args, rest):
+        self.old_weights = [float(a) for a in args]
+
+    def pwav(self, args, rest):
+        self.primary_wave = _int(args[0])
+
+    def mnum(self, args, rest):
+        self.num_configs = _int(args[0])
+        if len(args) > 1:
+            self.current_config = _int(args[1])
+
+    def aperture(self, keyword, args):
+        self.system["aperture_type"] = aperture_keywords[keyword]
+        self.system["aperture_value"] = float(args[0])
+
+    keywords = {"SURF": surf, "UNIT": unit, "ENVD": envd, "RAIM": raim,
+                "GLRS": glrs, "FTYP": ftyp, "WAVM": wavm, "WAVL": wavl,
+                "WWGT": wwgt, "PWAV": pwav, "MNUM": mnum}
+    for _keyword in aperture_keywords:
+        keywords[_keyword] = (lambda keyword: lambda self, args, rest:
+                              self.aperture(keyword, args))(_keyword)
+    for _keyword in field_keywords:
+        keywords[_keyword] = (lambda keyword: lambda self, args, rest:
+                              self.field_data(keyword, args))(_keyword)
+
+    # surface data
+
+    def set_surface(name, convert=float):
+        def set(self, args, rest):
+            setattr(self.surface, name, convert(args[0]))
+        return set
+
+    def comm(self, args, rest):
+        self.surface.comment = rest
+
+    def stop(self, args, rest):
+        self.system["stopsurf"] = [n for (n, s) in self.surfaces.items()
+                                   if s is self.surface][0]
+
+    def parm(self, args, rest):
+        self.surface.parameters[_int(args[0])] = _float(args[1])
+
+    def xdat(self, args, rest):
+        self.surface.extra[_int(args[0])] = _float(args[1])
+
+    def crtn(self, args, rest):
+        self.surface.coord_return = (_int(args[0]), _int(args[1]))
+
+    # non-sequential objects
+
+    def nsob(self, args, rest):
+        self.object = dict(type=args[0], parameters={})
+        self.surface.objects.append(self.object)
+
+    def nsoc(self, args, rest):
+        self.object["comment"] = rest
+
+    def nsop(self, args, rest):
+        self.object["position"] = tuple(float(a) for a in args[:6])
+        if len(args) > 6:
+            self.object["ref"] = _int(args[6])
+
+    def nsom(self, args, rest):
+        self.object["material"] = args[0] if args else ""
+
+    def nsod(self, args, rest):
+        self.object["parameters"][_int(args[0])] = float(args[1])
+
+    def nsoi(self, args, rest):
+        self.object["ignore"] = _int(args[0])
+
+    surface_keywords = {
+        "TYPE": set_surface("type", str), "COMM": comm, "STOP": stop,
+        "CURV": set_surface("curvature"), "DISZ": set_surface("thickness",
+                                                             _float),
+        "GLAS": set_surface("glass", str), "CONI": set_surface("conic"),
+        "DIAM": set_surface("semidia"), "PARM": parm, "XDAT": xdat,
+        "CRTN": crtn, "NSOB": nsob, "NSOC": nsoc, "NSOP": nsop,
+        "NSOM": nsom, "NSOD": nsod, "NSOI": nsoi}
+    del set_surface
+
+    def prescription(self):
+        numbers = sorted(self.surfaces)
+        surfaces = [self.surfaces[n].data() for n in numbers]
+        objects = dict((n, [ObjectSpec(**obj) for obj in
+                            self.surfaces[n].objects])
+                       for n in numbers if self.surfaces[n].objects)
+
+        num_fields = self.num_fields
+        if num_fields is None:
+            num_fields = len(self.field_columns.get("YFLN", []))
+        columns = []
+        for keyword in field_keywords:
+            default = 1.0 if keyword == "FWGN" else 0.0
+            values = self.field_columns.get(keyword, [])
+            values = values + [default] * (num_fields - len(values))
+            columns.append(values[:num_fields])
+        fields = [FieldData(*values) for values in zip(*columns)]
+
+        if self.waves:
+            waves = [self.waves[n] for n in sorted(self.waves)]
+        else:
+            waves = [WavelengthData(w, weight) for (w, weight) in
+                     zip(self.old_waves or [], self.old_weights or [])]
+        if self.num_waves is not None:
+            waves = waves[:self.num_waves]
+
+        configs = [ConfigOperand(_type, args + (0,) * (3 - len(args)),
+                                 tuple(values))
+                   for (_type, args, values) in filter(None, self.configs)
+                   if values]
+        return Prescription(surfaces, SystemData(**self.system),
+                            self.field_type, fields, self.primary_wave,
+                            waves, self.current_config, configs, objects)
+
+
+def parse_zmx(lines):
+    """Build a Prescription from the lines of a .ZMX file."""
+    parser = _Parser()
+    for line in lines:
+        parser.line(line)
+    return parser.prescription()
+
+
+def read_zmx(path):
+    """Read a .ZMX file (UTF-16 or plain text)."""
+    with open(path, "rb") as f:
+        return parse_zmx(decode_text_file(f, "latin-1"))
+
+
+def _format(value):
+    if isinstance(value, float):
+        # 17 significant digits reproduce the value exactly
+        return "%.17G" % value
+    return "%s" % value
+
+
+def _line(keyword, *args):
+    return " ".join([keyword] + [_format(a) for a in args])
+
+
+def _object_lines(spec):
+    lines = [_line("NSOB", spec.type)]
+    if spec.comment:
+        lines.append(_line("NSOC", spec.comment))
+    lines.append(_line("NSOP", *(tuple(float(x) for x in spec.position) +
+                                 (spec.ref,))))
+    if spec.material:
+        lines.append(_line("NSOM", spec.material))
+    parameters = spec.parameters
+    if not isinstance(parameters, dict):
+        parameters = dict(enumerate(parameters, 1))
+    for n in sorted(parameters):
+        lines.append(_line("NSOD", n, float(parameters[n])))
+    if spec.ignore:
+        lines.append(_line("NSOI", spec.ignore))
+    return ["  " + line for line in lines]
+
+
+def _surface_lines(surfno, surface, prescription):
+    lines = [_line("TYPE", surface.type)]
+    if surfno == prescription.system.stopsurf:
+        lines.append("STOP")
+    if surface.comment:
+        lines.append(_line("COMM", surface.comment))
+    lines.append(_line("CURV", float(surface.curvature)))
+    for n, value in enumerate(surface.parameters):
+        if value:
+            lines.append(_line("PARM", n, float(value)))
+    for n, value in surface.extra:
+        lines.append(_line("XDAT", n, float(value)))
+    if surface.coord_return[0]:
+        lines.append(_line("CRTN", *surface.coord_return))
+    if surface.thickness >= infinity:
+        lines.append("DISZ INFINITY")
+    else:
+        lines.append(_line("DISZ", float(surface.thickness)))
+    if surface.glass:
+        lines.append(_line("GLAS", surface.glass))
+    if surface.conic:
+        lines.append(_line("CONI", float(surface.conic)))
+    lines.append(_line("DIAM", float(surface.semidia)))
+    lines = [_line("SURF", surfno)] + ["  " + line for line in lines]
+    for spec in prescription.objects.get(surfno, ()):
+        lines.extend(_object_lines(spec))
+    return lines
+
+
+def format_zmx(prescription):
+    """Return the lines of a .ZMX file of a Prescription.
+
+    Only the values are written, so that the parameters are loaded with
+    fixed solves and semi-diameters as automatic.  The solves of the
+    prescription are set by load_prescription (see solve_requests).
+    """
+    system = prescription.system
+    aperture_keyword = dict((v, k) for (k, v) in
+                            aperture_keywords.items())[system.aperture_type]
+    lines = [
+        "MODE SEQ",
+        _line("UNIT", unit_names[system.unitcode]),
+        _line(aperture_keyword, float(system.aperture_value)),
+        _line("ENVD", float(system.temperature), float(system.pressure),
+              system.adjust_index),
+        _line("GLRS", system.globalrefsurf, 0),
+        _line("RAIM", 0, system.rayaimingtype),
+        _line("FTYP", prescription.field_type, 0, len(prescription.fields),
+              len(prescription.wavelengths))]
+    if prescription.fields:
+        columns = zip(*prescription.fields)
+        for keyword, values in zip(field_keywords, columns):
+            lines.append(_line(keyword, *[float(v) for v in values]))
+    for n, wave in enumerate(prescription.wavelengths, 1):
+        lines.append(_line("WAVM", n, float(wave.wavelength),
+                           float(wave.weight)))
+    lines.append(_line("PWAV", prescription.primary_wave))
+    if prescription.configs:
+        lines.append(_line("MNUM", len(prescription.configs[0].values),
+                           prescription.current_config))
+
+    for surfno, surface in enumerate(prescription.surfaces):
+        lines.extend(_surface_lines(surfno, surface, prescription))
+
+    for operand in prescription.configs:
+        lines.append(_line(operand.type, *operand.args))
+        lines.extend(_line("Z", value) for value in operand.values)
+    return lines
+
+
+def write_zmx(prescription, path, encoding="utf-16"):
+    """Write a Prescription to a .ZMX file.
+
+    Older versions of Zemax read only plain text files, which are
+    written with encoding="latin-1".
+    """
+    with codecs.open(path, "w", encoding) as f:
+        for line in format_zmx(prescription):
+            f.write(line + "\r\n")
+
+
+def solve_requests(conn, prescription):
+    """Return the SetSolve requests giving a lens loaded from a .ZMX file
+    of a Prescription (see format_zmx) the solves of the prescription.
+
+    Solves of type 0 (fixed values, and automatic semi-diameters) are
+    those of the loaded lens.  Fixed semi-diameters are set to their
+    values after their solves.
+    """
+    requests = []
+    for n, surface_solves in enumerate(prescription.solves or ()):
+        for code, solve in enumerate(surface_solves):
+            if not solve or int(solve[0]) == 0:
+                continue
+            # integers (solve types, surface numbers and columns) are
+            # sent as such
+            args = [int(v) if isinstance(v, float) and v.is_integer()
+                    else v for v in solve]
+            requests.append(conn.build_req("SetSolve", n, code, *args))
+            if code == semidia_code:
+                requests.append(conn.build_req(
+                    "SetSurfaceData", n, 5,
+                    float(prescription.surfaces[n].semidia)))
+    return requests
+
+
+def load_prescription(conn, prescription, append=0, encoding="utf-16",
+                      untraceable_allowed=False):
+    """Load a Prescription into the server lens, with one LoadFile
+    request and a batch of requests setting its solves (see
+    solve_requests).
+
+    append :
+        0 to replace the lens, or the number of the surface at which
+        the surfaces of the file are appended to the lens (see
+        Connection.LoadFile).  Solves cannot be appended, as their
+        surface numbers would refer to the lens of the file.
+    """
+    requests = solve_requests(conn, prescription)
+    if append and requests:
+        raise ValueError("The solves of a prescription cannot be appended "
+                         "to a lens")
+    # Zemax will not open a file created with
+    # tempfile.NamedTemporaryFile()
+    (fd, path) = tempfile.mkstemp(".ZMX")
+    os.close(fd)
+    try:
+        write_zmx(prescription, path, encoding)
+        error = conn.LoadFile(path, append, untraceable_allowed)
+    finally:
+        os.remove(path)
+    conn.req_batch(requests)
+    return error
@@ -0,0 +1,405 @@
+# Reader for Zemax ray database (ZRD) files.
+#
+# Connection.NSCTrace saves ray databases with the arguments save=1,
+# savefilename and zrd_format=0 (uncompressed).  The file is memory
+# mapped and rays are yielded in chunks of NumPy structured arrays, so
+# that databases larger than the available memory can be processed.
+#
+# The uncompressed format, as described in the Zemax manual, is:
+#
+#     int version
+#     int max_n_segments
+#     for each ray:
+#         int n_segments
+#         RAY_SEGMENT segments[n_segments]
+#
+# where RAY_SEGMENT is the record described by zrd_segment_dtype.
+#
+# Rays can be selected with the filter strings used by NSCTrace (see
+# RayFilter) and the power reaching the end of each distinct sequence
+# of objects hit by the rays can be totalled (see path_budget).
+
+import mmap
+import re
+import struct
+import numpy as np
+
+zrd_header = struct.Struct("<ii")
+_ray_header = struct.Struct("<i")
+
+zrd_segment_dtype = np.dtype(
+    [(name, "<u4") for name in ["status"]] +
+    [(name, "<i4") for name in ["level", "hit_object", "hit_face",
+                                 "unused", "in_object", "parent",
+                                 "storage", "xybin", "lmbin"]] +
+    [(name, "<f8") for name in ["index", "starting_phase", "x", "y", "z",
+                                 "l", "m", "n", "nx", "ny", "nz",
+                                 "path_to", "intensity", "phase_of",
+                                 "phase_at", "exr", "exi", "eyr", "eyi",
+                                 "ezr", "ezi"]])
+# level : number of segments between this segment and the source
+# hit_object : object hit at the end of the segment (0 for none)
+# parent : number (within the ray) of the parent segment
+# x, y, z, l, m, n : segment end point and direction cosines (global)
+# path_to : optical path length to the end point
+
+# Chunks carry the number of the ray (counted from 0) each segment
+# belongs to.
+zrd_chunk_dtype = np.dtype([("ray", "<i8")] + zrd_segment_dtype.descr)
+
+
+class ZRDFormatError(ValueError):
+    pass
+
+
+class ZRDReader(object):
+    """Streams the rays of an uncompressed ZRD file.
+
+    with ZRDReader(path) as zrd:
+        for chunk in zrd.chunks():
+            # chunk is a structured array (see zrd_chunk_dtype)
+            ...
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ZRDFormatError("Empty ray database", path)
+        self.size = len(self._map)
+        if self.size < zrd_header.size:
+            self.close()
+            raise ZRDFormatError("File too short for ZRD header", path)
+        self.version, self.max_segments = zrd_header.unpack_from(self._map)
+
+        # A view of segment records starting at every byte of the file,
+        # so that the records of many rays can be gathered by indexing
+        # with their byte offsets.
+        itemsize = zrd_segment_dtype.itemsize
+        buf = np.frombuffer(self._map, np.uint8)
+        self._records = np.ndarray((max(self.size - itemsize + 1, 0),),
+                                   zrd_segment_dtype, buf, 0, (1,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._records = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _scan(self, pos, max_segments):
+        """Find the rays starting from byte `pos`.
+
+        Returns the lists of the offsets of the first segments and the
+        number of segments of the rays, up to a total of max_segments
+        segments (or a single ray), with the position of the next ray.
+        """
+        itemsize = zrd_segment_dtype.itemsize
+        unpack = _ray_header.unpack_from
+        starts = []
+        counts = []
+        total = 0
+        while pos < self.size and (total < max_segments or not counts):
+            n, = unpack(self._map, pos)
+            pos += _ray_header.size
+            end = pos + n * itemsize
+            if n < 1 or end > self.size:
+                raise ZRDFormatError("Corrupt ray record at byte %d" % pos)
+            starts.append(pos)
+            counts.append(n)
+            total += n
+            pos = end
+        return starts, counts, pos
+
+    def chunks(self, chunk_size=65536):
+        """Yield structured arrays holding complete rays.
+
+        Each chunk holds about `chunk_size` segments (more, if a single
+        ray has more segments).  Segments are ordered by ray, then by
+        segment number within the ray.
+        """
+        itemsize = zrd_segment_dtype.itemsize
+        pos = zrd_header.size
+        ray = 0
+        while pos < self.size:
+            starts, counts, pos = self._scan(pos, chunk_size)
+            counts = np.array(counts)
+            first = np.cumsum(counts) - counts
+            total = counts.sum()
+            # byte offset of each segment in the file
+            segment_number = np.arange(total) - np.repeat(first, counts)
+            offsets = (np.repeat(np.array(starts, np.int64), counts) +
+                       segment_number * itemsize)
+
+            chunk = np.empty(total, zrd_chunk_dtype)
+            chunk["ray"] = np.repeat(np.arange(ray, ray + len(counts)),
+                                     counts)
+            segments = self._records[offsets]
+            for name in zrd_segment_dtype.names:
+                chunk[name] = segments[name]
+            ray += len(counts)
+            yield chunk
+
+    def __iter__(self):
+        """Yield the segments of each ray, in turn."""
+        for chunk in self.chunks():
+            bounds = np.flatnonzero(np.diff(chunk["ray"])) + 1
+            for ray in np.split(chunk, bounds):
+                yield ray
+
+
+def read_zrd(path):
+    """Read all the segments of an uncompressed ZRD file into memory."""
+    with ZRDReader(path) as zrd:
+        chunks = list(zrd.chunks())
+    if not chunks:
+        return np.empty(0, zrd_chunk_dtype)
+    return np.concatenate(chunks)
+
+
+# Bits of the segment status field
+TERMINATED = 1 << 0
+REFLECTED = 1 << 1
+TRANSMITTED = 1 << 2
+SCATTERED = 1 << 3
+DIFFRACTED = 1 << 4
+GHOST = 1 << 5
+
+
+def _ray_numbers(chunk):
+    """Number the rays in a chunk from 0, returning (numbers, count)."""
+    new_ray = np.ones(len(chunk), bool)
+    new_ray[1:] = chunk["ray"][1:] != chunk["ray"][:-1]
+    numbers = np.cumsum(new_ray) - 1
+    return numbers, int(numbers[-1]) + 1 if len(chunk) else 0
+
+
+def _any_segment(predicate):
+    """Make a ray test from a test on segments."""
+    def test(chunk, numbers, nrays):
+        hits = np.bincount(numbers, predicate(chunk), nrays)
+        return hits > 0
+    return test
+
+
+def _status_at(bit):
+    def term(n):
+        return _any_segment(lambda c: (c["hit_object"] == n) &
+                            (c["status"] & bit != 0))
+    return term
+
+
+# Filter terms, as used in the filter strings of NSCTrace.  Each term
+# is a letter followed by an object number (or a segment level for L).
+_filter_terms = {
+    "H": lambda n: _any_segment(lambda c: c["hit_object"] == n),
+    "M": lambda n: _negate(_any_segment(lambda c: c["hit_object"] == n)),
+    "R": _status_at(REFLECTED),
+    "T": _status_at(TRANSMITTED),
+    "S": _status_at(SCATTERED),
+    "D": _status_at(DIFFRACTED),
+    "G": _status_at(GHOST),
+    "E": _status_at(TERMINATED),
+    "L": lambda n: _any_segment(lambda c: c["level"] >= n),
+}
+
+
+def _negate(test):
+    return lambda *args: ~test(*args)
+
+
+def _combine(op, a, b):
+    return lambda *args: op(a(*args), b(*args))
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+class RayFilter(object):
+    """A ray filter, compiled from a filter string.
+
+    Filter strings combine terms with the operators ! (not), & (and),
+    ^ (exclusive or) and | (or), in order of decreasing precedence.
+    Parentheses group terms.  The terms are:
+
+        Hn : ray hit object n
+        Mn : ray missed object n
+        Rn, Tn, Sn, Dn : ray was reflected, transmitted (refracted),
+            scattered or diffracted at object n
+        Gn : ray was ghost reflected at object n
+        En : ray terminated at object n
+        Ln : ray has segments at level n, or higher
+
+    A ray passes the filter if any of its segments satisfies the term.
+    For example, "H3 & !G2" selects rays which hit object 3 without a
+    ghost reflection from object 2.
+    """
+    _token_re = re.compile(r"\s*(?:([A-Za-z])\s*(\d+)|(.))")
+    _binary_ops = [("|", np.logical_or), ("^", np.logical_xor),
+                   ("&", np.logical_and)]
+
+    def __init__(self, text):
+        self.text = text
+        self._tokens = self._tokenise(text)
+        self._pos = 0
+        self._test = self._parse_binary(0)
+        if self._pos != len(self._tokens):
+            raise FilterSyntaxError("Unexpected %r in filter %r" %
+                                    (self._tokens[self._pos], text))
+        del self._tokens
+
+    def _tokenise(self, text):
+        tokens = []
+        for m in self._token_re.finditer(text.rstrip()):
+            letter, number, symbol = m.groups()
+            if letter:
+                tokens.append((letter.upper(), int(number)))
+            else:
+                tokens.append(symbol)
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FilterSyntaxError("Incomplete filter %r" % self.text)
+        self._pos += 1
+        return token
+
+    def _parse_binary(self, level):
+        if level == len(self._binary_ops):
+            return self._parse_unary()
+        symbol, op = self._binary_ops[level]
+        test = self._parse_binary(level + 1)
+        while self._peek() == symbol:
+            self._next()
+            test = _combine(op, test, self._parse_binary(level + 1))
+        return test
+
+    def _parse_unary(self):
+        token = self._next()
+        if token == "!":
+            return _negate(self._parse_unary())
+        if token == "(":
+            test = self._parse_binary(0)
+            if self._next() != ")":
+                raise FilterSyntaxError("Unbalanced parentheses in %r" %
+                                        self.text)
+            return test
+        if isinstance(token, tuple) and token[0] in _filter_terms:
+            letter, number = token
+            return _filter_terms[letter](number)
+        raise FilterSyntaxError("Unexpected %r in filter %r" %
+                                (token, self.text))
+
+    def rays(self, chunk):
+        """Return a mask of the rays in a chunk which pass the filter.
+
+        The mask has one element per ray, in order of appearance."""
+        numbers, nrays = _ray_numbers(chunk)
+        return self._test(chunk, numbers, nrays)
+
+    def segments(self, chunk):
+        """Return a mask of the segments of rays which pass the filter."""
+        numbers, nrays = _ray_numbers(chunk)
+        return self._test(chunk, numbers, nrays)[numbers]
+
+    def __call__(self, chunk):
+        """Return the segments of rays in a chunk passing the filter."""
+        return chunk[self.segments(chunk)]
+
+
+def filter_rays(chunks, ray_filter):
+    """Apply a filter (string or RayFilter) to a sequence of chunks."""
+    if not isinstance(ray_filter, RayFilter):
+        ray_filter = RayFilter(ray_filter)
+    for chunk in chunks:
+        yield ray_filter(chunk)
+
+
+def hit_paths(chunk, terminal):
+    """Find the sequence of objects hit by rays up to given segments.
+
+    terminal :
+        indices of segments in the chunk
+
+    Returns an integer array of shape (len(terminal), depth).  Row i
+    lists the objects hit along the path to segment terminal[i],
+    starting from that segment and working back to the source.  Rows
+    are padded with zeros.
+    """
+    numbers, nrays = _ray_numbers(chunk)
+    first = np.flatnonzero(np.r_[True, numbers[1:] != numbers[:-1]])
+    parent = first[numbers] + chunk["parent"]
+    level = chunk["level"]
+
+    current = np.asarray(terminal)
+    active = np.ones(len(current), bool)
+    depth = int(level[current].max()) + 1 if len(current) else 0
+    paths = np.zeros((len(current), depth), chunk["hit_object"].dtype)
+    for d in range(depth):
+        paths[:, d] = np.where(active, chunk["hit_object"][current], 0)
+        active &= level[current] > 0
+        current = np.where(active, parent[current], current)
+    return paths
+
+
+def path_budget(chunks, ray_filter=None, terminal_object=None):
+    """Aggregate the power reaching the end of each distinct ray path.
+
+    The path of a segment is the tuple of objects hit by its ray, from
+    the source to the end of the segment.  The terminal segments are
+    those which hit `terminal_object` (eg. a detector), or if it is
+    None, the segments without children.  Rays are optionally selected
+    with a filter (string or RayFilter).
+
+    The chunks (eg. from ZRDReader.chunks) are processed in a single
+    pass.  Returns a dict mapping each path to a tuple of (total
+    intensity, number of terminal segments).
+    """
+    if ray_filter is not None and not isinstance(ray_filter, RayFilter):
+        ray_filter = RayFilter(ray_filter)
+
+    budget = {}
+    for chunk in chunks:
+        selected = np.ones(len(chunk), bool)
+        if ray_filter is not None:
+            selected = ray_filter.segments(chunk)
+        if terminal_object is not None:
+            selected &= chunk["hit_object"] == terminal_object
+        else:
+            # exclude segments which are parents of other segments
+            numbers, nrays = _ray_numbers(chunk)
+            first = np.flatnonzero(np.r_[True, numbers[1:] != numbers[:-1]])
+            children = chunk["level"] > 0
+            parents = (first[numbers] + chunk["parent"])[children]
+            selected[parents] = False
+        terminal = np.flatnonzero(selected)
+        if not len(terminal):
+            continue
+
+        paths, inverse = np.unique(hit_paths(chunk, terminal), axis=0,
+                                   return_inverse=True)
+        inverse = inverse.ravel()
+        power = np.bincount(inverse, chunk["intensity"][terminal],
+                            len(paths))
+        count = np.bincount(inverse, None, len(paths))
+        for path, p, n in zip(paths, power, count):
+            key = tuple(int(obj) for obj in path[::-1] if obj)
+            total, num = budget.get(key, (0.0, 0))
+            budget[key] = (total + p, num + int(n))
+    return budget